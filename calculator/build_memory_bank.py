@@ -0,0 +1,51 @@
+import argparse
+import os
+
+import cv2
+
+from calculator.knn_calculator import MemoryBankBuilder
+from detector.anomaly import Anomaly
+from logger.custom_logger import custom_logger
+
+_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def build_memory_banks(images_dir, output_dir, max_bank_size):
+    """
+    images_dir/<class_label>/*.png の正常画像から、クラスごとのメモリバンクを作成する
+    """
+    anomaly = Anomaly()
+    builder = MemoryBankBuilder(max_bank_size=max_bank_size)
+    for class_id in sorted(os.listdir(images_dir)):
+        class_dir = os.path.join(images_dir, class_id)
+        if not os.path.isdir(class_dir):
+            continue
+        num_images = 0
+        for file_name in sorted(os.listdir(class_dir)):
+            if not file_name.lower().endswith(_IMAGE_EXTENSIONS):
+                continue
+            image = cv2.imread(os.path.join(class_dir, file_name))
+            if image is None:
+                custom_logger.warning(f"failed to read {file_name}")
+                continue
+            sample_feats = anomaly.detect(image)
+            if sample_feats is None:
+                continue
+            builder.add(
+                class_id, sample_feats["layer_outputs"], sample_feats["layer_indices"]
+            )
+            num_images += 1
+        custom_logger.info(f"collected {num_images} samples for {class_id}")
+    builder.save_all(output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build per-class kNN memory banks from normal crop images."
+    )
+    parser.add_argument("--images-dir", required=True)
+    parser.add_argument("--output", default="memory_bank")
+    parser.add_argument("--max-size", type=int, default=2000)
+    args = parser.parse_args()
+
+    build_memory_banks(args.images_dir, args.output, args.max_size)
@@ -0,0 +1,305 @@
+import os
+import pickle
+
+import numpy as np
+
+from logger.custom_logger import custom_logger
+
+
+def greedy_coreset(features, target_size, projection_dim=128, seed=0):
+    """
+    k-center greedy 法で features から target_size 個の代表点のインデックスを選ぶ
+
+    距離計算は乱数射影で projection_dim 次元に落としてから行う
+    """
+    features = np.asarray(features, dtype=np.float32)
+    num = len(features)
+    if target_size >= num:
+        return np.arange(num)
+
+    rng = np.random.default_rng(seed)
+    if features.shape[1] > projection_dim:
+        projection = rng.normal(
+            size=(features.shape[1], projection_dim)
+        ).astype(np.float32) / np.sqrt(projection_dim)
+        projected = features @ projection
+    else:
+        projected = features
+
+    selected = np.empty(target_size, dtype=int)
+    selected[0] = rng.integers(num)
+    min_distances = np.sum((projected - projected[selected[0]]) ** 2, axis=1)
+    for i in range(1, target_size):
+        selected[i] = int(np.argmax(min_distances))
+        distances = np.sum((projected - projected[selected[i]]) ** 2, axis=1)
+        np.minimum(min_distances, distances, out=min_distances)
+    return selected
+
+
+def blocked_knn_distances(queries, bank, bank_sq_norms=None, k=1, block_size=4096):
+    """
+    queries (Q, D) の各行について bank (N, D) 中の近傍 k 点までのユークリッド距離の平均を返す
+
+    ||q - b||^2 = ||q||^2 + ||b||^2 - 2 q.b を bank の block_size 行ごとに計算し、
+    一時行列のサイズを Q x block_size に抑える
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if bank_sq_norms is None:
+        bank_sq_norms = np.einsum("ij,ij->i", bank, bank)
+    query_sq_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+    k = min(k, len(bank))
+
+    best = np.full((len(queries), k), np.inf, dtype=np.float32)
+    for start in range(0, len(bank), block_size):
+        block = bank[start : start + block_size]
+        sq = query_sq_norms + bank_sq_norms[None, start : start + block_size]
+        sq -= 2.0 * (queries @ block.T)
+        candidates = np.concatenate([best, sq], axis=1)
+        if candidates.shape[1] > k:
+            candidates = np.partition(candidates, k - 1, axis=1)[:, :k]
+        best = candidates
+    return np.sqrt(np.maximum(best, 0.0)).mean(axis=1)
+
+
+class IVFIndex:
+    """
+    k-means の粗い量子化器による転置リストで、近傍探索を n_probe 個のリストに絞る
+    """
+
+    def __init__(self, bank, n_lists=64, n_probe=4, iterations=10, seed=0):
+        self.n_probe = n_probe
+        n_lists = max(1, min(n_lists, len(bank)))
+        rng = np.random.default_rng(seed)
+        centroids = bank[rng.choice(len(bank), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(bank, centroids)
+            for c in range(n_lists):
+                members = bank[assignments == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        assignments = self._assign(bank, centroids)
+
+        self.centroids = centroids
+        order = np.argsort(assignments, kind="stable")
+        self.bank = bank[order]
+        self.bank_sq_norms = np.einsum("ij,ij->i", self.bank, self.bank)
+        counts = np.bincount(assignments, minlength=n_lists)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    @staticmethod
+    def _assign(points, centroids):
+        sq = (
+            np.einsum("ij,ij->i", points, points)[:, None]
+            + np.einsum("ij,ij->i", centroids, centroids)[None, :]
+            - 2.0 * (points @ centroids.T)
+        )
+        return np.argmin(sq, axis=1)
+
+    def search(self, query, k=1, block_size=4096):
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        n_probe = min(self.n_probe, len(self.centroids))
+        nearest_lists = np.argpartition(
+            self._centroid_sq_distances(query), n_probe - 1
+        )[:n_probe]
+        rows = np.concatenate(
+            [np.arange(self.offsets[c], self.offsets[c + 1]) for c in nearest_lists]
+        )
+        if len(rows) == 0:
+            return float(
+                blocked_knn_distances(query, self.bank, self.bank_sq_norms, k, block_size)[0]
+            )
+        return float(
+            blocked_knn_distances(
+                query, self.bank[rows], self.bank_sq_norms[rows], k, block_size
+            )[0]
+        )
+
+    def _centroid_sq_distances(self, query):
+        delta = self.centroids - query
+        return np.einsum("ij,ij->i", delta, delta)
+
+    def overhead_nbytes(self):
+        # 並べ替え後のバンクは MemoryBankData 側で元のバンクと置き換えて共有する
+        return self.centroids.nbytes + self.offsets.nbytes
+
+
+class MemoryBankData:
+    def __init__(self, class_id):
+        self.class_id = class_id
+        self.banks = {}
+        self.sq_norms = {}
+        self.indexes = {}
+
+    def add(self, layer_index, bank):
+        bank = np.ascontiguousarray(bank, dtype=np.float32)
+        self.banks[layer_index] = bank
+        self.sq_norms[layer_index] = np.einsum("ij,ij->i", bank, bank)
+
+    def build_indexes(self, n_lists, n_probe, min_bank_size=1024):
+        for layer_index, bank in self.banks.items():
+            if len(bank) >= min_bank_size:
+                index = IVFIndex(bank, n_lists, n_probe)
+                self.indexes[layer_index] = index
+                self.banks[layer_index] = index.bank
+                self.sq_norms[layer_index] = index.bank_sq_norms
+
+    def nbytes(self):
+        total = sum(bank.nbytes for bank in self.banks.values())
+        total += sum(norms.nbytes for norms in self.sq_norms.values())
+        total += sum(index.overhead_nbytes() for index in self.indexes.values())
+        return total
+
+
+class MemoryBankBuilder:
+    """
+    Anomaly.detect のレイヤー出力をクラスごとに蓄積し、コアセットで縮約したバンクを保存する
+    """
+
+    def __init__(self, max_bank_size=2000, projection_dim=128):
+        self.max_bank_size = max_bank_size
+        self.projection_dim = projection_dim
+        self._features = {}
+
+    def add(self, class_id, layer_outputs, layer_indices=None):
+        if layer_indices is None:
+            layer_indices = range(len(layer_outputs))
+        layers = self._features.setdefault(class_id, {})
+        for layer_index, layer_output in zip(layer_indices, layer_outputs):
+            layers.setdefault(layer_index, []).append(
+                np.asarray(layer_output[0], dtype=np.float32).ravel()
+            )
+
+    def build(self, class_id):
+        layers = self._features[class_id]
+        num_samples = len(next(iter(layers.values())))
+        # 全レイヤーで同じサンプルを残すよう、最終層の特徴量でコアセットを選ぶ
+        last_layer = max(layers)
+        selected = greedy_coreset(
+            np.stack(layers[last_layer]), self.max_bank_size, self.projection_dim
+        )
+        custom_logger.info(
+            f"memory bank for {class_id}: {len(selected)} of {num_samples} samples kept"
+        )
+        return {
+            layer_index: np.stack(features)[selected]
+            for layer_index, features in layers.items()
+        }
+
+    def save_all(self, data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+        for class_id in self._features:
+            file_path = os.path.join(data_dir, f"{class_id}_memory_bank.pkl")
+            with open(file_path, "wb") as f:
+                pickle.dump(self.build(class_id), f)
+            custom_logger.info(f"memory bank saved: {file_path}")
+
+
+class MemoryBankLoader:
+    def __init__(self, data_dir, ivf_n_lists=None, ivf_n_probe=4):
+        self.data_dir = data_dir
+        self.ivf_n_lists = ivf_n_lists
+        self.ivf_n_probe = ivf_n_probe
+
+    def list_class_ids(self):
+        if not os.path.isdir(self.data_dir):
+            return []
+        return [
+            file_name.split("_memory_bank.pkl")[0]
+            for file_name in os.listdir(self.data_dir)
+            if file_name.endswith("_memory_bank.pkl")
+        ]
+
+    def load_all_class_data(self):
+        return {
+            class_id: self.load_data_by_class_id(class_id)
+            for class_id in self.list_class_ids()
+        }
+
+    def load_data_by_class_id(self, class_id):
+        file_path = os.path.join(self.data_dir, f"{class_id}_memory_bank.pkl")
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(
+                f"Memory bank with class ID {class_id} not found in {self.data_dir}"
+            )
+        class_data = MemoryBankData(class_id)
+        with open(file_path, "rb") as f:
+            layer_banks = pickle.load(f)
+        for layer_index, bank in layer_banks.items():
+            class_data.add(layer_index, bank)
+        if self.ivf_n_lists:
+            class_data.build_indexes(self.ivf_n_lists, self.ivf_n_probe)
+        return class_data
+
+
+class KNNMetrics:
+    """
+    クラスごとのメモリバンクに対する近傍距離の総和で異常度を求める
+
+    VectorMetrics と同じ distances / cascade_distances / angle_difference_sum を持つ
+    """
+
+    def __init__(self, class_data_dict, k=1, block_size=4096):
+        self.class_data_dict = class_data_dict
+        self.k = k
+        self.block_size = block_size
+
+    def _layer_distance(self, class_data, layer_index, sample_feat):
+        query = np.asarray(sample_feat[0], dtype=np.float32).ravel()
+        index = class_data.indexes.get(layer_index)
+        if index is not None:
+            return index.search(query, self.k, self.block_size)
+        return float(
+            blocked_knn_distances(
+                query,
+                class_data.banks[layer_index],
+                class_data.sq_norms[layer_index],
+                self.k,
+                self.block_size,
+            )[0]
+        )
+
+    def distances(self, class_id, sample_feats, layer_indices=None):
+        if class_id not in self.class_data_dict:
+            raise KeyError(f"Class ID {class_id} not found in class_data_dict")
+        class_data = self.class_data_dict[class_id]
+        if layer_indices is None:
+            layer_indices = range(len(sample_feats))
+        total_distance = 0.0
+        for layer_index, sample_feat in zip(layer_indices, sample_feats):
+            if layer_index in class_data.banks:
+                total_distance += self._layer_distance(
+                    class_data, layer_index, sample_feat
+                )
+        return total_distance
+
+    def batch_distances(self, class_id, layer_batches, layer_indices=None):
+        """
+        layer_batches の各層 (N, D) をまとめて探索する。オフライン用途のため IVF は使わず厳密に探索する
+        """
+        if class_id not in self.class_data_dict:
+            raise KeyError(f"Class ID {class_id} not found in class_data_dict")
+        class_data = self.class_data_dict[class_id]
+        if layer_indices is None:
+            layer_indices = range(len(layer_batches))
+        total_distance = np.zeros(len(layer_batches[0]))
+        for layer_index, batch in zip(layer_indices, layer_batches):
+            if layer_index in class_data.banks:
+                total_distance += blocked_knn_distances(
+                    batch,
+                    class_data.banks[layer_index],
+                    class_data.sq_norms[layer_index],
+                    self.k,
+                    self.block_size,
+                )
+        return total_distance
+
+    def batch_angle_difference_sum(self, class_id, layer_batches, layer_indices=None):
+        return np.zeros(len(layer_batches[0]))
+
+    def cascade_distances(self, class_id, sample_feats, threshold, layer_indices=None, **_):
+        distance = self.distances(class_id, sample_feats, layer_indices)
+        return distance, False, len(sample_feats)
+
+    def angle_difference_sum(self, class_id, sample_feats, layer_indices=None):
+        # メモリバンクには平均ベクトルがないため角度差は定義しない
+        return 0
@@ -1,8 +1,13 @@
 import os
 import pickle
+import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 
+from logger.custom_logger import custom_logger
+
 
 class Mean_inv_Cov_Data:
     def __init__(self, class_id):
@@ -10,25 +15,42 @@ class Mean_inv_Cov_Data:
         self.data = []
 
     def add(self, index, mean_feat, inv_cov_feat):
+        # float64 のまま保持すると float32 の特徴量との演算が毎フレーム
+        # float64 に昇格するため、読み込み時に一度だけ float32 に変換する
         self.data.append(
-            {"layer_index": index, "mean_feat": mean_feat, "inv_cov_feat": inv_cov_feat}
+            {
+                "layer_index": index,
+                "mean_feat": np.asarray(mean_feat, dtype=np.float32),
+                "inv_cov_feat": np.asarray(inv_cov_feat, dtype=np.float32),
+            }
         )
 
     def get_layer_data(self, index):
         return self.data[index]
 
+    def nbytes(self):
+        return sum(
+            np.asarray(layer["mean_feat"]).nbytes
+            + np.asarray(layer["inv_cov_feat"]).nbytes
+            for layer in self.data
+        )
+
 
 class MeanInvCovDataLoader:
     def __init__(self, data_dir):
         self.data_dir = data_dir
 
+    def list_class_ids(self):
+        return [
+            file_name.split("_mean_inv_cov.pkl")[0]
+            for file_name in os.listdir(self.data_dir)
+            if file_name.endswith("_mean_inv_cov.pkl")
+        ]
+
     def load_all_class_data(self):
         class_data_dict = {}
-        for file_name in os.listdir(self.data_dir):
-            if file_name.endswith("_mean_inv_cov.pkl"):
-                class_id = file_name.split("_mean_inv_cov.pkl")[0]
-                class_data = self.load_data_by_class_id(class_id)
-                class_data_dict[class_id] = class_data
+        for class_id in self.list_class_ids():
+            class_data_dict[class_id] = self.load_data_by_class_id(class_id)
         return class_data_dict
 
     def load_data_by_class_id(self, class_id):
@@ -49,6 +71,124 @@ class MeanInvCovDataLoader:
             )
 
 
+class ClassDataCache:
+    """
+    クラスごとの Mean_inv_Cov_Data をメモリ予算内で保持するキャッシュ
+
+    初回参照時に読み込み、予算を超えた場合は policy ("lru" / "lfu") に従って
+    pinned 以外のクラスを追い出す。VectorMetrics からは dict と同様に参照できる
+    """
+
+    def __init__(self, data_loader, memory_budget_bytes, pinned=None, policy="lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.data_loader = data_loader
+        self.memory_budget_bytes = memory_budget_bytes
+        self.pinned = set(pinned or [])
+        self.policy = policy
+
+        self._lock = threading.Lock()
+        self._class_ids = set(data_loader.list_class_ids())
+        self._resident = OrderedDict()
+        self._sizes = {}
+        self._use_counts = {}
+        self._resident_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_load_seconds = 0.0
+        self.max_load_seconds = 0.0
+
+        for class_id in self.pinned & self._class_ids:
+            self.__getitem__(class_id)
+
+    def __contains__(self, class_id):
+        return class_id in self._class_ids
+
+    def __len__(self):
+        return len(self._class_ids)
+
+    def __getitem__(self, class_id):
+        with self._lock:
+            if class_id in self._resident:
+                self.hits += 1
+                self._use_counts[class_id] += 1
+                self._resident.move_to_end(class_id)
+                return self._resident[class_id]
+
+            if class_id not in self._class_ids:
+                raise KeyError(class_id)
+
+            self.misses += 1
+            start_time = time.perf_counter()
+            class_data = self.data_loader.load_data_by_class_id(class_id)
+            elapsed = time.perf_counter() - start_time
+            self.total_load_seconds += elapsed
+            self.max_load_seconds = max(self.max_load_seconds, elapsed)
+
+            size = class_data.nbytes()
+            self._resident[class_id] = class_data
+            self._sizes[class_id] = size
+            self._use_counts[class_id] = self._use_counts.get(class_id, 0) + 1
+            self._resident_bytes += size
+            self._evict(keep=class_id)
+            return class_data
+
+    def _eviction_candidates(self, keep):
+        candidates = [
+            class_id
+            for class_id in self._resident
+            if class_id != keep and class_id not in self.pinned
+        ]
+        if self.policy == "lfu":
+            # 同じ使用回数なら最も古く使われたクラスから追い出す
+            order = {class_id: i for i, class_id in enumerate(self._resident)}
+            candidates.sort(key=lambda c: (self._use_counts[c], order[c]))
+        return candidates
+
+    def _evict(self, keep):
+        if self._resident_bytes <= self.memory_budget_bytes:
+            return
+        for class_id in self._eviction_candidates(keep):
+            if self._resident_bytes <= self.memory_budget_bytes:
+                break
+            del self._resident[class_id]
+            self._resident_bytes -= self._sizes.pop(class_id)
+            self.evictions += 1
+            custom_logger.debug(f"class statistics evicted: {class_id}")
+        if self._resident_bytes > self.memory_budget_bytes:
+            custom_logger.warning(
+                f"class statistics exceed the memory budget even after eviction / "
+                f"resident {self._resident_bytes} bytes / "
+                f"budget {self.memory_budget_bytes} bytes"
+            )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "resident_classes": len(self._resident),
+                "resident_bytes": self._resident_bytes,
+                "total_load_seconds": self.total_load_seconds,
+                "max_load_seconds": self.max_load_seconds,
+            }
+
+
+def load_class_data(data_loader, memory_budget_bytes=None, pinned=None, policy="lru"):
+    """
+    予算が指定されていなければ全クラスを読み込んだ dict を、
+    指定されていれば ClassDataCache を返す
+    """
+    if memory_budget_bytes is None:
+        return data_loader.load_all_class_data()
+    return ClassDataCache(data_loader, memory_budget_bytes, pinned, policy)
+
+
 class VectorMetrics:
     def __init__(self, class_data_dict):
         self.class_data_dict = class_data_dict
@@ -67,31 +207,128 @@ class VectorMetrics:
         m = np.dot(np.dot(delta, VI), delta)
         return np.sqrt(m)
 
-    def distances(self, class_id, sample_feats):
+    def _iter_layers(self, class_data, sample_feats, layer_indices):
+        if layer_indices is None:
+            layer_indices = range(len(sample_feats))
+        for layer_index, sample_feat in zip(layer_indices, sample_feats):
+            yield class_data.get_layer_data(layer_index), sample_feat
+
+    def _layer_distance(self, layer_data, sample_feat):
+        return self.mahalanobis(
+            sample_feat[0],
+            layer_data["mean_feat"],
+            layer_data["inv_cov_feat"],
+        )
+
+    def distances(self, class_id, sample_feats, layer_indices=None):
         if class_id in self.class_data_dict:
             class_data = self.class_data_dict[class_id]
             total_distance = 0
-            for index, sample_feat in enumerate(sample_feats):
-                layer_data = class_data.get_layer_data(index)
-                mean_feat = layer_data["mean_feat"]
-                inv_cov_feat = layer_data["inv_cov_feat"]
-
-                dist = self.mahalanobis(
-                    sample_feat[0],
-                    mean_feat,
-                    inv_cov_feat,
-                )
-                total_distance += dist
+            for layer_data, sample_feat in self._iter_layers(
+                class_data, sample_feats, layer_indices
+            ):
+                total_distance += self._layer_distance(layer_data, sample_feat)
             return total_distance
         else:
             raise KeyError(f"Class ID {class_id} not found in class_data_dict")
 
-    def angle_difference_sum(self, class_id, sample_feats):
+    def cascade_distances(
+        self,
+        class_id,
+        sample_feats,
+        threshold,
+        layer_indices=None,
+        margin=0.2,
+        min_layers=2,
+    ):
+        """
+        コストの小さい層から順に距離を加算し、判定が明らかになった時点で打ち切る
+
+        正常分布下での各層の期待距離を sqrt(D) とみなし、途中までの和から全体の和を
+        外挿する。外挿値が threshold の (1 - margin) 倍を明確に下回る場合、もしくは
+        途中までの和が threshold を超えた場合に残りの層を計算しない。外挿値は打ち切りの
+        判定にだけ使い、異常の疑いがある場合は閾値を超えるまで実際の距離を計算する。
+        戻り値は (計算した層までの距離の和, 打ち切りの有無, 計算した層の数)
+        """
+        if class_id not in self.class_data_dict:
+            raise KeyError(f"Class ID {class_id} not found in class_data_dict")
+
+        class_data = self.class_data_dict[class_id]
+        layers = list(self._iter_layers(class_data, sample_feats, layer_indices))
+        # 逆共分散行列は D x D なので、1 層あたりのコストは D^2 に比例する
+        layers.sort(key=lambda layer: np.shape(layer[0]["inv_cov_feat"])[-1])
+        expected = [
+            np.sqrt(np.shape(layer_data["inv_cov_feat"])[-1])
+            for layer_data, _ in layers
+        ]
+        expected_total = float(np.sum(expected))
+
+        total_distance = 0.0
+        expected_seen = 0.0
+        for num_used, (layer_data, sample_feat) in enumerate(layers, start=1):
+            total_distance += self._layer_distance(layer_data, sample_feat)
+            expected_seen += expected[num_used - 1]
+            if num_used == len(layers):
+                break
+
+            # 距離は非負なので、途中の和が閾値を超えた時点で異常が確定する
+            if total_distance > threshold:
+                return total_distance, True, num_used
+            if num_used < min_layers:
+                continue
+
+            # 推定値を返すと閾値との比較結果が打ち切らなかった場合と食い違うため、
+            # 明らかに正常な場合だけ打ち切り、その時点までの実際の和を返す
+            projected = total_distance * expected_total / expected_seen
+            if projected < threshold * (1 - margin):
+                return total_distance, True, num_used
+
+        return total_distance, False, len(layers)
+
+    def batch_distances(self, class_id, layer_batches, layer_indices=None):
+        """
+        layer_batches の各層 (N, D) について N サンプル分の距離をまとめて計算し、
+        層の和 (N,) を返す
+        """
+        if class_id not in self.class_data_dict:
+            raise KeyError(f"Class ID {class_id} not found in class_data_dict")
+        class_data = self.class_data_dict[class_id]
+        total_distance = np.zeros(len(layer_batches[0]), dtype=np.float32)
+        for layer_data, batch in self._iter_layers(
+            class_data, layer_batches, layer_indices
+        ):
+            delta = np.asarray(batch, dtype=np.float32) - layer_data["mean_feat"]
+            m = np.einsum(
+                "nd,nd->n", delta @ np.atleast_2d(layer_data["inv_cov_feat"]), delta
+            )
+            total_distance += np.sqrt(np.maximum(m, 0.0))
+        return total_distance
+
+    def batch_angle_difference_sum(self, class_id, layer_batches, layer_indices=None):
+        if class_id not in self.class_data_dict:
+            raise KeyError(f"Class ID {class_id} not found in class_data_dict")
+        class_data = self.class_data_dict[class_id]
+        total_angle_diff = np.zeros(len(layer_batches[0]), dtype=np.float32)
+        for layer_data, batch in self._iter_layers(
+            class_data, layer_batches, layer_indices
+        ):
+            batch = np.asarray(batch, dtype=np.float32)
+            mean_vec = layer_data["mean_feat"]
+            cosine_similarity = (batch @ mean_vec) / (
+                np.linalg.norm(batch, axis=1) * np.linalg.norm(mean_vec)
+            )
+            total_angle_diff += np.degrees(
+                np.arccos(np.clip(cosine_similarity, -1.0, 1.0))
+            )
+        return total_angle_diff
+
+    def angle_difference_sum(self, class_id, sample_feats, layer_indices=None):
         if class_id in self.class_data_dict:
             class_data = self.class_data_dict[class_id]
             total_angle_diff = 0
-            for index, sample_feat in enumerate(sample_feats):
-                layer_data = class_data.get_layer_data(index)
+            for layer_data, sample_feat in self._iter_layers(
+                class_data, sample_feats, layer_indices
+            ):
                 mean_feat = layer_data["mean_feat"]
 
                 sample_vec = np.asarray(sample_feat[0])
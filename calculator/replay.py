@@ -0,0 +1,160 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from calculator.knn_calculator import KNNMetrics, MemoryBankLoader
+from calculator.mahalanobis_calculator import (
+    MeanInvCovDataLoader,
+    VectorMetrics,
+    load_class_data,
+)
+from calculator.scorer_router import build_metric
+from config_manager.config import SystemConfigs
+from logger.custom_logger import custom_logger
+from storage.feature_archive import FeatureArchiveReader
+
+
+def build_replay_metric(scorer, mean_inv_cov_path, memory_bank_dir=None, k=1):
+    system_config = SystemConfigs()
+    if scorer == "config":
+        return build_metric(system_config, mean_inv_cov_path)
+    if scorer == "mahalanobis":
+        return VectorMetrics(load_class_data(MeanInvCovDataLoader(mean_inv_cov_path)))
+    if scorer == "knn":
+        bank_loader = MemoryBankLoader(memory_bank_dir or system_config.memory_bank_dir)
+        return KNNMetrics(load_class_data(bank_loader), k=k)
+    raise ValueError(f"Unknown scorer: {scorer}")
+
+
+def reextract_chunk(chunk, anomaly):
+    """
+    記録した切り出し画像から Anomaly.detect をやり直し、チャンクのレイヤー出力を置き換える
+    """
+    rows = []
+    layers = {}
+    for row in range(len(chunk)):
+        crop = chunk.decode_crop(row)
+        if crop is None or crop.size == 0:
+            continue
+        sample_feats = anomaly.detect(crop)
+        if sample_feats is None:
+            continue
+        for layer_index, layer_output in zip(
+            sample_feats["layer_indices"], sample_feats["layer_outputs"]
+        ):
+            layers.setdefault(int(layer_index), []).append(
+                np.asarray(layer_output[0], dtype=np.float32).ravel()
+            )
+        rows.append(row)
+    chunk.records = [chunk.records[row] for row in rows]
+    chunk.layer_indices = sorted(layers)
+    chunk.layers = {layer_index: np.stack(feats) for layer_index, feats in layers.items()}
+    return chunk
+
+
+def score_chunk(metric, chunk):
+    """
+    チャンク内のレコードをクラスごとにまとめ、batch_distances で一度に採点する
+    """
+    labels = np.asarray([record["class_label"] for record in chunk.records])
+    scored = []
+    for class_label in np.unique(labels):
+        rows = np.flatnonzero(labels == class_label)
+        layer_batches = chunk.layer_batches(rows)
+        try:
+            distances = metric.batch_distances(
+                str(class_label), layer_batches, chunk.layer_indices
+            )
+            angle_diffs = metric.batch_angle_difference_sum(
+                str(class_label), layer_batches, chunk.layer_indices
+            )
+        except KeyError:
+            custom_logger.warning(f"no statistics for {class_label}, skipping {len(rows)}")
+            continue
+        for row, distance, angle_diff in zip(rows, distances, angle_diffs):
+            scored.append(
+                dict(
+                    chunk.records[row],
+                    anomaly_distances=float(distance),
+                    angle_diff=float(angle_diff),
+                )
+            )
+    return scored
+
+
+def summarize(scored, threshold=None):
+    by_class = {}
+    for result in scored:
+        by_class.setdefault(result["class_label"], []).append(result["anomaly_distances"])
+    print(f"{'class':<16}{'count':>8}{'mean':>12}{'p95':>12}{'over':>8}")
+    for class_label, distances in sorted(by_class.items()):
+        distances = np.asarray(distances)
+        over = "-" if threshold is None else int(np.sum(distances > threshold))
+        print(
+            f"{class_label:<16}{len(distances):>8}{distances.mean():>12.3f}"
+            f"{np.percentile(distances, 95):>12.3f}{over:>8}"
+        )
+
+
+def replay(archive_dir, metric, output_path=None, reextract=False):
+    anomaly = None
+    if reextract:
+        # 特徴量の再計算時だけ TFLite を必要とするよう、ここで読み込む
+        from detector.anomaly import Anomaly
+
+        anomaly = Anomaly()
+
+    start_time = time.perf_counter()
+    scored = []
+    num_chunks = 0
+    for chunk in FeatureArchiveReader(archive_dir):
+        if anomaly is not None:
+            if chunk.crops is None:
+                custom_logger.warning(f"{chunk.path} has no crops, using stored features")
+            else:
+                chunk = reextract_chunk(chunk, anomaly)
+        scored.extend(score_chunk(metric, chunk))
+        num_chunks += 1
+    elapsed = time.perf_counter() - start_time
+    custom_logger.info(
+        f"replayed {len(scored)} records from {num_chunks} chunks in {elapsed:.2f} s"
+    )
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            for result in scored:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        custom_logger.info(f"re-scored results saved: {output_path}")
+    return scored
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-score recorded anomaly features without re-running detection."
+    )
+    parser.add_argument("archive", help="Recording directory written with --record.")
+    parser.add_argument("--mean-inv-cov", default="mean_inv_cov")
+    parser.add_argument(
+        "--scorer",
+        choices=("config", "mahalanobis", "knn"),
+        default="config",
+        help="Scorer to use (config: anomaly_scorer in system_configs.json).",
+    )
+    parser.add_argument("--memory-bank", default=None)
+    parser.add_argument("--k", type=int, default=1)
+    parser.add_argument(
+        "--reextract",
+        action="store_true",
+        help="Re-run the anomaly model on recorded crops instead of stored features.",
+    )
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--output", default=None, help="Write re-scored results as JSONL.")
+    args = parser.parse_args()
+
+    metric = build_replay_metric(args.scorer, args.mean_inv_cov, args.memory_bank, args.k)
+    summarize(
+        replay(args.archive, metric, args.output, args.reextract),
+        args.threshold,
+    )
@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import numpy as np
+
+from calculator.knn_calculator import KNNMetrics, MemoryBankData, greedy_coreset
+from calculator.mahalanobis_calculator import Mean_inv_Cov_Data, VectorMetrics
+
+
+def _synthetic_class(rng, layer_dims, num_samples, num_modes):
+    """
+    複数の正規分布を混ぜた多峰性の学習特徴量と、そこから推定した統計量を作る
+    """
+    layers = []
+    for dim in layer_dims:
+        centers = rng.normal(scale=3.0, size=(num_modes, dim))
+        modes = rng.integers(num_modes, size=num_samples)
+        features = centers[modes] + rng.normal(size=(num_samples, dim))
+        layers.append(features.astype(np.float32))
+    return layers
+
+
+def _time_per_query(func, queries, repeats):
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        for query in queries:
+            func(query)
+    return (time.perf_counter() - start_time) * 1000.0 / (repeats * len(queries))
+
+
+def run(layer_dims, num_samples, bank_size, num_modes, ivf_n_lists, num_queries):
+    rng = np.random.default_rng(0)
+    layers = _synthetic_class(rng, layer_dims, num_samples, num_modes)
+
+    stats = Mean_inv_Cov_Data("bench")
+    for index, features in enumerate(layers):
+        cov = np.cov(features, rowvar=False) + 0.01 * np.eye(features.shape[1])
+        stats.add(index, features.mean(axis=0), np.linalg.inv(cov))
+    mahalanobis = VectorMetrics({"bench": stats})
+
+    start_time = time.perf_counter()
+    selected = greedy_coreset(layers[-1], bank_size)
+    coreset_seconds = time.perf_counter() - start_time
+    bank = MemoryBankData("bench")
+    for index, features in enumerate(layers):
+        bank.add(index, features[selected])
+    knn = KNNMetrics({"bench": bank})
+
+    ivf_bank = MemoryBankData("bench")
+    for index, features in enumerate(layers):
+        ivf_bank.add(index, features[selected])
+    ivf_bank.build_indexes(ivf_n_lists, n_probe=4, min_bank_size=0)
+    ivf = KNNMetrics({"bench": ivf_bank})
+
+    queries = [
+        [
+            [layer[rng.integers(len(layer))] + rng.normal(size=layer.shape[1])]
+            for layer in layers
+        ]
+        for _ in range(num_queries)
+    ]
+
+    rows = []
+    for name, metric, data in (
+        ("mahalanobis", mahalanobis, stats),
+        ("knn", knn, bank),
+        (f"knn+ivf({ivf_n_lists})", ivf, ivf_bank),
+    ):
+        latency = _time_per_query(
+            lambda q: metric.distances("bench", q), queries, repeats=3
+        )
+        rows.append((name, latency, data.nbytes()))
+
+    print(
+        f"layers {list(layer_dims)} / samples {num_samples} / bank {len(selected)} / "
+        f"coreset {coreset_seconds:.2f} s"
+    )
+    print(f"{'scorer':<16}{'ms/query':>12}{'memory MiB':>14}")
+    for name, latency, nbytes in rows:
+        print(f"{name:<16}{latency:>12.3f}{nbytes / 2**20:>14.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare Mahalanobis and memory-bank kNN scorers on synthetic features."
+    )
+    parser.add_argument(
+        "--layer-dims",
+        type=int,
+        nargs="+",
+        default=[16, 24, 40, 80, 112, 192, 320, 1280, 1280],
+    )
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--bank-size", type=int, default=1000)
+    parser.add_argument("--modes", type=int, default=4)
+    parser.add_argument("--ivf-lists", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    run(
+        args.layer_dims,
+        args.samples,
+        args.bank_size,
+        args.modes,
+        args.ivf_lists,
+        args.queries,
+    )
@@ -0,0 +1,106 @@
+from calculator.knn_calculator import KNNMetrics, MemoryBankLoader
+from calculator.mahalanobis_calculator import (
+    MeanInvCovDataLoader,
+    VectorMetrics,
+    load_class_data,
+)
+from logger.custom_logger import custom_logger
+
+MAHALANOBIS = "mahalanobis"
+KNN = "knn"
+
+
+class ScorerRouter:
+    """
+    クラスごとに設定されたスコアラー (mahalanobis / knn) へ処理を振り分ける
+
+    knn のクラスでも角度差は Mahalanobis 側の平均ベクトルがあればそちらで計算する
+    """
+
+    def __init__(self, scorers, class_scorers, default_scorer=MAHALANOBIS):
+        self.scorers = scorers
+        self.class_scorers = class_scorers
+        self.default_scorer = default_scorer
+
+    @property
+    def class_data_dict(self):
+        return self.scorers[MAHALANOBIS].class_data_dict
+
+    def scorer_for(self, class_id):
+        return self.scorers[self.class_scorers.get(class_id, self.default_scorer)]
+
+    def distances(self, class_id, sample_feats, layer_indices=None):
+        return self.scorer_for(class_id).distances(class_id, sample_feats, layer_indices)
+
+    def cascade_distances(self, class_id, sample_feats, threshold, **kwargs):
+        return self.scorer_for(class_id).cascade_distances(
+            class_id, sample_feats, threshold, **kwargs
+        )
+
+    def angle_difference_sum(self, class_id, sample_feats, layer_indices=None):
+        mahalanobis = self.scorers[MAHALANOBIS]
+        if class_id in mahalanobis.class_data_dict:
+            return mahalanobis.angle_difference_sum(class_id, sample_feats, layer_indices)
+        return self.scorer_for(class_id).angle_difference_sum(
+            class_id, sample_feats, layer_indices
+        )
+
+    def batch_distances(self, class_id, layer_batches, layer_indices=None):
+        return self.scorer_for(class_id).batch_distances(
+            class_id, layer_batches, layer_indices
+        )
+
+    def batch_angle_difference_sum(self, class_id, layer_batches, layer_indices=None):
+        mahalanobis = self.scorers[MAHALANOBIS]
+        if class_id in mahalanobis.class_data_dict:
+            return mahalanobis.batch_angle_difference_sum(
+                class_id, layer_batches, layer_indices
+            )
+        return self.scorer_for(class_id).batch_angle_difference_sum(
+            class_id, layer_batches, layer_indices
+        )
+
+
+def build_metric(system_config, mean_inv_cov_path):
+    """
+    system_configs.json の class_statistics と anomaly_scorer の設定からスコアラーを構築する
+
+    メモリ予算は Mahalanobis の統計データが class_statistics.memory_budget_bytes、
+    kNN のメモリバンクが anomaly_scorer.memory_bank.memory_budget_bytes で別々に管理する。
+    両方を使う場合、常駐するデータの上限は 2 つの予算の和になる
+    """
+    metric = VectorMetrics(
+        load_class_data(
+            MeanInvCovDataLoader(mean_inv_cov_path),
+            memory_budget_bytes=system_config.class_statistics_memory_budget_bytes,
+            pinned=system_config.class_statistics_pinned,
+            policy=system_config.class_statistics_policy,
+        )
+    )
+
+    class_scorers = system_config.anomaly_scorer_classes
+    default_scorer = system_config.anomaly_scorer_default
+    if default_scorer != KNN and KNN not in class_scorers.values():
+        return metric
+
+    bank_loader = MemoryBankLoader(
+        system_config.memory_bank_dir,
+        ivf_n_lists=system_config.memory_bank_ivf_n_lists,
+        ivf_n_probe=system_config.memory_bank_ivf_n_probe,
+    )
+    knn_metric = KNNMetrics(
+        load_class_data(
+            bank_loader,
+            memory_budget_bytes=system_config.memory_bank_memory_budget_bytes,
+            pinned=system_config.class_statistics_pinned,
+            policy=system_config.class_statistics_policy,
+        ),
+        k=system_config.memory_bank_k,
+        block_size=system_config.memory_bank_block_size,
+    )
+    custom_logger.info(
+        f"anomaly scorers / default {default_scorer} / per class {class_scorers}"
+    )
+    return ScorerRouter(
+        {MAHALANOBIS: metric, KNN: knn_metric}, class_scorers, default_scorer
+    )
@@ -1,11 +1,15 @@
 import json
 import os
-from typing import Any, Dict, Union
+import threading
+from typing import Any, Dict, List, Union
 
 
 class BaseConfig:
     _shared_config: Union[None, Dict[str, Any]] = None
     _config_files_directory = "config"
+    # 設定ファイルはパス単位で一度だけパースして全インスタンスで共有する
+    _parsed_cache: Dict[str, Dict[str, Any]] = {}
+    _parsed_cache_lock = threading.Lock()
 
     def __init__(self, file_name: str) -> None:
         self.program_directory = os.path.dirname(os.path.abspath(__file__))
@@ -29,11 +33,23 @@ class BaseConfig:
         return data
 
     def _load_json(self, file_path: str) -> Dict[str, Any]:
-        try:
-            with open(file_path, "r") as file:
-                return json.load(file)
-        except Exception as e:
-            raise RuntimeError(f"Failed to load config file '{file_path}': {e}") from e
+        with self._parsed_cache_lock:
+            if file_path in self._parsed_cache:
+                return self._parsed_cache[file_path]
+            try:
+                with open(file_path, "r", encoding="utf-8") as file:
+                    config = json.load(file)
+            except Exception as e:
+                raise RuntimeError(
+                    f"Failed to load config file '{file_path}': {e}"
+                ) from e
+            self._parsed_cache[file_path] = config
+            return config
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        with cls._parsed_cache_lock:
+            cls._parsed_cache.clear()
 
 
 class TFliteConfig(BaseConfig):
@@ -57,6 +73,90 @@ class TFliteConfig(BaseConfig):
     def score_threshold(self) -> float:
         return self.get_config(f"{self.section_name}.score_threshold", 0.5)
 
+    @property
+    def max_results(self) -> int:
+        return self.get_config(f"{self.section_name}.max_results", 20)
+
+    @property
+    def rois(self) -> List[List[int]]:
+        return self.get_config(f"{self.section_name}.rois", [])
+
+    @property
+    def tiling_enabled(self) -> bool:
+        return self.get_config(f"{self.section_name}.tiling.enabled", False)
+
+    @property
+    def tile_width(self) -> int:
+        return self.get_config(f"{self.section_name}.tiling.tile_width", 640)
+
+    @property
+    def tile_height(self) -> int:
+        return self.get_config(f"{self.section_name}.tiling.tile_height", 480)
+
+    @property
+    def tile_overlap(self) -> float:
+        return self.get_config(f"{self.section_name}.tiling.overlap", 0.2)
+
+    @property
+    def nms_iou_threshold(self) -> float:
+        return self.get_config(f"{self.section_name}.tiling.iou_threshold", 0.5)
+
+    @property
+    def tile_min_score(self) -> float:
+        return self.get_config(f"{self.section_name}.tiling.min_score", 0.1)
+
+    @property
+    def output_layers(self) -> Union[None, List[int]]:
+        return self.get_config(f"{self.section_name}.output_layers", None)
+
+    @property
+    def cascade_enabled(self) -> bool:
+        return self.get_config(f"{self.section_name}.cascade.enabled", False)
+
+    @property
+    def cascade_threshold(self) -> float:
+        return self.get_config(f"{self.section_name}.cascade.threshold", 100.0)
+
+    @property
+    def cascade_margin(self) -> float:
+        return self.get_config(f"{self.section_name}.cascade.margin", 0.2)
+
+    @property
+    def cascade_min_layers(self) -> int:
+        return self.get_config(f"{self.section_name}.cascade.min_layers", 2)
+
+    @property
+    def admission_min_score(self) -> float:
+        return self.get_config(f"{self.section_name}.admission.min_score", 0.1)
+
+    @property
+    def admission_min_area(self) -> int:
+        return self.get_config(f"{self.section_name}.admission.min_area", 0)
+
+    @property
+    def admission_min_aspect_ratio(self) -> Union[None, float]:
+        return self.get_config(f"{self.section_name}.admission.min_aspect_ratio", None)
+
+    @property
+    def admission_max_aspect_ratio(self) -> Union[None, float]:
+        return self.get_config(f"{self.section_name}.admission.max_aspect_ratio", None)
+
+    @property
+    def admission_iou_threshold(self) -> Union[None, float]:
+        return self.get_config(f"{self.section_name}.admission.iou_threshold", None)
+
+    @property
+    def admission_deadline_ms(self) -> Union[None, float]:
+        return self.get_config(f"{self.section_name}.admission.deadline_ms", None)
+
+    @property
+    def admission_max_deferred(self) -> int:
+        return self.get_config(f"{self.section_name}.admission.max_deferred", 0)
+
+    @property
+    def admission_max_defer_frames(self) -> int:
+        return self.get_config(f"{self.section_name}.admission.max_defer_frames", 5)
+
 
 class LogConfigs(BaseConfig):
     def __init__(self) -> None:
@@ -75,6 +175,10 @@ class LogConfigs(BaseConfig):
         return self.get_config("log.encoding", "UTF-8")
 
 
+# 検出結果の送信先として main.py / MultiProcessPipeline が読むセクション
+RESULT_API_SECTION = "LINE"
+
+
 class ApiConfigs(BaseConfig):
     def __init__(self, section_name: str) -> None:
         super().__init__("api_config.json")
@@ -103,6 +207,22 @@ class ApiConfigs(BaseConfig):
     def timeout(self) -> int:
         return self.get_config(f"{self.section_name}.timeout", 10)
 
+    @property
+    def wire_format(self) -> str:
+        return self.get_config(f"{self.section_name}.wire_format", "json")
+
+    @property
+    def compression(self) -> Union[None, str]:
+        return self.get_config(f"{self.section_name}.compression", None)
+
+    @property
+    def delta_boxes(self) -> bool:
+        return self.get_config(f"{self.section_name}.delta_boxes", True)
+
+    @property
+    def queue_size(self) -> int:
+        return self.get_config(f"{self.section_name}.queue_size", 32)
+
 
 class LabelConfigs(BaseConfig):
     def __init__(self, config_file: str = "label_map.json") -> None:
@@ -110,10 +230,235 @@ class LabelConfigs(BaseConfig):
         self.label_map = self._load_label_map()
 
     def _load_label_map(self) -> Dict[int, str]:
-        try:
-            with open(self.config_path, "r", encoding="utf-8") as f:
-                label_map = json.load(f)
-            label_map = {int(k): v for k, v in label_map.items()}
-            return label_map
-        except Exception:
-            raise
+        return {int(k): v for k, v in self.config.items()}
+
+
+class SystemConfigs(BaseConfig):
+    def __init__(self) -> None:
+        super().__init__("system_configs.json")
+
+    @property
+    def sys_tmps_dir(self) -> str:
+        return self.get_config("sys_tmps_dir", "")
+
+    @property
+    def warmup_runs(self) -> int:
+        return self.get_config("startup.warmup_runs", 1)
+
+    @property
+    def startup_max_workers(self) -> int:
+        return self.get_config("startup.max_workers", 3)
+
+    @property
+    def result_store_directory(self) -> str:
+        return self.get_config("result_store.directory", "output/detect")
+
+    @property
+    def result_store_segment_max_bytes(self) -> int:
+        return self.get_config("result_store.segment_max_bytes", 4 * 1024 * 1024)
+
+    @property
+    def result_store_total_budget_bytes(self) -> int:
+        return self.get_config("result_store.total_budget_bytes", 256 * 1024 * 1024)
+
+    @property
+    def result_store_fsync(self) -> bool:
+        return self.get_config("result_store.fsync", False)
+
+    @property
+    def preview_enabled(self) -> bool:
+        return self.get_config("preview.enabled", False)
+
+    @property
+    def preview_host(self) -> str:
+        return self.get_config("preview.host", "0.0.0.0")
+
+    @property
+    def preview_port(self) -> int:
+        return self.get_config("preview.port", 8080)
+
+    @property
+    def preview_max_fps(self) -> float:
+        return self.get_config("preview.max_fps", 5)
+
+    @property
+    def preview_max_width(self) -> int:
+        return self.get_config("preview.max_width", 640)
+
+    @property
+    def preview_jpeg_quality(self) -> int:
+        return self.get_config("preview.jpeg_quality", 70)
+
+    @property
+    def class_statistics_memory_budget_bytes(self) -> Union[None, int]:
+        return self.get_config("class_statistics.memory_budget_bytes", None)
+
+    @property
+    def class_statistics_policy(self) -> str:
+        return self.get_config("class_statistics.policy", "lru")
+
+    @property
+    def class_statistics_pinned(self) -> List[str]:
+        return self.get_config("class_statistics.pinned", [])
+
+    @property
+    def allocation_profiling_enabled(self) -> bool:
+        return self.get_config("profiling.allocations.enabled", False)
+
+    @property
+    def allocation_snapshot_interval(self) -> int:
+        return self.get_config("profiling.allocations.snapshot_interval", 500)
+
+    @property
+    def allocation_snapshot_dir(self) -> str:
+        return self.get_config("profiling.allocations.snapshot_dir", "output/profiling")
+
+    @property
+    def allocation_top_n(self) -> int:
+        return self.get_config("profiling.allocations.top_n", 10)
+
+    @property
+    def allocation_warmup_frames(self) -> int:
+        return self.get_config("profiling.allocations.warmup_frames", 20)
+
+    @property
+    def allocation_budget(self) -> Dict[str, int]:
+        return self.get_config(
+            "profiling.allocations.retained_bytes_per_frame", {"total": 4096}
+        )
+
+    @property
+    def tracing_enabled(self) -> bool:
+        return self.get_config("tracing.enabled", False)
+
+    @property
+    def tracing_sample_rate(self) -> float:
+        return self.get_config("tracing.sample_rate", 0.01)
+
+    @property
+    def tracing_output_path(self) -> str:
+        return self.get_config("tracing.output_path", "output/trace.json")
+
+    @property
+    def scheduling_enabled(self) -> bool:
+        return self.get_config("scheduling.enabled", False)
+
+    @property
+    def scheduling_layout(self) -> str:
+        return self.get_config("scheduling.layout", "unpinned")
+
+    @property
+    def scheduling_layouts(self) -> Dict[str, Any]:
+        return self.get_config("scheduling.layouts", {"unpinned": {"roles": {}}})
+
+    @property
+    def anomaly_scorer_default(self) -> str:
+        return self.get_config("anomaly_scorer.default", "mahalanobis")
+
+    @property
+    def anomaly_scorer_classes(self) -> Dict[str, str]:
+        return self.get_config("anomaly_scorer.classes", {})
+
+    @property
+    def memory_bank_dir(self) -> str:
+        return self.get_config("anomaly_scorer.memory_bank.directory", "memory_bank")
+
+    @property
+    def memory_bank_k(self) -> int:
+        return self.get_config("anomaly_scorer.memory_bank.k", 1)
+
+    @property
+    def memory_bank_block_size(self) -> int:
+        return self.get_config("anomaly_scorer.memory_bank.block_size", 4096)
+
+    @property
+    def memory_bank_memory_budget_bytes(self) -> Union[None, int]:
+        return self.get_config("anomaly_scorer.memory_bank.memory_budget_bytes", None)
+
+    @property
+    def memory_bank_ivf_n_lists(self) -> Union[None, int]:
+        return self.get_config("anomaly_scorer.memory_bank.ivf.n_lists", None)
+
+    @property
+    def memory_bank_ivf_n_probe(self) -> int:
+        return self.get_config("anomaly_scorer.memory_bank.ivf.n_probe", 4)
+
+    @property
+    def hot_reload_enabled(self) -> bool:
+        return self.get_config("hot_reload.enabled", False)
+
+    @property
+    def hot_reload_poll_interval(self) -> float:
+        return self.get_config("hot_reload.poll_interval_seconds", 2.0)
+
+    @property
+    def hot_reload_probation_frames(self) -> int:
+        return self.get_config("hot_reload.probation_frames", 30)
+
+    @property
+    def hot_reload_validation_classes(self) -> int:
+        return self.get_config("hot_reload.validation_classes", 3)
+
+    @property
+    def event_clips_enabled(self) -> bool:
+        return self.get_config("event_clips.enabled", True)
+
+    @property
+    def event_clips_annotated(self) -> bool:
+        return self.get_config("event_clips.annotated", False)
+
+    @property
+    def event_clip_jpeg_quality(self) -> int:
+        return self.get_config("event_clips.jpeg_quality", 80)
+
+    @property
+    def event_clip_memory_budget_bytes(self) -> int:
+        return self.get_config("event_clips.memory_budget_bytes", 32 * 1024 * 1024)
+
+    @property
+    def event_clip_pre_roll_seconds(self) -> float:
+        return self.get_config("event_clips.pre_roll_seconds", 3.0)
+
+    @property
+    def event_clip_post_roll_seconds(self) -> float:
+        return self.get_config("event_clips.post_roll_seconds", 3.0)
+
+    @property
+    def event_clip_min_trigger_frames(self) -> int:
+        return self.get_config("event_clips.min_trigger_frames", 1)
+
+    @property
+    def event_clip_cooldown_seconds(self) -> float:
+        return self.get_config("event_clips.cooldown_seconds", 0.0)
+
+    @property
+    def event_clip_default_thresholds(self) -> Dict[str, Any]:
+        return self.get_config("event_clips.thresholds.default", {})
+
+    @property
+    def event_clip_class_thresholds(self) -> Dict[str, Dict[str, Any]]:
+        return self.get_config("event_clips.thresholds.classes", {})
+
+    @property
+    def recording_enabled(self) -> bool:
+        return self.get_config("recording.enabled", False)
+
+    @property
+    def recording_directory(self) -> str:
+        return self.get_config("recording.directory", "output/recordings")
+
+    @property
+    def recording_chunk_records(self) -> int:
+        return self.get_config("recording.chunk_records", 256)
+
+    @property
+    def recording_feature_dtype(self) -> str:
+        return self.get_config("recording.feature_dtype", "float16")
+
+    @property
+    def recording_store_crops(self) -> bool:
+        return self.get_config("recording.store_crops", False)
+
+    @property
+    def recording_crop_jpeg_quality(self) -> int:
+        return self.get_config("recording.crop_jpeg_quality", 90)
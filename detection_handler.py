@@ -1,26 +1,71 @@
-import json
+import itertools
 import os
+import time
 from datetime import datetime
 
 import cv2
 import numpy as np
-import requests
 
-from calculator.mahalanobis_calculator import MeanInvCovDataLoader, VectorMetrics
-from config_manager .config import ApiConfigs
+from calculator.mahalanobis_calculator import ClassDataCache
+from calculator.scorer_router import build_metric
+from config_manager .config import ApiConfigs, SystemConfigs, TFliteConfig
+from detector.admission import SCORED, TOO_SMALL, CropAdmission
 from detector.anomaly import Anomaly
 from logger.custom_logger import custom_logger
+from profiling.stages import stage
+from profiling.tracing import tracer
+from sender.result_sender import Sender
+from storage.event_clips import EventClipRecorder
+from storage.feature_archive import FeatureRecorder
+from storage.result_store import ResultStore
+
+
+def make_frame_name(ts, frame_id):
+    # 同一秒内のフレームが上書きされないようフレーム ID をファイル名に含める
+    return f"{datetime.fromtimestamp(ts).strftime('%Y%m%d_%H%M%S')}_{frame_id:012d}"
+
+
+def _group_by_frame(late_results):
+    """
+    持ち越し分の結果を元のフレームごとにまとめ、(frame_id, ts, 結果のリスト) を返す
+    """
+    grouped = []
+    for frame_id, group in itertools.groupby(
+        late_results, key=lambda result: result["frame_id"]
+    ):
+        results = list(group)
+        grouped.append((frame_id, results[0]["ts"], results))
+    return grouped
+
+
+# 異常検知を行わなかった領域の結果
+_UNSCORED = {
+    "anomaly_distances": 0,
+    "angle_diff": 0,
+    "early_exit": False,
+    "layers_used": 0,
+}
 
 
 class Drawer:
     def __init__(
-        self, enable_drawing: bool = True, detect_score_threshold: float = 0.2
+        self,
+        enable_drawing: bool = True,
+        detect_score_threshold: float = 0.2,
+        should_draw=None,
     ):
         self.enable_drawing = enable_drawing
         self.detect_score_threshold = detect_score_threshold
+        # プレビュー視聴者がいるときだけ描画するなど、描画要否を動的に判定する callable
+        self.should_draw = should_draw
 
-    def draw(self, frame, cls_id, cls_label, box, score, distances, angle_diff):
+    def is_active(self):
         if not self.enable_drawing:
+            return False
+        return self.should_draw is None or self.should_draw()
+
+    def draw(self, frame, cls_id, cls_label, box, score, distances, angle_diff):
+        if not self.is_active():
             return
         try:
             if score <= 0.1:
@@ -72,63 +117,86 @@ class Drawer:
             custom_logger.exception("error occurred while drawing the result")
 
 
-class Sender:
-    def __init__(self, server_url, headers=None, auth=None, timeout=10):
-        self.server_url = server_url
-        self.headers = headers or {"Content-Type": "application/json"}
-        self.auth = auth
-        self.timeout = timeout
-        custom_logger.info("sender initialisation is complete")
-
-    def send(self, data):
-        try:
-            response = requests.post(
-                self.server_url,
-                json=data,
-                headers=self.headers,
-                auth=self.auth,
-                timeout=self.timeout,
-            )
-            response.raise_for_status()
-            custom_logger.info(
-                f"data transmission was successful status code: {response.status_code}"
-            )
-            return True
-        except Exception:
-            custom_logger.exception("error occurred while sending data")
-            return False
-
-
 class ObjectDetectHandler:
     def __init__(
         self,
         api_config: ApiConfigs,
         detect_score_threshold,
         enable_drawing: bool,
-        mean_inv_cov_path,
+        mean_inv_cov_path=None,
+        anomaly=None,
+        metric=None,
+        result_store=None,
+        should_draw=None,
+        output_root="output",
+        recorder=None,
+        save_frames=True,
+        scheduling_policy=None,
     ):
-        self.drawer = Drawer(enable_drawing, detect_score_threshold)
+        system_config = SystemConfigs()
+        self.drawer = Drawer(enable_drawing, detect_score_threshold, should_draw)
         self.sender = Sender(
             server_url=api_config.url,
             headers=api_config.headers,
             auth=api_config.auth,
             timeout=api_config.timeout,
+            wire_format=api_config.wire_format,
+            compression=api_config.compression,
+            delta_boxes=api_config.delta_boxes,
+            queue_size=api_config.queue_size,
+            scheduling_policy=scheduling_policy,
         )
-        self.sender = Sender(
-            server_url=api_config.url,
-            headers=api_config.headers,
-            auth=api_config.auth,
-            timeout=api_config.timeout,
+        # StartupOrchestrator で並列に構築済みのものがあればそれを使う
+        self.anomaly = anomaly if anomaly is not None else Anomaly()
+        if metric is None:
+            metric = build_metric(system_config, mean_inv_cov_path)
+        self.metric = metric
+        self.anomaly_config = TFliteConfig(section_name="anomaly")
+        self.admission = CropAdmission(
+            min_score=self.anomaly_config.admission_min_score,
+            min_area=self.anomaly_config.admission_min_area,
+            min_aspect_ratio=self.anomaly_config.admission_min_aspect_ratio,
+            max_aspect_ratio=self.anomaly_config.admission_max_aspect_ratio,
+            iou_threshold=self.anomaly_config.admission_iou_threshold,
+            deadline_ms=self.anomaly_config.admission_deadline_ms,
+            max_deferred=self.anomaly_config.admission_max_deferred,
+            max_defer_frames=self.anomaly_config.admission_max_defer_frames,
         )
-        self.anomaly = Anomaly()
-        data_loader = MeanInvCovDataLoader(mean_inv_cov_path)
-        mean_inv_cov_dicts = data_loader.load_all_class_data()
-        self.metric = VectorMetrics(mean_inv_cov_dicts)
+
+        # 既定では全フレームを保存せず、異常イベントの前後だけをクリップとして残す。
+        # save_frames=False の場合、フレームの保存は呼び出し側 (MultiProcessPipeline) が行う
+        self.save_frames = save_frames
+        self.annotate_clips = system_config.event_clips_annotated
+        self.event_clips = None
+        self.output_frame = None
+        self.output_images = None
+        if save_frames and system_config.event_clips_enabled:
+            self.event_clips = EventClipRecorder.from_config(
+                system_config,
+                os.path.join(output_root, "events"),
+                scheduling_policy=scheduling_policy,
+            )
+        elif save_frames:
+            self.output_frame = self.create_output_directory(output_root, name="frames")
+            self.output_images = self.create_output_directory(output_root, name="images")
+        if result_store is None:
+            result_store = ResultStore(
+                directory=system_config.result_store_directory,
+                segment_max_bytes=system_config.result_store_segment_max_bytes,
+                total_budget_bytes=system_config.result_store_total_budget_bytes,
+                fsync=system_config.result_store_fsync,
+            )
+        self.result_store = result_store
+        if recorder is None and system_config.recording_enabled:
+            recorder = FeatureRecorder.from_config(
+                system_config, scheduling_policy=scheduling_policy
+            )
+        self.recorder = recorder
 
         custom_logger.debug("DetectionHandler initialization is complete")
 
-    def save_frame(self, frame, output_directory, timestamp):
-        file_path = os.path.join(output_directory, f"frame_{timestamp}.png")
+    def save_frame(self, frame, output_directory, frame_name):
+        file_path = os.path.join(output_directory, f"frame_{frame_name}.png")
         cv2.imwrite(file_path, frame)
         custom_logger.info(f"Frame saved: {file_path}")
 
@@ -147,40 +215,147 @@ class ObjectDetectHandler:
             return None
 
     def _get_distances(self, cls_label, sample_feats):
+        """
+        戻り値は (距離, 途中の層で打ち切ったか, 計算した層の数)
+        """
         distances = 0
+        exited_early = False
+        num_layers = 0
         if sample_feats is not None:
-            distances = self.metric.distances(cls_label, sample_feats["layer_outputs"])
+            num_layers = len(sample_feats["layer_indices"])
+            if self.anomaly_config.cascade_enabled:
+                distances, exited_early, num_layers = self.metric.cascade_distances(
+                    cls_label,
+                    sample_feats["layer_outputs"],
+                    threshold=self.anomaly_config.cascade_threshold,
+                    layer_indices=sample_feats["layer_indices"],
+                    margin=self.anomaly_config.cascade_margin,
+                    min_layers=self.anomaly_config.cascade_min_layers,
+                )
+                custom_logger.debug(
+                    f"cascade used {num_layers} layers / early exit {exited_early}"
+                )
+            else:
+                distances = self.metric.distances(
+                    cls_label,
+                    sample_feats["layer_outputs"],
+                    sample_feats["layer_indices"],
+                )
             custom_logger.debug(f"distances is {distances}")
 
-        return distances
+        return distances, exited_early, num_layers
 
     def _get_angle_diff(self, cls_label, sample_feats):
         diff = 0
         if sample_feats is not None:
             diff = self.metric.angle_difference_sum(
-                cls_label, sample_feats["layer_outputs"]
+                cls_label, sample_feats["layer_outputs"], sample_feats["layer_indices"]
             )
             custom_logger.debug(f"angle diff is {diff}")
 
         return diff
 
-    def save_results_to_json(
-        self,
-        frame,
-        output_directory,
-        output_frame,
-        num,
-        class_ids,
-        class_labels,
-        boxes,
-        scores,
-        timestamp,
-    ):
-        file_path = os.path.join(output_directory, f"detect_{timestamp}.json")
+    def _score_crop(self, record, cropped_img, recorded):
+        """
+        特徴量の記録はフレーム全体の異常検知が終わってから行うよう recorded に積む
+        """
+        cls_label = record["class_label"]
+        # 内側の anomaly.* ステージと二重に集計しないようトレースのみ記録する
+        with tracer.span("anomaly.detect", index=record["index"], class_label=cls_label):
+            sample_feats = self.anomaly.detect(cropped_img)
+
+        if self.recorder is not None:
+            recorded.append((record, sample_feats, cropped_img))
+
+        with stage("metrics"):
+            distances, early_exit, layers_used = self._get_distances(
+                cls_label, sample_feats
+            )
+            angle_diff = self._get_angle_diff(cls_label, sample_feats)
+        self.admission.record(SCORED)
+        # カスケードで打ち切った距離は全層の和ではないため、使った層の数と合わせて残す
+        return {
+            "anomaly_distances": float(distances),
+            "angle_diff": float(angle_diff),
+            "early_exit": bool(early_exit),
+            "layers_used": int(layers_used),
+        }
+
+    def _score_deferred(self, frame_id, deadline, recorded):
+        # 今フレームの処理後に締め切りまで余裕があれば、持ち越した領域を古い順に処理する
+        late_results = []
+        while not deadline.expired():
+            entry = self.admission.pop_deferred(frame_id)
+            if entry is None:
+                break
+            # 記録や結果の突き合わせに使えるよう、持ち越し元のフレームの情報をそのまま残す。
+            # 送信やクリップでも使えるよう、ボックスは今フレームの結果と同じ形にする
+            x1, y1, x2, y2 = entry.record["box"]
+            late_results.append(
+                dict(
+                    entry.record,
+                    box={"x1": x1, "y1": y1, "x2": x2, "y2": y2},
+                    **self._score_crop(entry.record, entry.crop, recorded),
+                    admission=SCORED,
+                    late=True,
+                )
+            )
+        return late_results
 
-        json_result = []
+    def _score_frame(
+        self, frame, num, class_ids, class_labels, boxes, scores, ts, frame_id
+    ):
+        """
+        モデルを使う処理だけを行い、(結果のリスト, 持ち越し分の結果, 記録する特徴量) を返す。
+        例外を送出した場合は領域の選別の集計と持ち越しを呼び出し前の状態に戻すので、
+        ロールバックしたモデルで同じフレームを処理し直せる
+        """
         height, width = frame.shape[:2]
+        checkpoint = self.admission.checkpoint()
+        try:
+            deadline = self.admission.start_frame()
 
+            with stage("admission"):
+                order, statuses = self.admission.plan(
+                    boxes[:num], scores[:num], class_ids[:num], width, height
+                )
+
+            # 優先度の高い順に異常検知し、締め切りを過ぎた残りは持ち越すか破棄する
+            anomaly_results = {}
+            recorded = []
+            for i in order:
+                cls_label = class_labels[i]
+                x1, y1 = boxes[i][1], boxes[i][0]
+                x2, y2 = boxes[i][3], boxes[i][2]
+                with stage("clip"):
+                    cropped_img = self._clip_image_by_box(
+                        frame, (x1, y1, x2, y2), width, height
+                    )
+                if cropped_img is None or cropped_img.size == 0:
+                    statuses[i] = TOO_SMALL
+                    self.admission.record(TOO_SMALL)
+                    continue
+                record = {
+                    "frame_id": frame_id,
+                    "ts": ts,
+                    "index": i,
+                    "class_id": int(class_ids[i]),
+                    "class_label": cls_label,
+                    "score": float(scores[i]),
+                    "box": [int(x1), int(y1), int(x2), int(y2)],
+                }
+                if deadline.expired():
+                    statuses[i] = self.admission.defer(record, cropped_img)
+                    continue
+                anomaly_results[i] = self._score_crop(record, cropped_img, recorded)
+                statuses[i] = SCORED
+
+            late_results = self._score_deferred(frame_id, deadline, recorded)
+        except Exception:
+            self.admission.restore(checkpoint)
+            raise
+
+        json_result = []
         for i in range(num):
             score = scores[i]
             cls_id = class_ids[i]
@@ -188,18 +363,6 @@ class ObjectDetectHandler:
             x1, y1 = boxes[i][1], boxes[i][0]
             x2, y2 = boxes[i][3], boxes[i][2]
 
-            distances = 0
-            angle_diff = 0
-            if score >= 0.1:
-                cropped_img = self._clip_image_by_box(
-                    frame, (x1, y1, x2, y2), width, height
-                )
-                if cropped_img is not None:
-                    sample_feats = self.anomaly.detect(cropped_img)
-
-                    distances = self._get_distances(cls_label, sample_feats)
-                    angle_diff = self._get_angle_diff(cls_label, sample_feats)
-
             result = {
                 "class_id": int(cls_id),
                 "class_label": cls_label,
@@ -210,44 +373,146 @@ class ObjectDetectHandler:
                     "x2": int(x2),
                     "y2": int(y2),
                 },
-                "anomaly_distances": distances,
-                "angle_diff": angle_diff,
+                **anomaly_results.get(i, _UNSCORED),
+                "admission": statuses[i],
             }
-            self.drawer.draw(
-                frame, cls_id, cls_label, (x1, y1, x2, y2), score, distances, angle_diff
-            )
             json_result.append(result)
+        return json_result, late_results, recorded
+
+    def save_results_to_json(
+        self,
+        frame,
+        output_frame,
+        num,
+        class_ids,
+        class_labels,
+        boxes,
+        scores,
+        ts,
+        frame_name,
+        frame_id=None,
+    ):
+        if frame_id is None:
+            frame_id = self.result_store.peek_next_frame_id()
+        json_result, late_results, recorded = self._score_frame(
+            frame, num, class_ids, class_labels, boxes, scores, ts, frame_id
+        )
 
-        self.save_frame(frame, output_frame, timestamp)
+        # ここから先の副作用はフレームの異常検知がすべて成功してから行う
+        if self.recorder is not None:
+            # 統計量や手法を変えたときに検出からやり直さず再計算できるよう特徴量を残す
+            with stage("record"):
+                for record, sample_feats, cropped_img in recorded:
+                    self.recorder.add(record, sample_feats, cropped_img)
+
+        if self.save_frames and self.event_clips is None:
+            with stage("save_image"):
+                self.save_frame(frame, self.output_images, frame_name)
+
+        # 注釈付きクリップの設定がなければ描画前のフレームを渡し、
+        # クリップの内容がプレビュー視聴者の有無で変わらないようにする
+        annotate_clip = self.annotate_clips and self.drawer.is_active()
+        if self.event_clips is not None and not annotate_clip:
+            with stage("save_frame"):
+                self.event_clips.add(
+                    frame, frame_id, ts, frame_name, json_result, late=late_results
+                )
 
-        with open(file_path, "w") as f:
-            json.dump(json_result, f, indent=2)
+        for result in json_result:
+            box = result["box"]
+            with stage("draw"):
+                self.drawer.draw(
+                    frame,
+                    result["class_id"],
+                    result["class_label"],
+                    (box["x1"], box["y1"], box["x2"], box["y2"]),
+                    result["score"],
+                    result["anomaly_distances"],
+                    result["angle_diff"],
+                )
+
+        with stage("save_frame"):
+            if self.event_clips is not None and annotate_clip:
+                self.event_clips.add(
+                    frame, frame_id, ts, frame_name, json_result, late=late_results
+                )
+            elif self.event_clips is None and self.save_frames:
+                self.save_frame(frame, output_frame, frame_name)
+
+        with stage("result_store"):
+            frame_id = self.result_store.append(
+                json_result, ts=ts, late=late_results, frame_id=frame_id
+            )
+        return frame_id, json_result, late_results
 
     def create_output_directory(self, directory="output", name="dist"):
         output_directory = os.path.join(directory, name)
-        if not os.path.exists(output_directory):
-            os.makedirs(output_directory)
+        os.makedirs(output_directory, exist_ok=True)
         return output_directory
 
     # TODO 処理を詰め込みすぎなので分離する。クラス設計の見直し
-    def process_results(self, frame, num, class_ids, class_labels, boxes, scores):
-        output_frame = self.create_output_directory(name="frames")
-        output_detect = self.create_output_directory(name="detect")
-        output_images = self.create_output_directory(name="images")
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        self.save_frame(frame, output_images, timestamp)
-        self.save_results_to_json(
+    def process_results(
+        self,
+        frame,
+        num,
+        class_ids,
+        class_labels,
+        boxes,
+        scores,
+        frame_id=None,
+        ts=None,
+    ):
+        """
+        frame_id と ts を省略すると結果ストアの次の ID と現在時刻を使う。
+        戻り値は (frame_id, 結果のリスト, 以前のフレームから持ち越して処理した結果のリスト)
+        """
+        if ts is None:
+            ts = time.time()
+        # FrameBus の共有フレームは読み取り専用なので、描画するときだけ複製する
+        if self.drawer.is_active() and not frame.flags.writeable:
+            frame = frame.copy()
+        if frame_id is None:
+            frame_id = self.result_store.peek_next_frame_id()
+        frame_name = make_frame_name(ts, frame_id)
+
+        frame_id, json_result, late_results = self.save_results_to_json(
             frame,
-            output_detect,
-            output_frame,
+            self.output_frame,
             num,
             class_ids,
             class_labels,
             boxes,
             scores,
-            timestamp,
+            ts,
+            frame_name,
+            frame_id,
         )
 
-        # self.sender.send(parsed_results)
+        # 送信先が設定されていなければ送らない。送信自体は Sender のスレッドで行う
+        if self.sender.server_url:
+            with stage("send"):
+                self.sender.enqueue(frame_id, ts, json_result)
+                # 持ち越し分は元のフレームの ID と時刻で、遅れて届いたことがわかるように送る
+                for late_frame_id, late_ts, results in _group_by_frame(late_results):
+                    self.sender.enqueue(late_frame_id, late_ts, results, late=True)
+        return frame_id, json_result, late_results
+
+    def swap_models(self, anomaly, metric):
+        """
+        HotReloader で構築した異常検知モデルと統計データに切り替える。フレームの合間に呼ぶこと
+        """
+        self.anomaly = anomaly
+        self.metric = metric
+
+    def close(self):
+        self.sender.close(timeout=self.sender.timeout)
+        self.result_store.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.event_clips is not None:
+            self.event_clips.close()
+        custom_logger.info(f"crop admission stats: {self.admission.stats()}")
+        if isinstance(self.metric.class_data_dict, ClassDataCache):
+            custom_logger.info(
+                f"class statistics cache stats: {self.metric.class_data_dict.stats()}"
+            )
@@ -0,0 +1,181 @@
+import time
+from collections import deque
+
+import numpy as np
+
+from detector.tiling import non_max_suppression
+from logger.custom_logger import custom_logger
+
+SCORED = "scored"
+LOW_SCORE = "low_score"
+TOO_SMALL = "too_small"
+BAD_ASPECT = "bad_aspect"
+DUPLICATE = "duplicate"
+DEFERRED = "deferred"
+SKIPPED = "skipped"
+
+
+class FrameDeadline:
+    def __init__(self, budget_ms=None):
+        self._deadline = (
+            None if budget_ms is None else time.perf_counter() + budget_ms / 1000.0
+        )
+
+    def expired(self):
+        return self._deadline is not None and time.perf_counter() >= self._deadline
+
+
+class DeferredCrop:
+    """
+    record は frame_id / ts / index / class_id / class_label / score / box を持つ dict
+    """
+
+    __slots__ = ("frame_id", "index", "record", "crop")
+
+    def __init__(self, record, crop):
+        self.frame_id = record["frame_id"]
+        self.index = record["index"]
+        self.record = record
+        self.crop = crop
+
+
+class CropAdmission:
+    """
+    異常検知にかける切り出し領域を選別し、優先度 (スコア x 面積) の高い順に並べる
+
+    スコア・面積・縦横比で足切りし、同じクラスで大きく重なる領域は 1 つにまとめる。
+    フレームの締め切りを過ぎて処理できなかった領域は max_deferred 件まで後続フレームへ持ち越し、
+    max_defer_frames フレーム以内に処理できなければ破棄する
+    """
+
+    def __init__(
+        self,
+        min_score=0.1,
+        min_area=0,
+        min_aspect_ratio=None,
+        max_aspect_ratio=None,
+        iou_threshold=None,
+        deadline_ms=None,
+        max_deferred=0,
+        max_defer_frames=5,
+    ):
+        self.min_score = min_score
+        self.min_area = min_area
+        self.min_aspect_ratio = min_aspect_ratio
+        self.max_aspect_ratio = max_aspect_ratio
+        self.iou_threshold = iou_threshold
+        self.deadline_ms = deadline_ms
+        self.max_deferred = max_deferred
+        self.max_defer_frames = max_defer_frames
+        self._deferred = deque()
+        self._counts = {}
+
+    def record(self, status, n=1):
+        self._counts[status] = self._counts.get(status, 0) + n
+
+    def plan(self, boxes, scores, class_ids, frame_width, frame_height):
+        """
+        boxes ([ymin, xmin, ymax, xmax]) を選別し、(処理順のインデックス, 各領域の状態) を返す
+
+        処理対象の状態は None で、処理後に呼び出し側で SCORED などに更新する
+        """
+        num = len(scores)
+        statuses = [None] * num
+        if num == 0:
+            return [], statuses
+
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(num, 4)
+        scores = np.asarray(scores, dtype=np.float32)
+        class_ids = np.asarray(class_ids)
+        y1 = np.clip(boxes[:, 0], 0, frame_height)
+        x1 = np.clip(boxes[:, 1], 0, frame_width)
+        y2 = np.clip(boxes[:, 2], 0, frame_height)
+        x2 = np.clip(boxes[:, 3], 0, frame_width)
+        widths = np.maximum(0.0, x2 - x1)
+        heights = np.maximum(0.0, y2 - y1)
+        areas = widths * heights
+        aspects = widths / np.maximum(heights, 1e-6)
+
+        low_score = scores < self.min_score
+        too_small = ~low_score & ((areas <= 0) | (areas < self.min_area))
+        bad_aspect = np.zeros(num, dtype=bool)
+        if self.min_aspect_ratio is not None:
+            bad_aspect |= aspects < self.min_aspect_ratio
+        if self.max_aspect_ratio is not None:
+            bad_aspect |= aspects > self.max_aspect_ratio
+        bad_aspect &= ~low_score & ~too_small
+
+        for mask, status in (
+            (low_score, LOW_SCORE),
+            (too_small, TOO_SMALL),
+            (bad_aspect, BAD_ASPECT),
+        ):
+            for index in np.flatnonzero(mask):
+                statuses[index] = status
+
+        candidates = np.flatnonzero(~(low_score | too_small | bad_aspect))
+        if self.iou_threshold is not None and len(candidates) > 1:
+            keep = candidates[
+                non_max_suppression(
+                    boxes[candidates],
+                    scores[candidates],
+                    class_ids[candidates],
+                    self.iou_threshold,
+                )
+            ]
+            for index in np.setdiff1d(candidates, keep):
+                statuses[index] = DUPLICATE
+            candidates = keep
+
+        priorities = scores[candidates] * areas[candidates]
+        order = candidates[np.argsort(-priorities, kind="stable")]
+        for status in statuses:
+            if status is not None:
+                self.record(status)
+        return [int(index) for index in order], statuses
+
+    def start_frame(self):
+        return FrameDeadline(self.deadline_ms)
+
+    def defer(self, record, crop):
+        """
+        締め切りに間に合わなかった領域を持ち越す。持ち越せなければ SKIPPED を返す
+        """
+        if self.max_deferred <= 0 or crop is None:
+            self.record(SKIPPED)
+            return SKIPPED
+        if len(self._deferred) >= self.max_deferred:
+            dropped = self._deferred.popleft()
+            self.record(SKIPPED)
+            custom_logger.debug(
+                f"deferred crop {dropped.frame_id}/{dropped.index} dropped, queue full"
+            )
+        # 元フレームのバッファは再利用されるため切り出し領域は複製して保持する
+        self._deferred.append(DeferredCrop(record, crop.copy()))
+        self.record(DEFERRED)
+        return DEFERRED
+
+    def pop_deferred(self, current_frame_id):
+        """
+        持ち越した領域を古い順に 1 件返す。期限切れのものは破棄する
+        """
+        while self._deferred:
+            entry = self._deferred.popleft()
+            if current_frame_id - entry.frame_id <= self.max_defer_frames:
+                return entry
+            self.record(SKIPPED)
+        return None
+
+    def checkpoint(self):
+        """
+        フレームを処理し直すときに restore() で戻すための集計と持ち越しの状態を返す
+        """
+        return dict(self._counts), list(self._deferred)
+
+    def restore(self, checkpoint):
+        counts, deferred = checkpoint
+        self._counts = dict(counts)
+        self._deferred = deque(deferred)
+
+    def stats(self):
+        return dict(self._counts, pending=len(self._deferred))
@@ -12,21 +12,27 @@ except ImportError:
 
 from config_manager.config import TFliteConfig
 from logger.custom_logger import custom_logger, log_debug_method_execution
+from profiling.stages import stage
 
 
 class AnomalyInferenceResult:
     def __init__(self):
         self.layer_outputs = []
+        self.layer_indices = []
 
-    def set_results(self, all_layer_outputs):
+    def set_results(self, all_layer_outputs, layer_indices):
         self.layer_outputs = all_layer_outputs
+        self.layer_indices = layer_indices
 
     def has_results(self):
         return self.layer_outputs is not None and len(self.layer_outputs) > 0
 
     def get_results(self):
         if self.has_results():
-            return {"layer_outputs": self.layer_outputs}
+            return {
+                "layer_outputs": self.layer_outputs,
+                "layer_indices": self.layer_indices,
+            }
         else:
             return None
 
@@ -46,35 +52,68 @@ class TFLiteClassifcation:
             self.input_height = self.input_details[0]["shape"][1]
             self.input_width = self.input_details[0]["shape"][2]
             self.input_type = self.input_details[0]["dtype"]
+            self.layer_indices = self._select_layer_indices(self._config.output_layers)
+            # True の間は推論の失敗を None で握りつぶさず送出する (差し替え直後の検証用)
+            self.strict = False
 
             custom_logger.info(
                 f"EfficientNet model loaded successfully / "
                 f"model name {self._config.model} / "
                 f"height {self.input_height} / "
                 f"input_width {self.input_width} / "
-                f"input_type {self.input_type}"
+                f"input_type {self.input_type} / "
+                f"output_layers {self.layer_indices}"
             )
 
         except Exception as e:
             custom_logger.exception("Error loading EfficientNet model")
             raise e
 
+    def _select_layer_indices(self, output_layers):
+        num_outputs = len(self.output_details)
+        if output_layers is None:
+            return list(range(num_outputs))
+
+        layer_indices = sorted(set(int(i) for i in output_layers))
+        invalid = [i for i in layer_indices if i < 0 or i >= num_outputs]
+        if invalid or not layer_indices:
+            raise ValueError(
+                f"output_layers {output_layers} must be a non-empty subset of "
+                f"0..{num_outputs - 1}"
+            )
+        return layer_indices
+
+    def warm_up(self, runs=1):
+        """
+        初回 invoke の遅延をライブフレームの前に済ませるためダミー入力で推論する
+        """
+        dummy_input = np.zeros(self.input_details[0]["shape"], dtype=self.input_type)
+        for _ in range(runs):
+            self.interpreter.set_tensor(self.input_details[0]["index"], dummy_input)
+            self.interpreter.invoke()
+        custom_logger.info(f"EfficientNet model warm-up finished / runs {runs}")
+
     @log_debug_method_execution()
     def run_inference(self, input_data):
         try:
-            all_layer_outputs = [[] for _ in range(9)]
+            all_layer_outputs = [[] for _ in self.layer_indices]
 
             self.interpreter.set_tensor(self.input_details[0]["index"], input_data)
             self.interpreter.invoke()
 
-            for i, output_detail in enumerate(self.output_details):
+            for i, layer_index in enumerate(self.layer_indices):
+                output_detail = self.output_details[layer_index]
                 output_data = self.interpreter.get_tensor(output_detail["index"])
                 all_layer_outputs[i].append(output_data.squeeze())
+                if self.strict and not np.all(np.isfinite(output_data)):
+                    raise ValueError(f"layer {layer_index} returned non-finite values")
 
             return all_layer_outputs
 
         except Exception:
             custom_logger.exception("An error occurred during EfficientNet inference")
+            if self.strict:
+                raise
             return None
 
 
@@ -88,9 +127,11 @@ class Anomaly:
 
     def detect(self, frame):
         result = AnomalyInferenceResult()
-        input_data = self.preprocessor.process(frame, is_normalizing=False)
+        with stage("anomaly.preprocess"):
+            input_data = self.preprocessor.process(frame, is_normalizing=False)
 
-        all_layer_outputs = self.model.run_inference(input_data)
-        result.set_results(all_layer_outputs)
+        with stage("anomaly.inference"):
+            all_layer_outputs = self.model.run_inference(input_data)
+        result.set_results(all_layer_outputs, self.model.layer_indices)
 
         return result.get_results()
@@ -11,7 +11,9 @@ except ImportError:
     from tensorflow import lite as tflite
 
 from config_manager.config import TFliteConfig
+from detector.tiling import TileGrid, non_max_suppression
 from logger.custom_logger import custom_logger, log_debug_method_execution
+from profiling.stages import stage
 
 
 class DetectInferenceResult:
@@ -73,6 +75,8 @@ class TFLiteDetect:
             self.input_height = self.input_details[0]["shape"][1]
             self.input_width = self.input_details[0]["shape"][2]
             self.input_type = self.input_details[0]["dtype"]
+            # True の間は推論の失敗を None で握りつぶさず送出する (差し替え直後の検証用)
+            self.strict = False
 
             custom_logger.info(
                 f"model loaded successfully / "
@@ -86,6 +90,16 @@ class TFLiteDetect:
             custom_logger.exception("model loaded error")
             raise e
 
+    def warm_up(self, runs=1):
+        """
+        初回 invoke の遅延をライブフレームの前に済ませるためダミー入力で推論する
+        """
+        dummy_input = np.zeros(self.input_details[0]["shape"], dtype=self.input_type)
+        for _ in range(runs):
+            self.interpreter.set_tensor(self.input_details[0]["index"], dummy_input)
+            self.interpreter.invoke()
+        custom_logger.info(f"model warm-up finished / runs {runs}")
+
     @log_debug_method_execution()
     def run_inference(self, input_data, img_width, img_height):
         try:
@@ -100,6 +114,8 @@ class TFLiteDetect:
             boxes = self.interpreter.get_tensor(self.output_details[1]["index"])[0]
             num = self.interpreter.get_tensor(self.output_details[2]["index"])[0]
             class_ids = self.interpreter.get_tensor(self.output_details[3]["index"])[0]
+            if self.strict and not np.all(np.isfinite(scores)):
+                raise ValueError("detector returned non-finite scores")
 
             boxes[:, 0] = (boxes[:, 0] * img_width).astype(int)
             boxes[:, 1] = (boxes[:, 1] * img_height).astype(int)
@@ -115,7 +131,51 @@ class TFLiteDetect:
 
         except Exception:
             custom_logger.exception("an error occurred during inference")
-            return None, None, None
+            if self.strict:
+                raise
+            return None, None, None, None
+
+    def run_tiled_inference(self, preprocessor, frame, regions, min_score):
+        """
+        各領域を推論し、フレーム座標に戻した検出結果を連結して返す
+
+        SSD の後処理オペレータはバッチ 1 固定のため、領域ごとに同じインタプリタで順に推論する
+        """
+        all_class_ids = []
+        all_boxes = []
+        all_scores = []
+        for x1, y1, x2, y2 in regions:
+            tile = frame[y1:y2, x1:x2]
+            input_data = preprocessor.process(tile)
+            if input_data is None:
+                continue
+            num, class_ids, boxes, scores = self.run_inference(
+                input_data, y2 - y1, x2 - x1
+            )
+            if num is None:
+                continue
+
+            keep = scores[:num] >= min_score
+            boxes = boxes[:num][keep]
+            boxes[:, [0, 2]] += y1
+            boxes[:, [1, 3]] += x1
+            all_boxes.append(boxes)
+            all_class_ids.append(class_ids[:num][keep])
+            all_scores.append(scores[:num][keep])
+
+        if not all_boxes:
+            return (
+                0,
+                np.empty((0,), dtype=int),
+                np.empty((0, 4), dtype=int),
+                np.empty((0,), dtype=np.float32),
+            )
+        return (
+            sum(len(b) for b in all_boxes),
+            np.concatenate(all_class_ids),
+            np.concatenate(all_boxes),
+            np.concatenate(all_scores),
+        )
 
 
 class Detector:
@@ -126,22 +186,65 @@ class Detector:
         )
         self.label_map = label_map
 
+        config = self.model._config
+        self.max_results = config.max_results
+        self.nms_iou_threshold = config.nms_iou_threshold
+        self.tile_min_score = config.tile_min_score
+        self.tile_grid = None
+        if config.rois or config.tiling_enabled:
+            self.tile_grid = TileGrid(
+                rois=config.rois,
+                tile_width=config.tile_width if config.tiling_enabled else None,
+                tile_height=config.tile_height if config.tiling_enabled else None,
+                overlap=config.tile_overlap,
+            )
+
         custom_logger.info("detector initialization is complete")
 
+    def _detect_tiled(self, frame):
+        result = DetectInferenceResult()
+        frame_height, frame_width = frame.shape[:2]
+        regions = self.tile_grid.regions(frame_width, frame_height)
+
+        with stage("detector.tiled_inference"):
+            num, class_ids, boxes, scores = self.model.run_tiled_inference(
+                self.preprocessor, frame, regions, self.tile_min_score
+            )
+        with stage("detector.nms"):
+            keep = non_max_suppression(
+                boxes, scores, class_ids, self.nms_iou_threshold
+            )
+        keep = keep[: self.max_results]
+
+        result.set_results(
+            self.label_map, len(keep), class_ids[keep], boxes[keep], scores[keep]
+        )
+        custom_logger.debug(
+            f"tiled detection / regions {len(regions)} / raw {num} / kept {len(keep)}"
+        )
+        return result
+
     def detect(self, frame):
+        if self.tile_grid is not None:
+            return self._detect_tiled(frame)
+
         result = DetectInferenceResult()
         img_width, img_height, _ = frame.shape
-        input_data = self.preprocessor.process(frame)
+        with stage("detector.preprocess"):
+            input_data = self.preprocessor.process(frame)
         if input_data is None:
             custom_logger.warning("preprocessing failed")
             return result
 
-        (
-            num,
-            class_ids,
-            boxes,
-            scores,
-        ) = self.model.run_inference(input_data, img_width, img_height)
+        with stage("detector.inference"):
+            (
+                num,
+                class_ids,
+                boxes,
+                scores,
+            ) = self.model.run_inference(input_data, img_width, img_height)
+        if num is None:
+            return result
 
         result.set_results(self.label_map, num, class_ids, boxes, scores)
 
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+def _tile_starts(start, end, tile_size, step):
+    if end - start <= tile_size:
+        return [start]
+    starts = list(range(start, end - tile_size, step))
+    # 最後のタイルは領域の端に揃えて取りこぼしを防ぐ
+    starts.append(end - tile_size)
+    return starts
+
+
+class TileGrid:
+    """
+    ROI とタイル設定からフレーム上の推論領域 (x1, y1, x2, y2) を生成する
+
+    rois が空の場合はフレーム全体を 1 つの ROI とみなす。
+    tile_width / tile_height が None の場合は ROI をそのまま 1 領域として扱う
+    """
+
+    def __init__(self, rois=None, tile_width=None, tile_height=None, overlap=0.2):
+        if not 0.0 <= overlap < 1.0:
+            raise ValueError(f"overlap must be in [0, 1), got {overlap}")
+        self.rois = [tuple(int(v) for v in roi) for roi in (rois or [])]
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.overlap = overlap
+        self._cache_key = None
+        self._regions = []
+
+    def _clip_roi(self, roi, frame_width, frame_height):
+        x1, y1, x2, y2 = roi
+        x1, x2 = max(0, x1), min(frame_width, x2)
+        y1, y2 = max(0, y1), min(frame_height, y2)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return x1, y1, x2, y2
+
+    def regions(self, frame_width, frame_height):
+        # フレームサイズが変わらない限り領域は同じなので再計算しない
+        if self._cache_key == (frame_width, frame_height):
+            return self._regions
+
+        rois = self.rois or [(0, 0, frame_width, frame_height)]
+        regions = []
+        for roi in rois:
+            roi = self._clip_roi(roi, frame_width, frame_height)
+            if roi is None:
+                continue
+            x1, y1, x2, y2 = roi
+            if self.tile_width is None or self.tile_height is None:
+                regions.append(roi)
+                continue
+
+            tile_width = min(self.tile_width, x2 - x1)
+            tile_height = min(self.tile_height, y2 - y1)
+            step_x = max(1, int(tile_width * (1.0 - self.overlap)))
+            step_y = max(1, int(tile_height * (1.0 - self.overlap)))
+            for ty in _tile_starts(y1, y2, tile_height, step_y):
+                for tx in _tile_starts(x1, x2, tile_width, step_x):
+                    regions.append((tx, ty, tx + tile_width, ty + tile_height))
+
+        self._cache_key = (frame_width, frame_height)
+        self._regions = regions
+        return regions
+
+
+def non_max_suppression(boxes, scores, class_ids, iou_threshold=0.5):
+    """
+    クラスごとの NMS を行い、残すインデックスをスコアの降順で返す
+
+    boxes は [ymin, xmin, ymax, xmax] 形式 (TFLiteDetect.run_inference の出力と同じ)
+    """
+    if len(boxes) == 0:
+        return np.empty((0,), dtype=int)
+
+    boxes = np.asarray(boxes, dtype=np.float32)
+    # クラスごとに座標をずらし、異なるクラス同士が重ならないようにする
+    offsets = np.asarray(class_ids, dtype=np.float32)[:, None] * (boxes.max() + 1.0)
+    shifted = boxes + offsets
+
+    y1, x1, y2, x2 = shifted[:, 0], shifted[:, 1], shifted[:, 2], shifted[:, 3]
+    areas = np.maximum(0.0, x2 - x1) * np.maximum(0.0, y2 - y1)
+
+    # IoU 行列を一度に計算し、貪欲法の各ステップではマスク操作のみ行う
+    inter_w = np.maximum(
+        0.0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :])
+    )
+    inter_h = np.maximum(
+        0.0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :])
+    )
+    inter = inter_w * inter_h
+    union = areas[:, None] + areas[None, :] - inter
+    iou = np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+    order = np.argsort(-np.asarray(scores))
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for index in order:
+        if suppressed[index]:
+            continue
+        keep.append(index)
+        suppressed |= iou[index] > iou_threshold
+    return np.asarray(keep, dtype=int)
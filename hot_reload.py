@@ -0,0 +1,272 @@
+import os
+import threading
+
+import numpy as np
+
+from calculator.mahalanobis_calculator import ClassDataCache
+from config_manager.config import SystemConfigs, TFliteConfig
+from logger.custom_logger import custom_logger
+from startup import StartupOrchestrator
+
+COMPONENTS = ("detector", "anomaly", "metric")
+
+
+def _fingerprint(path):
+    """
+    ファイルは (mtime, size)、ディレクトリは直下のファイルごとの (名前, mtime, size) を返す
+    """
+    try:
+        if os.path.isdir(path):
+            entries = []
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            return tuple(entries)
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+class ModelSet:
+    def __init__(self, detector, anomaly, metric, version=0):
+        self.detector = detector
+        self.anomaly = anomaly
+        self.metric = metric
+        self.version = version
+
+
+class HotReloader:
+    """
+    モデルファイルと統計データのディレクトリを監視し、変更があれば新しい ModelSet を
+    バックグラウンドで構築・ウォームアップ・検証する
+
+    差し替えはキャプチャループがフレームの合間に take_pending() を呼んだときに行う。
+    構築や検証に失敗した場合は現在の ModelSet を使い続け、差し替え後 probation_frames
+    フレーム以内に処理が失敗した場合は rollback() で直前の ModelSet に戻す。
+    この期間は新しいモデルの推論失敗も None ではなく例外として扱う
+    """
+
+    def __init__(
+        self,
+        model_set,
+        label_map,
+        mean_inv_cov_path,
+        system_config=None,
+        scheduling_policy=None,
+        poll_interval=2.0,
+        probation_frames=30,
+        validation_classes=3,
+    ):
+        self.current = model_set
+        self.label_map = label_map
+        self.mean_inv_cov_path = mean_inv_cov_path
+        self.system_config = system_config or SystemConfigs()
+        self.scheduling_policy = scheduling_policy
+        self.poll_interval = poll_interval
+        self.probation_frames = probation_frames
+        self.validation_classes = validation_classes
+
+        self.watched = {
+            "detector": [TFliteConfig(section_name="detector").model],
+            "anomaly": [TFliteConfig(section_name="anomaly").model],
+            "metric": [mean_inv_cov_path, self.system_config.memory_bank_dir],
+        }
+        self._applied = self._snapshot()
+        self._last_seen = self._applied
+        self._failed = None
+
+        self._lock = threading.Lock()
+        self._pending = None
+        self._pending_snapshot = None
+        self._previous = None
+        self._previous_snapshot = None
+        self._probation_left = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(
+        cls,
+        model_set,
+        label_map,
+        mean_inv_cov_path,
+        system_config,
+        scheduling_policy=None,
+    ):
+        return cls(
+            model_set,
+            label_map,
+            mean_inv_cov_path,
+            system_config=system_config,
+            scheduling_policy=scheduling_policy,
+            poll_interval=system_config.hot_reload_poll_interval,
+            probation_frames=system_config.hot_reload_probation_frames,
+            validation_classes=system_config.hot_reload_validation_classes,
+        )
+
+    def _snapshot(self):
+        return {
+            component: tuple(_fingerprint(path) for path in paths)
+            for component, paths in self.watched.items()
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._watch, name="hot-reload", daemon=True
+        )
+        self._thread.start()
+        custom_logger.info(
+            f"hot reload watching {self.watched} every {self.poll_interval} s"
+        )
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self):
+        # 構築スレッドはこのスレッドの nice 値を引き継ぐため、io の設定 (nice 5) は適用しない。
+        # 各モデルは起動時と同じく StartupOrchestrator の pinned(role) の中で構築される
+        while not self._stop_event.wait(self.poll_interval):
+            snapshot = self._snapshot()
+            # コピー途中のファイルを読まないよう、2 回続けて同じ状態になってから読み込む
+            stable = snapshot == self._last_seen
+            self._last_seen = snapshot
+            with self._lock:
+                busy = self._pending is not None
+                applied = self._applied
+            if not stable or busy or snapshot == applied or snapshot == self._failed:
+                continue
+            changed = [c for c in COMPONENTS if snapshot[c] != applied[c]]
+            self._reload(changed, snapshot)
+
+    def _reload(self, changed, snapshot):
+        custom_logger.info(f"hot reload: {changed} changed, building new model set")
+        with self._lock:
+            current = self.current
+        try:
+            built = StartupOrchestrator(
+                label_map=self.label_map,
+                mean_inv_cov_path=self.mean_inv_cov_path,
+                system_config=self.system_config,
+                scheduling_policy=self.scheduling_policy,
+            ).build(changed)
+            model_set = ModelSet(
+                built.get("detector", current.detector),
+                built.get("anomaly", current.anomaly),
+                built.get("metric", current.metric),
+                version=current.version + 1,
+            )
+            self._validate(model_set, changed)
+        except Exception:
+            # 同じファイルで再試行し続けないよう、失敗した状態を覚えておく
+            self._failed = snapshot
+            custom_logger.exception(
+                f"hot reload of {changed} failed, keeping model set {current.version}"
+            )
+            return
+        with self._lock:
+            self._pending = model_set
+            self._pending_snapshot = snapshot
+        custom_logger.info(f"model set {model_set.version} is ready to swap in")
+
+    def _class_ids(self, metric):
+        class_data_dict = metric.class_data_dict
+        if isinstance(class_data_dict, ClassDataCache):
+            return sorted(class_data_dict.data_loader.list_class_ids())
+        return sorted(class_data_dict)
+
+    def _validate(self, model_set, changed):
+        """
+        新しく構築したモデルをダミー入力で推論し、統計データの次元が異常検知モデルの出力と合うことを確かめる
+
+        TFLite のインタプリタはスレッドセーフではないため、使用中のモデルでは推論しない
+        """
+        if "detector" in changed:
+            model_set.detector.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+        if "anomaly" in changed:
+            sample_feats = model_set.anomaly.detect(np.zeros((64, 64, 3), dtype=np.uint8))
+            if sample_feats is None:
+                raise RuntimeError("anomaly model returned no layer outputs")
+            layer_outputs = sample_feats["layer_outputs"]
+        else:
+            model = model_set.anomaly.model
+            layer_outputs = [
+                [np.ones(model.output_details[layer_index]["shape"]).squeeze()]
+                for layer_index in model.layer_indices
+            ]
+        if "anomaly" not in changed and "metric" not in changed:
+            return
+
+        class_ids = self._class_ids(model_set.metric)
+        if not class_ids:
+            raise RuntimeError("no class statistics found")
+        for class_id in class_ids[: self.validation_classes]:
+            model_set.metric.distances(
+                class_id, layer_outputs, model_set.anomaly.model.layer_indices
+            )
+
+    @staticmethod
+    def _set_strict(model_set, previous, strict):
+        # 直前の ModelSet と共有している (差し替えていない) モデルはそのままにする
+        for name in ("detector", "anomaly"):
+            component = getattr(model_set, name)
+            if component is not getattr(previous, name):
+                component.model.strict = strict
+
+    def take_pending(self):
+        """
+        フレームの合間に呼ぶ。新しい ModelSet が用意できていれば現在のものと入れ替えて返す
+        """
+        with self._lock:
+            model_set = self._pending
+            if model_set is None:
+                return None
+            self._pending = None
+            self._previous = self.current
+            self._previous_snapshot = self._applied
+            self.current = model_set
+            self._applied = self._pending_snapshot
+            self._probation_left = self.probation_frames
+            # 推論の失敗で rollback() できるよう、検証期間中は新しいモデルの失敗を例外にする
+            self._set_strict(model_set, self._previous, True)
+        custom_logger.info(
+            f"swapped in model set {model_set.version} "
+            f"(previous {self._previous.version} kept for {self.probation_frames} frames)"
+        )
+        return model_set
+
+    def frame_succeeded(self):
+        if self._probation_left <= 0:
+            return
+        self._probation_left -= 1
+        if self._probation_left == 0:
+            with self._lock:
+                self._set_strict(self.current, self._previous, False)
+                self._previous = None
+                self._previous_snapshot = None
+            custom_logger.info(f"model set {self.current.version} passed probation")
+
+    def rollback(self):
+        """
+        差し替え直後のフレームで処理が失敗した場合に直前の ModelSet に戻して返す。戻せなければ None
+        """
+        with self._lock:
+            if self._probation_left <= 0 or self._previous is None:
+                return None
+            failed = self.current
+            self._set_strict(failed, self._previous, False)
+            self._failed = self._applied
+            self.current = self._previous
+            self._applied = self._previous_snapshot
+            self._previous = None
+            self._previous_snapshot = None
+            self._probation_left = 0
+        custom_logger.error(
+            f"model set {failed.version} failed on live frames, "
+            f"rolled back to {self.current.version}"
+        )
+        return self.current
@@ -1,57 +1,314 @@
 import argparse
+import itertools
 import os
+import signal
+import threading
 
 import cv2
 
-from config_manager.config import ApiConfigs, LabelConfigs, TFliteConfig
+from config_manager.config import (
+    RESULT_API_SECTION,
+    ApiConfigs,
+    LabelConfigs,
+    SystemConfigs,
+    TFliteConfig,
+)
 from detection_handler import ObjectDetectHandler
-from detector.detector import Detector
+from hot_reload import HotReloader, ModelSet
 from logger.custom_logger import custom_logger
+from pipeline.multiprocess import MultiProcessPipeline
+from preview.mjpeg_server import PreviewServer
+from profiling.allocation import AllocationBudget, allocation_profiler
+from profiling.tracing import tracer
+from scheduling.affinity import SchedulingPolicy
 from sensor.vision import Camera
+from startup import StartupOrchestrator
+from storage.feature_archive import FeatureRecorder
 
 
-def main(show_frame=False):
+def install_signal_handlers(stop_event):
+    def _handle_signal(signum, _frame):
+        custom_logger.info(f"received signal {signal.Signals(signum).name}, stopping")
+        stop_event.set()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, _handle_signal)
+
+
+def configure_allocation_profiler(system_config, enabled):
+    allocation_profiler.configure(
+        enabled=enabled or system_config.allocation_profiling_enabled,
+        snapshot_interval=system_config.allocation_snapshot_interval,
+        snapshot_dir=system_config.allocation_snapshot_dir,
+        top_n=system_config.allocation_top_n,
+        warmup_frames=system_config.allocation_warmup_frames,
+    )
+
+
+def report_allocation_profile(system_config):
+    if not allocation_profiler.enabled:
+        return
+    report = allocation_profiler.report()
+    allocation_profiler.stop()
+    violations = AllocationBudget(system_config.allocation_budget).violations(report)
+    for name, (used, budget) in violations.items():
+        custom_logger.warning(
+            f"allocation budget exceeded / stage {name} / "
+            f"{used:.0f} > {budget} bytes per frame"
+        )
+
+
+def configure_tracer(system_config, sample_rate):
+    if sample_rate is None and not system_config.tracing_enabled:
+        return
+    tracer.configure(
+        enabled=True,
+        sample_rate=(
+            system_config.tracing_sample_rate if sample_rate is None else sample_rate
+        ),
+        output_path=system_config.tracing_output_path,
+    )
+
+
+def process_frame(detector, detect_handler, frame, frame_id=None):
+    with tracer.span("detect"):
+        results = detector.detect(frame).get_results()
+
+    if results is not None:
+        with tracer.span("process_results"):
+            detect_handler.process_results(
+                frame=frame,
+                num=results["num"],
+                class_ids=results["ids"],
+                class_labels=results["labels"],
+                boxes=results["boxes"],
+                scores=results["scores"],
+                frame_id=frame_id,
+            )
+    return results
+
+
+def apply_model_set(model_set, detect_handler):
+    detect_handler.swap_models(model_set.anomaly, model_set.metric)
+    return model_set.detector
+
+
+def run_multiprocess(
+    stop_event,
+    num_workers,
+    width,
+    height,
+    mean_inv_cov_path,
+    scheduling_policy,
+    record=False,
+):
+    """
+    検出と異常検知を別プロセスで実行する。プレビュー、ローカル表示、ホットリロードは使えない
+    """
+    pipeline = MultiProcessPipeline(
+        label_map=LabelConfigs().label_map,
+        mean_inv_cov_path=mean_inv_cov_path,
+        frame_shape=(height, width, 3),
+        num_workers=num_workers,
+        record=record,
+        scheduling_policy=scheduling_policy,
+    ).start()
+    tracer.start()
+    scheduling_policy.apply("capture")
+    try:
+        with Camera(width=width, height=height) as cam:
+            frames = cam.iterate_frames()
+            for frame_id in itertools.count(pipeline.next_frame_id()):
+                tracer.begin_frame(frame_id)
+                with tracer.span("capture"):
+                    frame = next(frames, None)
+                if frame is None or stop_event.is_set():
+                    break
+                with tracer.span("submit"):
+                    pipeline.submit(frame, frame_id)
+                tracer.end_frame()
+    except Exception:
+        custom_logger.exception("実行中にエラーが発生しました")
+    finally:
+        custom_logger.info("アプリケーションを終了します。")
+        tracer.end_frame()
+        pipeline.stop()
+        tracer.stop()
+
+
+def main(
+    show_frame=False,
+    enable_preview=False,
+    profile_allocations=False,
+    trace_sample_rate=None,
+    scheduling_layout=None,
+    num_workers=0,
+    record=False,
+    hot_reload=False,
+):
     custom_logger.info("Initialization starts")
 
+    stop_event = threading.Event()
+    install_signal_handlers(stop_event)
+    system_config = SystemConfigs()
+
     width = 640
     height = 480
     mean_inv_cov_path = f"{os.path.dirname(os.path.abspath(__file__))}/mean_inv_cov"
 
+    # ワーカープロセスへ設定を引き継ぐため、パイプラインの起動より前に設定する
+    configure_tracer(system_config, trace_sample_rate)
+    scheduling_policy = SchedulingPolicy.from_config(system_config, scheduling_layout)
+    scheduling_policy.apply_global()
+
+    if num_workers > 0:
+        # コマンドラインでの指定は引数の解析時に弾くので、ここに来るのは主に設定ファイルの値
+        for enabled, feature in (
+            (show_frame, "frame display"),
+            (enable_preview or system_config.preview_enabled, "preview"),
+            (hot_reload or system_config.hot_reload_enabled, "hot reload"),
+        ):
+            if enabled:
+                custom_logger.warning(
+                    f"{feature} is not supported with worker processes, ignoring it"
+                )
+        run_multiprocess(
+            stop_event,
+            num_workers,
+            width,
+            height,
+            mean_inv_cov_path,
+            scheduling_policy,
+            record=record,
+        )
+        return
+
     detect_score_threshold = TFliteConfig(section_name="detector").score_threshold
 
-    detector = Detector(label_map=LabelConfigs().label_map)
+    label_map = LabelConfigs().label_map
+    detector, anomaly, metric = StartupOrchestrator(
+        label_map=label_map,
+        mean_inv_cov_path=mean_inv_cov_path,
+        system_config=system_config,
+        scheduling_policy=scheduling_policy,
+    ).run()
+
+    preview = None
+    should_draw = None
+    # 保存するフレームに注釈を付けるのは、注釈付きクリップの設定時と全フレーム保存 (frames/) の場合
+    annotate_saved = (
+        system_config.event_clips_annotated or not system_config.event_clips_enabled
+    )
+    if enable_preview or system_config.preview_enabled:
+        # メインスレッドの nice 値を上げると戻せないため、io の設定はサーバースレッド自身が適用する
+        preview = PreviewServer(
+            host=system_config.preview_host,
+            port=system_config.preview_port,
+            max_fps=system_config.preview_max_fps,
+            max_width=system_config.preview_max_width,
+            quality=system_config.preview_jpeg_quality,
+        ).start(scheduling_policy)
+        # 他に描画結果を使うものがなければ、視聴者がいるときだけ描画する
+        if not show_frame and not annotate_saved:
+            should_draw = preview.has_clients
+
     detect_handler = ObjectDetectHandler(
-        api_config=ApiConfigs(section_name="LINE"),
-        enable_drawing=True,
+        api_config=ApiConfigs(section_name=RESULT_API_SECTION),
+        enable_drawing=show_frame or preview is not None or annotate_saved,
         detect_score_threshold=detect_score_threshold,
-        mean_inv_cov_path=mean_inv_cov_path,
+        anomaly=anomaly,
+        metric=metric,
+        should_draw=should_draw,
+        recorder=(
+            FeatureRecorder.from_config(
+                system_config, scheduling_policy=scheduling_policy
+            )
+            if record
+            else None
+        ),
+        scheduling_policy=scheduling_policy,
     )
 
+    reloader = None
+    if hot_reload or system_config.hot_reload_enabled:
+        reloader = HotReloader.from_config(
+            ModelSet(detector, anomaly, metric),
+            label_map,
+            mean_inv_cov_path,
+            system_config,
+            scheduling_policy,
+        ).start()
+
+    configure_allocation_profiler(system_config, profile_allocations)
+    allocation_profiler.start()
+    tracer.start()
+    scheduling_policy.apply("capture")
+
     try:
         with Camera(width=width, height=height) as cam:
-            for frame in cam.iterate_frames():
-                if cv2.waitKey(1) & 0xFF == ord("q"):
-                    custom_logger.info("Exit key pressed, closing camera.")
-                    break
-                results = detector.detect(frame).get_results()
-
-                if results is not None:
-                    detect_handler.process_results(
-                        frame=frame,
-                        num=results["num"],
-                        class_ids=results["ids"],
-                        class_labels=results["labels"],
-                        boxes=results["boxes"],
-                        scores=results["scores"],
-                    )
-                    if show_frame:
-                        cv2.imshow("Image Window", frame)
+            frames = cam.iterate_frames()
+            # トレースと結果ストアで同じフレーム ID を使うよう、処理の前に採番する
+            first_frame_id = detect_handler.result_store.peek_next_frame_id()
+            for frame_id in itertools.count(first_frame_id):
+                tracer.begin_frame(frame_id)
+                with tracer.span("frame"):
+                    with tracer.span("capture"):
+                        frame = next(frames, None)
+                    if frame is None or stop_event.is_set():
+                        break
+                    if show_frame and cv2.waitKey(1) & 0xFF == ord("q"):
+                        custom_logger.info("Exit key pressed, closing camera.")
+                        break
+                    # 新しいモデルへの差し替えはフレームの合間にだけ行う
+                    model_set = reloader.take_pending() if reloader else None
+                    if model_set is not None:
+                        detector = apply_model_set(model_set, detect_handler)
+
+                    try:
+                        results = process_frame(
+                            detector, detect_handler, frame, frame_id
+                        )
+                    except Exception:
+                        # 差し替え直後の失敗なら直前のモデルに戻して同じフレームを処理し直す。
+                        # 記録や保存は異常検知がすべて成功してから行うので二重にはならない
+                        model_set = reloader.rollback() if reloader else None
+                        if model_set is None:
+                            raise
+                        custom_logger.exception(
+                            "frame failed right after a model swap, "
+                            "reprocessing it with the previous models"
+                        )
+                        detector = apply_model_set(model_set, detect_handler)
+                        results = process_frame(
+                            detector, detect_handler, frame, frame_id
+                        )
+                    else:
+                        if reloader is not None:
+                            reloader.frame_succeeded()
+
+                    if results is not None:
+                        if preview is not None:
+                            with tracer.span("preview"):
+                                preview.publish(frame)
+                        if show_frame:
+                            cv2.imshow("Image Window", frame)
+
+                tracer.end_frame()
+                allocation_profiler.end_frame()
 
     except Exception:
         custom_logger.exception("実行中にエラーが発生しました")
     finally:
         custom_logger.info("アプリケーションを終了します。")
-        cv2.destroyAllWindows()
+        if reloader is not None:
+            reloader.stop()
+        detect_handler.close()
+        report_allocation_profile(system_config)
+        tracer.stop()
+        if preview is not None:
+            preview.stop()
+        if show_frame:
+            cv2.destroyAllWindows()
 
 
 if __name__ == "__main__":
@@ -63,6 +320,68 @@ if __name__ == "__main__":
         action="store_true",
         help="Display the frame in a window if this flag is set.",
     )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="Serve an MJPEG live preview over HTTP regardless of system_configs.json.",
+    )
+    parser.add_argument(
+        "--profile-allocations",
+        action="store_true",
+        help="Attribute per-frame allocations to pipeline stages with tracemalloc.",
+    )
+    parser.add_argument(
+        "--trace",
+        type=float,
+        default=None,
+        metavar="SAMPLE_RATE",
+        help="Write Chrome trace events for this fraction of frames (0-1).",
+    )
+    parser.add_argument(
+        "--layout",
+        default=None,
+        help="Scheduling layout name from system_configs.json to use.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Run detection and anomaly scoring in N worker processes "
+        "sharing frames through shared memory "
+        "(no preview, frame display or hot reload).",
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Record anomaly layer outputs for offline re-scoring "
+        "(python -m calculator.replay).",
+    )
+    parser.add_argument(
+        "--hot-reload",
+        action="store_true",
+        help="Watch model files and statistics and swap them in without restarting.",
+    )
     args = parser.parse_args()
+    if args.workers > 0:
+        unsupported = [
+            flag
+            for flag, enabled in (
+                ("--show-frame", args.show_frame),
+                ("--preview", args.preview),
+                ("--hot-reload", args.hot_reload),
+            )
+            if enabled
+        ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be used with --workers")
 
-    main(show_frame=args.show_frame)
+    main(
+        show_frame=args.show_frame,
+        enable_preview=args.preview,
+        profile_allocations=args.profile_allocations,
+        trace_sample_rate=args.trace,
+        scheduling_layout=args.layout,
+        num_workers=args.workers,
+        record=args.record,
+        hot_reload=args.hot_reload,
+    )
@@ -0,0 +1,168 @@
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from logger.custom_logger import custom_logger
+
+
+class StaleFrameError(RuntimeError):
+    pass
+
+
+class FrameDescriptor:
+    """
+    キューで受け渡すフレームの参照。フレーム本体は FrameBus のスロットにある
+    """
+
+    __slots__ = ("slot", "generation", "frame_id", "ts", "shape")
+
+    def __init__(self, slot, generation, frame_id, ts, shape):
+        self.slot = slot
+        self.generation = generation
+        self.frame_id = frame_id
+        self.ts = ts
+        self.shape = shape
+
+    def __getstate__(self):
+        return (self.slot, self.generation, self.frame_id, self.ts, self.shape)
+
+    def __setstate__(self, state):
+        self.slot, self.generation, self.frame_id, self.ts, self.shape = state
+
+    def __repr__(self):
+        return (
+            f"FrameDescriptor(slot={self.slot}, generation={self.generation}, "
+            f"frame_id={self.frame_id})"
+        )
+
+
+class FrameBus:
+    """
+    multiprocessing.shared_memory 上の固定数のフレームスロットを複数プロセスで共有する
+
+    書き込み側は acquire() で空きスロットを取得して 1 度だけコピーし、
+    読み出し側は view() でコピーせずに参照する。スロットは参照カウントで管理し、
+    すべての参照が release() されると空きキューに戻る。
+    スロットが再利用されると世代番号が進み、古い記述子での参照は StaleFrameError になる
+
+    生成は親プロセスで行い、Process の引数として渡すと子プロセスで同じ共有メモリに接続する
+    """
+
+    def __init__(self, context, num_slots, max_shape, dtype=np.uint8):
+        self.num_slots = num_slots
+        self.max_shape = tuple(max_shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_nbytes = int(np.prod(self.max_shape)) * self.dtype.itemsize
+
+        self._frames_shm = shared_memory.SharedMemory(
+            create=True, size=self.slot_nbytes * num_slots
+        )
+        # スロットごとに [参照カウント, 世代番号] を持つ
+        self._meta_shm = shared_memory.SharedMemory(
+            create=True, size=num_slots * 2 * np.dtype(np.int64).itemsize
+        )
+        self._lock = context.Lock()
+        self._free_slots = context.Queue()
+        self._owner = True
+        self._attach_arrays()
+        self._meta[:] = 0
+        for slot in range(num_slots):
+            self._free_slots.put(slot)
+        custom_logger.info(
+            f"frame bus created / slots {num_slots} / slot size {self.slot_nbytes} bytes"
+        )
+
+    def _attach_arrays(self):
+        self._frames = np.ndarray(
+            (self.num_slots, self.slot_nbytes), dtype=np.uint8, buffer=self._frames_shm.buf
+        )
+        self._meta = np.ndarray(
+            (self.num_slots, 2), dtype=np.int64, buffer=self._meta_shm.buf
+        )
+
+    def __getstate__(self):
+        return {
+            "num_slots": self.num_slots,
+            "max_shape": self.max_shape,
+            "dtype": self.dtype.str,
+            "slot_nbytes": self.slot_nbytes,
+            "frames_name": self._frames_shm.name,
+            "meta_name": self._meta_shm.name,
+            "lock": self._lock,
+            "free_slots": self._free_slots,
+        }
+
+    def __setstate__(self, state):
+        self.num_slots = state["num_slots"]
+        self.max_shape = state["max_shape"]
+        self.dtype = np.dtype(state["dtype"])
+        self.slot_nbytes = state["slot_nbytes"]
+        self._frames_shm = shared_memory.SharedMemory(name=state["frames_name"])
+        self._meta_shm = shared_memory.SharedMemory(name=state["meta_name"])
+        self._lock = state["lock"]
+        self._free_slots = state["free_slots"]
+        self._owner = False
+        self._attach_arrays()
+
+    def write(self, frame, frame_id, ts, readers=1, timeout=None):
+        """
+        空きスロットにフレームをコピーして記述子を返す。timeout までに空きがなければ None
+        """
+        if frame.dtype != self.dtype or frame.nbytes > self.slot_nbytes:
+            raise ValueError(
+                f"frame {frame.shape}/{frame.dtype} does not fit slot "
+                f"{self.max_shape}/{self.dtype}"
+            )
+        try:
+            slot = self._free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        destination = self._frames[slot, : frame.nbytes].reshape(frame.shape)
+        np.copyto(destination, frame)
+        with self._lock:
+            self._meta[slot, 0] = readers
+            self._meta[slot, 1] += 1
+            generation = int(self._meta[slot, 1])
+        return FrameDescriptor(slot, generation, frame_id, ts, frame.shape)
+
+    def _check(self, descriptor):
+        if self._meta[descriptor.slot, 1] != descriptor.generation:
+            raise StaleFrameError(f"{descriptor} has been recycled")
+
+    def view(self, descriptor):
+        """
+        スロットを読み取り専用の ndarray として返す (コピーしない)
+        """
+        self._check(descriptor)
+        nbytes = int(np.prod(descriptor.shape)) * self.dtype.itemsize
+        frame = self._frames[descriptor.slot, :nbytes].view(self.dtype)
+        frame = frame.reshape(descriptor.shape)
+        frame.flags.writeable = False
+        return frame
+
+    def retain(self, descriptor, count=1):
+        with self._lock:
+            self._check(descriptor)
+            self._meta[descriptor.slot, 0] += count
+
+    def release(self, descriptor):
+        with self._lock:
+            self._check(descriptor)
+            self._meta[descriptor.slot, 0] -= 1
+            remaining = int(self._meta[descriptor.slot, 0])
+        if remaining == 0:
+            self._free_slots.put(descriptor.slot)
+        elif remaining < 0:
+            raise RuntimeError(f"{descriptor} released more times than retained")
+
+    def close(self):
+        # 子プロセスに渡した ndarray が残っていると close できないため先に参照を外す
+        self._frames = None
+        self._meta = None
+        self._frames_shm.close()
+        self._meta_shm.close()
+        if self._owner:
+            self._frames_shm.unlink()
+            self._meta_shm.unlink()
@@ -0,0 +1,359 @@
+import glob
+import multiprocessing
+import os
+import threading
+import time
+
+from config_manager.config import (
+    RESULT_API_SECTION,
+    ApiConfigs,
+    SystemConfigs,
+    TFliteConfig,
+)
+from detection_handler import ObjectDetectHandler, make_frame_name
+from detector.detector import Detector
+from logger.custom_logger import custom_logger
+from pipeline.frame_bus import FrameBus, StaleFrameError
+from profiling.tracing import tracer
+from scheduling.affinity import SchedulingPolicy
+from storage.event_clips import EventClipRecorder
+from storage.feature_archive import FeatureRecorder
+from storage.result_store import ResultStore
+
+
+def _start_tracer(trace_settings):
+    # spawn した子プロセスのトレーサは未設定なので、親の設定を引き継いで別ファイルに書き出す
+    if trace_settings is not None:
+        tracer.configure(**trace_settings).start()
+
+
+def _apply_scheduling(scheduling_layout, role):
+    # 以降に生成されるスレッド (TFLite のワーカーなど) もこのプロセスの設定を引き継ぐ
+    scheduling_policy = SchedulingPolicy.from_config(SystemConfigs(), scheduling_layout)
+    scheduling_policy.apply_global()
+    scheduling_policy.apply(role)
+    return scheduling_policy
+
+
+def _detector_worker(
+    bus,
+    input_queue,
+    output_queue,
+    label_map,
+    num_handlers,
+    scheduling_layout=None,
+    trace_settings=None,
+):
+    _apply_scheduling(scheduling_layout, "detector")
+    detector = Detector(label_map=label_map)
+    detector.model.warm_up(SystemConfigs().warmup_runs)
+    _start_tracer(trace_settings)
+    try:
+        while True:
+            descriptor = input_queue.get()
+            if descriptor is None:
+                break
+            tracer.begin_frame(descriptor.frame_id)
+            try:
+                with tracer.span("detect"):
+                    results = detector.detect(bus.view(descriptor)).get_results()
+            except StaleFrameError:
+                custom_logger.exception("detector received a recycled frame")
+                continue
+            except Exception:
+                # 1 フレームの失敗でワーカーが止まらないよう、記録して次のフレームへ進む
+                custom_logger.exception(
+                    f"detector worker failed on frame {descriptor.frame_id}"
+                )
+                bus.release(descriptor)
+                continue
+            finally:
+                tracer.end_frame()
+            if results is None:
+                bus.release(descriptor)
+                continue
+            # スロットの参照はそのまま後段のワーカーへ引き渡す
+            output_queue.put((descriptor, results))
+    finally:
+        for _ in range(num_handlers):
+            output_queue.put(None)
+        bus.close()
+        tracer.stop()
+
+
+def _handler_worker(
+    worker_index,
+    bus,
+    input_queue,
+    clip_queue,
+    mean_inv_cov_path,
+    output_root,
+    record=False,
+    scheduling_layout=None,
+    trace_settings=None,
+):
+    system_config = SystemConfigs()
+    scheduling_policy = _apply_scheduling(scheduling_layout, "anomaly")
+    # ワーカーごとに出力先を分け、結果ストアの書き込みが競合しないようにする
+    worker_root = os.path.join(output_root, f"worker_{worker_index}")
+    recorder = None
+    if record or system_config.recording_enabled:
+        recorder = FeatureRecorder.from_config(
+            system_config, f"worker_{worker_index}", scheduling_policy
+        )
+    handler = ObjectDetectHandler(
+        api_config=ApiConfigs(section_name=RESULT_API_SECTION),
+        detect_score_threshold=TFliteConfig(section_name="detector").score_threshold,
+        enable_drawing=False,
+        mean_inv_cov_path=mean_inv_cov_path,
+        result_store=ResultStore(
+            directory=os.path.join(
+                system_config.result_store_directory, f"worker_{worker_index}"
+            ),
+            segment_max_bytes=system_config.result_store_segment_max_bytes,
+            total_budget_bytes=system_config.result_store_total_budget_bytes,
+            fsync=system_config.result_store_fsync,
+        ),
+        output_root=worker_root,
+        recorder=recorder,
+        # イベントクリップは全フレームを見る必要があるため、本プロセスでまとめて保存する
+        save_frames=clip_queue is None,
+        scheduling_policy=scheduling_policy,
+    )
+    handler.anomaly.model.warm_up(system_config.warmup_runs)
+    _start_tracer(trace_settings)
+    try:
+        while True:
+            item = input_queue.get()
+            if item is None:
+                break
+            descriptor, results = item
+            tracer.begin_frame(descriptor.frame_id)
+            try:
+                with tracer.span("process_results"):
+                    _, json_result, late_results = handler.process_results(
+                        frame=bus.view(descriptor),
+                        num=results["num"],
+                        class_ids=results["ids"],
+                        class_labels=results["labels"],
+                        boxes=results["boxes"],
+                        scores=results["scores"],
+                        frame_id=descriptor.frame_id,
+                        ts=descriptor.ts,
+                    )
+            except Exception:
+                custom_logger.exception(f"handler worker {worker_index} failed")
+                bus.release(descriptor)
+                continue
+            finally:
+                tracer.end_frame()
+            if clip_queue is None:
+                bus.release(descriptor)
+            else:
+                # スロットの参照はクリップの保存後に本プロセスで解放する
+                clip_queue.put((descriptor, json_result, late_results))
+    finally:
+        handler.close()
+        bus.close()
+        tracer.stop()
+
+
+class MultiProcessPipeline:
+    """
+    キャプチャ (本プロセス) → 検出ワーカー → 異常検知・出力ワーカー (num_workers 個) の
+    プロセス構成でフレームを処理する。フレームは FrameBus 経由で受け渡しコピーしない
+
+    フレーム ID は submit() の呼び出し側が採番し、各ワーカーの結果ストアにそのまま記録する。
+    イベントクリップは全フレームを順に見る必要があるため、ワーカーの結果を本プロセスの
+    収集スレッドに戻して 1 つの EventClipRecorder で保存する
+    """
+
+    def __init__(
+        self,
+        label_map,
+        mean_inv_cov_path,
+        frame_shape,
+        num_workers=2,
+        num_slots=None,
+        output_root="output",
+        queue_size=8,
+        record=False,
+        scheduling_policy=None,
+    ):
+        self.label_map = label_map
+        self.mean_inv_cov_path = mean_inv_cov_path
+        self.frame_shape = frame_shape
+        self.num_workers = num_workers
+        self.output_root = output_root
+        self.queue_size = queue_size
+        self.record = record
+        self.system_config = SystemConfigs()
+        # ワーカーには構成名だけを渡し、各プロセスで同じ SchedulingPolicy を構築する
+        self.scheduling_policy = scheduling_policy or SchedulingPolicy.from_config(
+            self.system_config
+        )
+        self.clips_enabled = self.system_config.event_clips_enabled
+        # 収集スレッドへのキューに入っているフレームもスロットを保持する
+        self.num_slots = num_slots or (
+            queue_size * (2 if self.clips_enabled else 1) + num_workers + 2
+        )
+
+        # TFLite インタプリタやスレッドを fork 後に引き継がないよう spawn で起動する
+        self._context = multiprocessing.get_context("spawn")
+        self.bus = None
+        self._detect_queue = None
+        self._handler_queue = None
+        self._clip_queue = None
+        self._collector = None
+        self._event_clips = None
+        self._processes = []
+        self.dropped_frames = 0
+
+    def next_frame_id(self):
+        """
+        再起動しても ID が重複しないよう、各ワーカーの結果ストアに続く最初のフレーム ID を返す
+        """
+        next_frame_id = 0
+        pattern = os.path.join(self.system_config.result_store_directory, "worker_*")
+        for directory in glob.glob(pattern):
+            store = ResultStore(directory)
+            next_frame_id = max(next_frame_id, store.peek_next_frame_id())
+            store.close()
+        return next_frame_id
+
+    def start(self):
+        self.bus = FrameBus(self._context, self.num_slots, self.frame_shape)
+        self._detect_queue = self._context.Queue(self.queue_size)
+        self._handler_queue = self._context.Queue(self.queue_size)
+        if self.clips_enabled:
+            self._clip_queue = self._context.Queue(self.queue_size)
+            self._event_clips = EventClipRecorder.from_config(
+                self.system_config,
+                os.path.join(self.output_root, "events"),
+                self.scheduling_policy,
+            )
+            self._collector = threading.Thread(
+                target=self._collect_clips, name="clip-collector", daemon=True
+            )
+            self._collector.start()
+
+        self._processes.append(
+            self._context.Process(
+                target=_detector_worker,
+                args=(
+                    self.bus,
+                    self._detect_queue,
+                    self._handler_queue,
+                    self.label_map,
+                    self.num_workers,
+                    self.scheduling_policy.name,
+                    self._trace_settings("detector"),
+                ),
+                name="detector-worker",
+            )
+        )
+        for worker_index in range(self.num_workers):
+            self._processes.append(
+                self._context.Process(
+                    target=_handler_worker,
+                    args=(
+                        worker_index,
+                        self.bus,
+                        self._handler_queue,
+                        self._clip_queue,
+                        self.mean_inv_cov_path,
+                        self.output_root,
+                        self.record,
+                        self.scheduling_policy.name,
+                        self._trace_settings(f"worker_{worker_index}"),
+                    ),
+                    name=f"handler-worker-{worker_index}",
+                )
+            )
+        for process in self._processes:
+            process.start()
+        custom_logger.info(
+            f"multi-process pipeline started / handler workers {self.num_workers} / "
+            f"slots {self.num_slots}"
+        )
+        return self
+
+    @staticmethod
+    def _trace_settings(name):
+        return tracer.child_settings(name) if tracer.enabled else None
+
+    def _collect_clips(self):
+        self.scheduling_policy.apply("io")
+        # ワーカーごとの処理時間の差で前後することはあるが、ほぼキャプチャ順に届く
+        while True:
+            item = self._clip_queue.get()
+            if item is None:
+                break
+            descriptor, json_result, late_results = item
+            tracer.begin_frame(descriptor.frame_id)
+            try:
+                with tracer.span("clip.add"):
+                    self._event_clips.add(
+                        self.bus.view(descriptor),
+                        descriptor.frame_id,
+                        descriptor.ts,
+                        make_frame_name(descriptor.ts, descriptor.frame_id),
+                        json_result,
+                        late=late_results,
+                    )
+            except Exception:
+                custom_logger.exception(
+                    f"failed to keep frame {descriptor.frame_id} for event clips"
+                )
+            finally:
+                tracer.end_frame()
+                self.bus.release(descriptor)
+
+    def check_workers(self):
+        """
+        終了したワーカーがあれば RuntimeError を送出する
+        """
+        for process in self._processes:
+            if not process.is_alive():
+                raise RuntimeError(
+                    f"{process.name} exited unexpectedly with code {process.exitcode}"
+                )
+
+    def submit(self, frame, frame_id):
+        """
+        フレームを共有メモリに書き込み検出ワーカーへ渡す。空きスロットがなければ破棄する
+        """
+        # ワーカーが落ちたままフレームを投入し続けないよう、呼び出し側に失敗を伝える
+        self.check_workers()
+        descriptor = self.bus.write(frame, frame_id, time.time(), timeout=0)
+        if descriptor is None:
+            self.dropped_frames += 1
+            custom_logger.warning(
+                f"no free frame slot, dropped frame {frame_id} / "
+                f"total dropped {self.dropped_frames}"
+            )
+            return False
+        self._detect_queue.put(descriptor)
+        return True
+
+    def stop(self, timeout=30):
+        if self._detect_queue is not None:
+            self._detect_queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                custom_logger.warning(f"{process.name} did not stop, terminating")
+                process.terminate()
+        self._processes = []
+        if self._collector is not None:
+            # ワーカーが書き込んだ結果はすべてキューに届いているので、最後に終了を伝える
+            self._clip_queue.put(None)
+            self._collector.join()
+            self._collector = None
+            self._event_clips.close()
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+        custom_logger.info(
+            f"multi-process pipeline stopped / dropped frames {self.dropped_frames}"
+        )
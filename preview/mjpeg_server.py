@@ -0,0 +1,185 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+from logger.custom_logger import custom_logger
+from profiling.tracing import tracer
+
+_BOUNDARY = "frame"
+_INDEX_HTML = (
+    b"<html><head><title>preview</title></head>"
+    b'<body style="margin:0;background:#000"><img src="/stream"></body></html>'
+)
+
+
+class _PreviewRequestHandler(BaseHTTPRequestHandler):
+    # self.server.preview には PreviewServer.start() で自身が設定される
+    server_version = "EdgePreview/1.0"
+
+    def do_GET(self):
+        if self.path in ("/", "/index.html"):
+            self._send_index()
+        elif self.path == "/stream":
+            self._send_stream()
+        else:
+            self.send_error(404)
+
+    def _send_index(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(_INDEX_HTML)))
+        self.end_headers()
+        self.wfile.write(_INDEX_HTML)
+
+    def _send_stream(self):
+        preview = self.server.preview
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-cache, private")
+        self.send_header("Pragma", "no-cache")
+        self.send_header(
+            "Content-Type", f"multipart/x-mixed-replace; boundary={_BOUNDARY}"
+        )
+        self.end_headers()
+
+        preview._client_connected()
+        try:
+            sequence = -1
+            while not preview.is_stopped():
+                jpeg, sequence, frame_id = preview.wait_for_frame(
+                    sequence, timeout=1.0
+                )
+                if jpeg is None:
+                    continue
+                with tracer.bind_frame(frame_id), tracer.span("preview.send"):
+                    self.wfile.write(
+                        f"--{_BOUNDARY}\r\n"
+                        f"Content-Type: image/jpeg\r\n"
+                        f"Content-Length: {len(jpeg)}\r\n\r\n".encode("ascii")
+                    )
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            preview._client_disconnected()
+
+    def log_message(self, format, *args):
+        custom_logger.debug(f"preview {self.address_string()} {format % args}")
+
+
+class PreviewServer:
+    """
+    注釈付きフレームを MJPEG で配信する HTTP サーバー
+
+    接続中のクライアントがいる間だけ publish() がフレームを縮小・JPEG エンコードする。
+    クライアントがいないときの publish() は何もしない
+    """
+
+    def __init__(self, host="0.0.0.0", port=8080, max_fps=5, max_width=640, quality=70):
+        self.host = host
+        self.port = port
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.max_width = max_width
+        self.quality = quality
+
+        self._condition = threading.Condition()
+        self._jpeg = None
+        self._frame_id = None
+        self._sequence = 0
+        self._num_clients = 0
+        self._last_publish = 0.0
+        self._stopped = threading.Event()
+        self._httpd = None
+        self._thread = None
+
+    def start(self, scheduling_policy=None):
+        """
+        scheduling_policy を渡すと、サーバースレッドが自身に io の設定を適用する。
+        クライアントごとのスレッドはサーバースレッドの設定を引き継ぐ
+        """
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _PreviewRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.preview = self
+        self._thread = threading.Thread(
+            target=self._serve,
+            args=(scheduling_policy,),
+            name="preview-server",
+            daemon=True,
+        )
+        self._thread.start()
+        custom_logger.info(f"preview server listening on http://{self.host}:{self.port}/")
+        return self
+
+    def _serve(self, scheduling_policy):
+        if scheduling_policy is not None:
+            scheduling_policy.apply("io")
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        custom_logger.info("preview server stopped")
+
+    def is_stopped(self):
+        return self._stopped.is_set()
+
+    def has_clients(self):
+        return self._num_clients > 0
+
+    def _client_connected(self):
+        with self._condition:
+            self._num_clients += 1
+        custom_logger.info(f"preview client connected / clients {self._num_clients}")
+
+    def _client_disconnected(self):
+        with self._condition:
+            self._num_clients -= 1
+        custom_logger.info(f"preview client disconnected / clients {self._num_clients}")
+
+    def publish(self, frame):
+        if not self.has_clients():
+            return False
+        now = time.monotonic()
+        if now - self._last_publish < self.min_interval:
+            return False
+        self._last_publish = now
+
+        height, width = frame.shape[:2]
+        if self.max_width and width > self.max_width:
+            scale = self.max_width / width
+            frame = cv2.resize(
+                frame,
+                (self.max_width, int(height * scale)),
+                interpolation=cv2.INTER_AREA,
+            )
+        ok, encoded = cv2.imencode(
+            ".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        )
+        if not ok:
+            custom_logger.warning("preview frame encoding failed")
+            return False
+
+        with self._condition:
+            self._jpeg = encoded.tobytes()
+            # 配信スレッドのトレースを元のフレームに紐付ける
+            self._frame_id = tracer.current_frame()
+            self._sequence += 1
+            self._condition.notify_all()
+        return True
+
+    def wait_for_frame(self, last_sequence, timeout=None):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._sequence != last_sequence or self._stopped.is_set(),
+                timeout=timeout,
+            )
+            if self._sequence == last_sequence:
+                return None, last_sequence, None
+            return self._jpeg, self._sequence, self._frame_id
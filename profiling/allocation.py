@@ -0,0 +1,229 @@
+import contextlib
+import os
+import sys
+import threading
+import tracemalloc
+
+from logger.custom_logger import custom_logger
+
+
+class AllocationBudgetExceeded(RuntimeError):
+    pass
+
+
+class StageAllocation:
+    def __init__(self):
+        self.calls = 0
+        self.allocated_bytes = 0
+        self.retained_bytes = 0
+        self.blocks = 0
+
+    def add(self, allocated_bytes, retained_bytes, blocks):
+        self.calls += 1
+        self.allocated_bytes += allocated_bytes
+        self.retained_bytes += retained_bytes
+        self.blocks += blocks
+
+    def to_dict(self, num_frames):
+        num_frames = max(num_frames, 1)
+        return {
+            "calls": self.calls,
+            "allocated_bytes_per_frame": self.allocated_bytes / num_frames,
+            "retained_bytes_per_frame": self.retained_bytes / num_frames,
+            "blocks_per_frame": self.blocks / num_frames,
+        }
+
+
+class AllocationProfiler:
+    """
+    tracemalloc を用いてパイプラインの各ステージの割り当て量をフレーム単位で集計する
+
+    allocated: ステージ実行中のピーク増加量 (一時的な割り当てを含む)
+    retained: ステージ終了時点で解放されずに残った量
+    blocks: ステージ前後での確保済みメモリブロック数の差分
+    warmup_frames までのフレームは定常状態の集計から除外する
+    """
+
+    def __init__(
+        self,
+        enabled=False,
+        snapshot_interval=500,
+        snapshot_dir="output/profiling",
+        top_n=10,
+        traceback_frames=1,
+        warmup_frames=20,
+    ):
+        self.enabled = enabled
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_dir = snapshot_dir
+        self.top_n = top_n
+        self.traceback_frames = traceback_frames
+        self.warmup_frames = warmup_frames
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._frame_count = 0
+        self._steady_frames = 0
+        self._previous_snapshot = None
+        self._calibration = []
+        self._overhead = (0, 0, 0)
+
+    def configure(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise AttributeError(f"Unknown profiler option: {key}")
+            setattr(self, key, value)
+        return self
+
+    def start(self):
+        if not self.enabled:
+            return self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceback_frames)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self._calibrate()
+        self._previous_snapshot = self._take_snapshot()
+        custom_logger.info(
+            f"allocation profiling started / snapshot interval {self.snapshot_interval}"
+        )
+        return self
+
+    def stop(self):
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            custom_logger.info(f"allocation profile: {self.report()}")
+
+    def _calibrate(self, rounds=64):
+        # 計測処理自体の割り当て量を空のステージで測り、以降の計測値から差し引く
+        self._calibration = []
+        for _ in range(rounds):
+            with self._measure(None):
+                pass
+        samples = sorted(self._calibration)
+        self._overhead = samples[len(samples) // 2]
+        self._calibration = []
+        custom_logger.debug(f"allocation profiler overhead per stage {self._overhead}")
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def _measure(self, name):
+        stack = self._stack()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            # reset_peak で親ステージのピークが失われないよう退避する
+            stack[-1][2] = max(stack[-1][2], peak)
+        tracemalloc.reset_peak()
+        entry = [current, sys.getallocatedblocks(), current]
+        stack.append(entry)
+        try:
+            yield
+        finally:
+            end_current, end_peak = tracemalloc.get_traced_memory()
+            end_peak = max(end_peak, entry[2])
+            blocks = sys.getallocatedblocks() - entry[1]
+            stack.pop()
+            if stack:
+                stack[-1][2] = max(stack[-1][2], end_peak)
+            self._record(name, end_peak - entry[0], end_current - entry[0], blocks)
+
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._measure(name)
+
+    def _record(self, name, allocated_bytes, retained_bytes, blocks):
+        if name is None:
+            self._calibration.append((allocated_bytes, retained_bytes, blocks))
+            return
+        if self._frame_count < self.warmup_frames:
+            return
+        allocated_bytes -= self._overhead[0]
+        retained_bytes -= self._overhead[1]
+        blocks -= self._overhead[2]
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = StageAllocation()
+            stage.add(allocated_bytes, retained_bytes, blocks)
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self._frame_count += 1
+        if self._frame_count > self.warmup_frames:
+            self._steady_frames += 1
+        if self.snapshot_interval and self._frame_count % self.snapshot_interval == 0:
+            self._dump_snapshot_diff()
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            )
+        )
+
+    def _dump_snapshot_diff(self):
+        snapshot = self._take_snapshot()
+        diff = snapshot.compare_to(self._previous_snapshot, "lineno")
+        self._previous_snapshot = snapshot
+
+        file_path = os.path.join(
+            self.snapshot_dir, f"alloc_diff_{self._frame_count:010d}.txt"
+        )
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(f"frame {self._frame_count}\n")
+            for stat in diff:
+                f.write(f"{stat}\n")
+        custom_logger.info(
+            f"allocation snapshot diff at frame {self._frame_count} saved: {file_path}"
+        )
+        for stat in diff[: self.top_n]:
+            custom_logger.info(f"  {stat}")
+
+    def report(self):
+        with self._lock:
+            return {
+                name: stage.to_dict(self._steady_frames)
+                for name, stage in self._stages.items()
+            }
+
+
+class AllocationBudget:
+    """
+    定常状態で 1 フレームあたりに残留してよいバイト数をステージごとに定義する
+    """
+
+    def __init__(self, retained_bytes_per_frame):
+        self.retained_bytes_per_frame = retained_bytes_per_frame
+
+    def violations(self, report):
+        violations = {}
+        for name, budget in self.retained_bytes_per_frame.items():
+            if name == "total":
+                used = sum(r["retained_bytes_per_frame"] for r in report.values())
+            elif name in report:
+                used = report[name]["retained_bytes_per_frame"]
+            else:
+                continue
+            if used > budget:
+                violations[name] = (used, budget)
+        return violations
+
+    def check(self, report):
+        violations = self.violations(report)
+        if violations:
+            details = ", ".join(
+                f"{name}: {used:.0f} > {budget} bytes/frame"
+                for name, (used, budget) in violations.items()
+            )
+            raise AllocationBudgetExceeded(f"steady-state allocation budget exceeded: {details}")
+
+
+allocation_profiler = AllocationProfiler()
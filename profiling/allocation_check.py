@@ -0,0 +1,109 @@
+import argparse
+import sys
+import tempfile
+
+import numpy as np
+
+from calculator.mahalanobis_calculator import Mean_inv_Cov_Data, VectorMetrics
+from config_manager.config import SystemConfigs
+from images.image_util import Preprocessor
+from logger.custom_logger import custom_logger
+from profiling.allocation import (
+    AllocationBudget,
+    AllocationBudgetExceeded,
+    AllocationProfiler,
+)
+from sender.wire_format import WireEncoder
+from storage.result_store import ResultStore
+
+# EfficientNet-B0 の各出力層の特徴量次元に合わせた合成データ
+_LAYER_DIMS = (16, 24, 40, 80, 112, 192, 320, 1280, 1280)
+
+
+def _synthetic_metrics(rng, class_id):
+    class_data = Mean_inv_Cov_Data(class_id)
+    for index, dim in enumerate(_LAYER_DIMS):
+        class_data.add(index, rng.normal(size=dim), np.eye(dim, dtype=np.float32))
+    return VectorMetrics({class_id: class_data})
+
+
+def run_hot_loop(profiler, frames, rng):
+    """
+    モデルを使わずに、フレームごとのホットループと同じ処理を合成データで繰り返す
+    """
+    frame = rng.integers(0, 255, size=(480, 640, 3), dtype=np.uint8)
+    preprocessor = Preprocessor(224, 224, np.float32)
+    metric = _synthetic_metrics(rng, "Head")
+    layer_outputs = [[rng.normal(size=dim).astype(np.float32)] for dim in _LAYER_DIMS]
+    encoder = WireEncoder()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = ResultStore(directory, total_budget_bytes=1024 * 1024)
+        for frame_id in range(frames):
+            with profiler.stage("anomaly.preprocess"):
+                crop = frame[100:300, 200:360]
+                preprocessor.process(crop, is_normalizing=False)
+            with profiler.stage("metrics"):
+                distances = metric.distances("Head", layer_outputs)
+                angle_diff = metric.angle_difference_sum("Head", layer_outputs)
+            results = [
+                {
+                    "class_id": 0,
+                    "class_label": "Head",
+                    "score": 0.9,
+                    "box": {"x1": 200, "y1": 100, "x2": 360, "y2": 300},
+                    "anomaly_distances": float(distances),
+                    "angle_diff": float(angle_diff),
+                }
+            ]
+            with profiler.stage("result_store"):
+                store.append(results, ts=float(frame_id))
+            with profiler.stage("wire_format"):
+                encoder.encode(frame_id, float(frame_id), results)
+            profiler.end_frame()
+        store.close()
+
+
+def profile_hot_loop(frames, warmup_frames):
+    """
+    run_hot_loop を frames フレーム実行し、ステージごとの集計を返す
+    """
+    profiler = AllocationProfiler(
+        enabled=True,
+        snapshot_interval=0,
+        snapshot_dir=tempfile.gettempdir(),
+        warmup_frames=warmup_frames,
+    ).start()
+    try:
+        run_hot_loop(profiler, frames, np.random.default_rng(0))
+        return profiler.report()
+    finally:
+        profiler.stop()
+
+
+def main(frames):
+    system_config = SystemConfigs()
+    report = profile_hot_loop(frames, system_config.allocation_warmup_frames)
+
+    for name, stats in sorted(report.items()):
+        print(
+            f"{name:<20} allocated {stats['allocated_bytes_per_frame']:10.0f} B/frame  "
+            f"retained {stats['retained_bytes_per_frame']:8.1f} B/frame  "
+            f"blocks {stats['blocks_per_frame']:6.2f}/frame"
+        )
+    try:
+        AllocationBudget(system_config.allocation_budget).check(report)
+    except AllocationBudgetExceeded as e:
+        custom_logger.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fail when the steady-state hot loop exceeds its allocation budget."
+    )
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+
+    sys.exit(main(args.frames))
@@ -0,0 +1,35 @@
+import contextlib
+
+from profiling.allocation import allocation_profiler
+from profiling.tracing import tracer
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ("allocation", "span")
+
+    def __init__(self, name, args):
+        self.allocation = allocation_profiler.stage(name)
+        self.span = tracer.span(name, **args)
+
+    def __enter__(self):
+        self.allocation.__enter__()
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.__exit__(exc_type, exc_value, traceback)
+        self.allocation.__exit__(exc_type, exc_value, traceback)
+        return False
+
+
+def stage(name, **args):
+    """
+    パイプラインのステージを割り当てプロファイラとトレーサの両方で計測する
+
+    どちらも無効なフレームでは共有の nullcontext を返すだけなので、ほぼコストがかからない
+    """
+    if not allocation_profiler.enabled and tracer.current_frame() is None:
+        return _NULL_CONTEXT
+    return _Stage(name, args)
@@ -0,0 +1,209 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+from logger.custom_logger import custom_logger
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "frame_id", "args", "start")
+
+    def __init__(self, tracer, name, frame_id, args):
+        self.tracer = tracer
+        self.name = name
+        self.frame_id = frame_id
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        args = {"frame_id": self.frame_id}
+        if self.args:
+            args.update(self.args)
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        self.tracer._add_event(self.name, self.start, end, args)
+        return False
+
+
+class Tracer:
+    """
+    サンプリングしたフレームについて各ステージの開始・終了時刻を記録し、
+    Chrome trace event 形式 (JSON 配列) で書き出す。Perfetto でそのまま開ける
+
+    begin_frame() を呼んだスレッドでは、以降の span() に frame_id が付与される。
+    別スレッドで処理する場合は bind_frame() で frame_id を引き継ぐ。
+    子プロセスでは child_settings() で構成したトレーサが別ファイルに書き出す。
+    時刻の基準 (origin_ns) を共有するため、ファイルを結合すれば同じ時間軸に並ぶ
+    """
+
+    def __init__(
+        self,
+        enabled=False,
+        sample_rate=0.01,
+        output_path="output/trace.json",
+        process_name="edge-anomaly",
+        origin_ns=None,
+    ):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.output_path = output_path
+        self.process_name = process_name
+        # perf_counter_ns は Linux ではプロセス間で共通の単調時計なので基準を共有できる
+        self.origin_ns = time.perf_counter_ns() if origin_ns is None else origin_ns
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+        self._num_events = 0
+        self._known_threads = set()
+        self._pid = os.getpid()
+
+    def configure(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise AttributeError(f"Unknown tracer option: {key}")
+            setattr(self, key, value)
+        return self
+
+    def child_settings(self, name):
+        """
+        子プロセスで同じ設定のトレーサを configure() するための引数を返す。
+        出力先は name ごとに分ける
+        """
+        root, ext = os.path.splitext(self.output_path)
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "output_path": f"{root}_{name}{ext}",
+            "process_name": name,
+            "origin_ns": self.origin_ns,
+        }
+
+    def start(self):
+        if not self.enabled:
+            return self
+        directory = os.path.dirname(self.output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.output_path, "w", encoding="utf-8")
+        self._file.write("[\n")
+        self._pid = os.getpid()
+        self._write(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self._pid,
+                "args": {"name": self.process_name},
+            }
+        )
+        custom_logger.info(
+            f"frame tracing started / sample rate {self.sample_rate} / "
+            f"output {self.output_path}"
+        )
+        return self
+
+    def stop(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+        custom_logger.info(
+            f"frame tracing stopped / events {self._num_events} / "
+            f"output {self.output_path}"
+        )
+
+    def _should_sample(self, frame_id):
+        if self.sample_rate >= 1.0:
+            return True
+        # 乱数を使わず、frame_id に対して一定間隔で決定的にサンプリングする
+        return int((frame_id + 1) * self.sample_rate) > int(frame_id * self.sample_rate)
+
+    def begin_frame(self, frame_id):
+        if not self.enabled or self._file is None:
+            self._local.frame_id = None
+            return False
+        sampled = self._should_sample(frame_id)
+        self._local.frame_id = frame_id if sampled else None
+        return sampled
+
+    def end_frame(self):
+        self._local.frame_id = None
+
+    def current_frame(self):
+        return getattr(self._local, "frame_id", None)
+
+    @contextlib.contextmanager
+    def bind_frame(self, frame_id):
+        previous = self.current_frame()
+        self._local.frame_id = frame_id
+        try:
+            yield
+        finally:
+            self._local.frame_id = previous
+
+    def wrap(self, name, func):
+        """
+        呼び出し元スレッドの frame_id を引き継ぎ、別スレッドで func を span 付きで実行する
+        callable を返す。サンプリング対象外のフレームでは func をそのまま返す
+        """
+        frame_id = self.current_frame()
+        if frame_id is None:
+            return func
+
+        def run(*args, **kwargs):
+            with self.bind_frame(frame_id), self.span(name):
+                return func(*args, **kwargs)
+
+        return run
+
+    def span(self, name, **args):
+        frame_id = getattr(self._local, "frame_id", None)
+        if frame_id is None:
+            return contextlib.nullcontext()
+        return _Span(self, name, frame_id, args)
+
+    def _write(self, event):
+        if self._num_events:
+            self._file.write(",\n")
+        self._file.write(json.dumps(event, separators=(",", ":")))
+        self._num_events += 1
+
+    def _add_event(self, name, start_ns, end_ns, args):
+        thread = threading.current_thread()
+        tid = threading.get_native_id()
+        with self._lock:
+            if self._file is None:
+                return
+            if tid not in self._known_threads:
+                self._known_threads.add(tid)
+                self._write(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self._pid,
+                        "tid": tid,
+                        "args": {"name": thread.name},
+                    }
+                )
+            self._write(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start_ns - self.origin_ns) / 1000.0,
+                    "dur": (end_ns - start_ns) / 1000.0,
+                    "pid": self._pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+
+
+tracer = Tracer()
@@ -0,0 +1,135 @@
+import contextlib
+import os
+import resource
+import threading
+
+import cv2
+
+from logger.custom_logger import custom_logger
+
+ROLES = ("capture", "detector", "anomaly", "io")
+
+
+def is_supported():
+    return hasattr(os, "sched_setaffinity") and hasattr(os, "sched_getaffinity")
+
+
+class RolePolicy:
+    def __init__(self, cpus=None, nice=None):
+        self.cpus = set(cpus) if cpus else None
+        self.nice = nice
+
+    def __repr__(self):
+        cpus = sorted(self.cpus) if self.cpus else None
+        return f"RolePolicy(cpus={cpus}, nice={self.nice})"
+
+
+class SchedulingPolicy:
+    """
+    パイプラインの役割 (capture / detector / anomaly / io) ごとに CPU コアと nice 値を割り当てる
+
+    Linux では sched_setaffinity(0, ...) は呼び出したスレッドのみに作用し、
+    新しく生成されたスレッドは生成元スレッドのアフィニティを引き継ぐ。
+    そのため TFLite のワーカースレッドは、インタプリタの構築とウォームアップを
+    pinned() の中で行うことで目的のコアに固定される
+    """
+
+    def __init__(self, roles=None, opencv_threads=None, enabled=True, name="default"):
+        self.enabled = enabled and is_supported()
+        self.name = name
+        self.opencv_threads = opencv_threads
+        self.roles = {}
+        available = os.sched_getaffinity(0) if is_supported() else set()
+        for role, role_config in (roles or {}).items():
+            if role not in ROLES:
+                raise ValueError(f"Unknown scheduling role: {role}")
+            policy = RolePolicy(role_config.get("cpus"), role_config.get("nice"))
+            if policy.cpus is not None:
+                missing = policy.cpus - available
+                if missing:
+                    custom_logger.warning(
+                        f"scheduling role {role} requests unavailable cpus {sorted(missing)}"
+                    )
+                policy.cpus = (policy.cpus & available) or None
+            self.roles[role] = policy
+
+        if enabled and not is_supported():
+            custom_logger.warning("cpu affinity is not supported on this platform")
+
+    @classmethod
+    def from_config(cls, system_config, layout=None, enabled=None):
+        layout = layout or system_config.scheduling_layout
+        layouts = system_config.scheduling_layouts
+        if layout not in layouts:
+            raise KeyError(f"Scheduling layout {layout} not found in system_configs.json")
+        layout_config = layouts[layout]
+        return cls(
+            roles=layout_config.get("roles", {}),
+            opencv_threads=layout_config.get("opencv_threads"),
+            enabled=system_config.scheduling_enabled if enabled is None else enabled,
+            name=layout,
+        )
+
+    def apply_global(self):
+        if not self.enabled or self.opencv_threads is None:
+            return
+        cv2.setNumThreads(self.opencv_threads)
+        custom_logger.info(f"opencv threads set to {self.opencv_threads}")
+
+    def _set_nice(self, nice):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except PermissionError:
+            custom_logger.warning(f"permission denied while setting nice {nice}")
+
+    @staticmethod
+    def _can_set_nice(nice):
+        # 権限がなければ nice 値は上げられても下げられない。RLIMIT_NICE の範囲内なら下げられる
+        if os.geteuid() == 0:
+            return True
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NICE)
+        return soft_limit == resource.RLIM_INFINITY or nice >= 20 - soft_limit
+
+    def apply(self, role, nice=True):
+        """
+        呼び出し元スレッドに role の設定を適用する。nice=False ならアフィニティのみ
+        """
+        policy = self.roles.get(role)
+        if not self.enabled or policy is None:
+            return
+        if policy.cpus is not None:
+            os.sched_setaffinity(0, policy.cpus)
+        if nice and policy.nice is not None:
+            self._set_nice(policy.nice)
+        custom_logger.info(
+            f"scheduling role {role} applied to thread "
+            f"{threading.current_thread().name} / {policy}"
+        )
+
+    @contextlib.contextmanager
+    def pinned(self, role):
+        """
+        ブロック内でのみ role を適用し、終了時に元のアフィニティと nice 値に戻す
+
+        元の nice 値に戻せない (権限がない) 場合、nice 値は変更せずアフィニティのみ適用する
+        """
+        policy = self.roles.get(role)
+        if not self.enabled or policy is None:
+            yield
+            return
+        previous_cpus = os.sched_getaffinity(0)
+        previous_nice = os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+        change_nice = policy.nice is not None and policy.nice != previous_nice
+        if change_nice and not self._can_set_nice(previous_nice):
+            custom_logger.warning(
+                f"scheduling role {role} keeps nice {previous_nice} "
+                f"because it could not be restored"
+            )
+            change_nice = False
+        self.apply(role, nice=change_nice)
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous_cpus)
+            if change_nice:
+                self._set_nice(previous_nice)
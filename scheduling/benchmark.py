@@ -0,0 +1,132 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config_manager.config import LabelConfigs, SystemConfigs, TFliteConfig
+from detector.anomaly import Anomaly
+from detector.detector import Detector
+from logger.custom_logger import custom_logger
+from scheduling.affinity import SchedulingPolicy
+
+_RESULT_PREFIX = "BENCHMARK_RESULT "
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_layout(layout, frames, image_path=None, warmup_frames=10):
+    """
+    1 つのレイアウトで検出と異常検知を frames 回実行し、フレームごとの遅延を集計する
+
+    TFLite のワーカースレッドは生成時のアフィニティを引き継ぐため、
+    レイアウトごとに新しいプロセスで実行する必要がある
+    """
+    system_config = SystemConfigs()
+    policy = SchedulingPolicy.from_config(system_config, layout, enabled=True)
+    policy.apply_global()
+
+    with policy.pinned("detector"):
+        detector = Detector(label_map=LabelConfigs().label_map)
+        detector.model.warm_up(system_config.warmup_runs)
+    with policy.pinned("anomaly"):
+        anomaly = Anomaly()
+        anomaly.model.warm_up(system_config.warmup_runs)
+    policy.apply("capture")
+
+    if image_path:
+        frame = cv2.imread(image_path)
+    else:
+        frame = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    score_threshold = TFliteConfig(section_name="detector").score_threshold
+
+    latencies = []
+    for index in range(warmup_frames + frames):
+        start_time = time.perf_counter()
+        results = detector.detect(frame).get_results()
+        if results is not None:
+            for i in range(results["num"]):
+                if results["scores"][i] < score_threshold:
+                    continue
+                y1, x1, y2, x2 = results["boxes"][i]
+                crop = frame[max(y1, 0) : y2, max(x1, 0) : x2]
+                if crop.size:
+                    anomaly.detect(crop)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000.0
+        if index >= warmup_frames:
+            latencies.append(elapsed_ms)
+
+    return {
+        "layout": layout,
+        "frames": frames,
+        "mean_ms": statistics.fmean(latencies),
+        "stdev_ms": statistics.pstdev(latencies),
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "p99_ms": _percentile(latencies, 99),
+    }
+
+
+def compare_layouts(layouts, frames, image_path=None):
+    results = []
+    for layout in layouts:
+        command = [
+            sys.executable,
+            "-m",
+            "scheduling.benchmark",
+            "--run-layout",
+            layout,
+            "--frames",
+            str(frames),
+        ]
+        if image_path:
+            command += ["--image", image_path]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        lines = [
+            line
+            for line in completed.stdout.splitlines()
+            if line.startswith(_RESULT_PREFIX)
+        ]
+        if completed.returncode != 0 or not lines:
+            custom_logger.error(f"benchmark for layout {layout} failed:\n{completed.stderr}")
+            continue
+        results.append(json.loads(lines[-1][len(_RESULT_PREFIX) :]))
+    return results
+
+
+def print_table(results):
+    print(f"{'layout':<16}{'mean':>10}{'stdev':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for r in sorted(results, key=lambda r: r["p95_ms"]):
+        print(
+            f"{r['layout']:<16}{r['mean_ms']:>10.2f}{r['stdev_ms']:>10.2f}"
+            f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare per-frame latency across scheduling layouts."
+    )
+    parser.add_argument(
+        "--layouts",
+        nargs="*",
+        default=None,
+        help="Layout names to compare (default: all layouts in system_configs.json).",
+    )
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--image", default=None, help="Frame image to run on.")
+    parser.add_argument("--run-layout", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_layout:
+        result = run_layout(args.run_layout, args.frames, args.image)
+        print(_RESULT_PREFIX + json.dumps(result))
+    else:
+        layouts = args.layouts or list(SystemConfigs().scheduling_layouts)
+        print_table(compare_layouts(layouts, args.frames, args.image))
@@ -0,0 +1,120 @@
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger.custom_logger import custom_logger
+from sender.wire_format import (
+    BINARY_CONTENT_TYPE,
+    JSON_CONTENT_TYPE,
+    WireDecoder,
+    WireFormatError,
+    decode_json,
+    decompress,
+)
+
+
+class _ReceiverRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        receiver = self.server.receiver
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        content_encoding = self.headers.get("Content-Encoding")
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if content_type not in (JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE):
+            self._reply(415)
+            return
+
+        try:
+            payload = decompress(body, content_encoding)
+            if content_type == BINARY_CONTENT_TYPE:
+                decoder = receiver.decoder_for(self.client_address[0])
+                frame_id, ts, results = decoder.decode(payload)
+            else:
+                frame_id, ts, results = decode_json(payload)
+        except WireFormatError:
+            custom_logger.exception("failed to decode payload")
+            self._reply(409)
+            return
+        except Exception:
+            custom_logger.exception("failed to decode payload")
+            self._reply(400)
+            return
+
+        receiver.record(content_type, len(body), frame_id, ts, results)
+        self._reply(200)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        custom_logger.debug(f"receiver {self.address_string()} {format % args}")
+
+
+class ResultReceiver:
+    """
+    Sender の送信内容をデコードして受け取るローカル確認用サーバー
+    """
+
+    def __init__(self, host="127.0.0.1", port=8000):
+        self.host = host
+        self.port = port
+        self.received = []
+        self.bytes_by_content_type = {}
+        self._decoders = {}
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    def decoder_for(self, client):
+        with self._lock:
+            return self._decoders.setdefault(client, WireDecoder())
+
+    def record(self, content_type, num_bytes, frame_id, ts, results):
+        with self._lock:
+            self.received.append((frame_id, ts, results))
+            self.bytes_by_content_type[content_type] = (
+                self.bytes_by_content_type.get(content_type, 0) + num_bytes
+            )
+        custom_logger.info(
+            f"received frame {frame_id} / {content_type} / {num_bytes} bytes / "
+            f"detections {len(results)}"
+        )
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _ReceiverRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.receiver = self
+        # port=0 の場合は OS が割り当てたポートを使う
+        self.port = self._httpd.server_address[1]
+        threading.Thread(
+            target=self._httpd.serve_forever, name="result-receiver", daemon=True
+        ).start()
+        custom_logger.info(f"result receiver listening on http://{self.host}:{self.port}/")
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local server that decodes and logs results posted by Sender."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    receiver = ResultReceiver(args.host, args.port).start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        receiver.stop()
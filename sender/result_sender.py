@@ -1,16 +1,150 @@
+import queue
+import threading
+
 import requests
 
-from logger.custom_logger import dp_logger
+from logger.custom_logger import custom_logger
+from profiling.tracing import tracer
+from sender.wire_format import (
+    BINARY_CONTENT_TYPE,
+    JSON_CONTENT_TYPE,
+    WireEncoder,
+    check_encoding,
+    compress,
+    encode_json,
+)
 
 
 class Sender:
-    def __init__(self, server_url, headers=None, auth=None, timeout=10):
-        """サーバーへのデータ送信クラスの初期化"""
+    def __init__(
+        self,
+        server_url,
+        headers=None,
+        auth=None,
+        timeout=10,
+        wire_format="json",
+        compression=None,
+        delta_boxes=True,
+        queue_size=32,
+        scheduling_policy=None,
+    ):
+        if wire_format not in ("json", "binary"):
+            raise ValueError(f"Unsupported wire format: {wire_format}")
+        # 不正な圧縮方式はフレームごとの送信時ではなく起動時に検出する
+        check_encoding(compression)
         self.server_url = server_url
         self.headers = headers or {"Content-Type": "application/json"}
         self.auth = auth
         self.timeout = timeout
-        dp_logger.info("ResultSenderの初期化が完了しました。")
+        self.wire_format = wire_format
+        self.compression = compression
+        self.encoder = WireEncoder(delta_boxes=delta_boxes)
+        self.scheduling_policy = scheduling_policy
+        # 回線が遅くてもキャプチャを止めないよう、送信は専用スレッドで行う
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self.dropped_results = 0
+        custom_logger.info(
+            f"sender initialisation is complete / wire format {wire_format} / "
+            f"compression {compression}"
+        )
+
+    def _encode_results(self, frame_id, ts, results, late=False):
+        if self.wire_format == "binary":
+            payload = self.encoder.encode(frame_id, ts, results, late=late)
+            content_type = BINARY_CONTENT_TYPE
+        else:
+            payload = encode_json(frame_id, ts, results)
+            content_type = JSON_CONTENT_TYPE
+        headers = dict(self.headers, **{"Content-Type": content_type})
+        if self.compression:
+            headers["Content-Encoding"] = self.compression
+        return compress(payload, self.compression), headers
+
+    def send_results(self, frame_id, ts, results, late=False):
+        """
+        late=True は以前のフレームから持ち越して処理した結果。JSON では各結果の "late" で区別する
+        """
+        try:
+            payload, headers = self._encode_results(frame_id, ts, results, late)
+            response = requests.post(
+                self.server_url,
+                data=payload,
+                headers=headers,
+                auth=self.auth,
+                timeout=self.timeout,
+            )
+            if response.status_code == 415 and self.wire_format != "json":
+                # 受信側がバイナリ形式に対応していなければ以降は JSON で送る
+                custom_logger.warning("server rejected binary results, falling back to json")
+                self.wire_format = "json"
+                return self.send_results(frame_id, ts, results, late)
+            response.raise_for_status()
+            custom_logger.debug(
+                f"results sent / frame {frame_id} / {len(payload)} bytes / "
+                f"status code {response.status_code}"
+            )
+            return True
+        except Exception:
+            # 受信側が差分の基準フレームを持っていない可能性があるため次はキーフレームを送る
+            self.encoder.reset()
+            custom_logger.exception("error occurred while sending results")
+            return False
+
+    def enqueue(self, frame_id, ts, results, late=False):
+        """
+        1 フレーム分の結果を送信キューに入れてすぐに戻る。キューが満杯なら最も古い結果を破棄する
+
+        破棄したフレームの次は差分の基準がないため、自動的にキーフレームで送られる
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._send_loop, name="result-sender", daemon=True
+            )
+            self._thread.start()
+        while True:
+            try:
+                self._queue.put_nowait(
+                    (tracer.current_frame(), frame_id, ts, results, late)
+                )
+                return
+            except queue.Full:
+                pass
+            try:
+                _, dropped_frame_id, _, _, _ = self._queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped_results += 1
+            custom_logger.warning(
+                f"send queue full, dropped results of frame {dropped_frame_id} / "
+                f"total dropped {self.dropped_results}"
+            )
+
+    def _send_loop(self):
+        if self.scheduling_policy is not None:
+            self.scheduling_policy.apply("io")
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            trace_frame_id, frame_id, ts, results, late = item
+            with tracer.bind_frame(trace_frame_id), tracer.span("send.post"):
+                self.send_results(frame_id, ts, results, late)
+
+    def close(self, timeout=None):
+        """
+        キューに残った結果を送り終えてから送信スレッドを止める
+        """
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            custom_logger.warning("sender did not drain its queue before closing")
+            return
+        self._thread.join(timeout)
+        self._thread = None
+        custom_logger.info(f"sender closed / dropped results {self.dropped_results}")
 
     def send(self, data):
         try:
@@ -19,13 +153,13 @@ class Sender:
                 json=data,
                 headers=self.headers,
                 auth=self.auth,
-                timeout=self.timeout,  # タイムアウトを適宜設定
+                timeout=self.timeout,
             )
-            response.raise_for_status()  # HTTPエラーをチェック
-            dp_logger.info(
-                f"データの送信に成功しました。ステータスコード: {response.status_code}"
+            response.raise_for_status()
+            custom_logger.info(
+                f"data transmission was successful status code: {response.status_code}"
             )
             return True
-        except requests.exceptions.RequestException as e:
-            dp_logger.exception(f"データの送信中にエラーが発生しました: {e}")
+        except Exception:
+            custom_logger.exception("error occurred while sending data")
             return False
@@ -0,0 +1,222 @@
+import gzip
+import json
+import struct
+import zlib
+
+import numpy as np
+
+JSON_CONTENT_TYPE = "application/json"
+BINARY_CONTENT_TYPE = "application/x-edge-results"
+
+_MAGIC = b"EDR1"
+_VERSION = 1
+_FLAG_DELTA_BOXES = 0x01
+# 以前のフレームから持ち越して処理した結果。常にキーフレームで送り、差分の基準にもしない
+_FLAG_LATE = 0x02
+# magic, version, flags, frame_id, base_frame_id, ts, num detections, num labels
+_HEADER = struct.Struct("<4sBBIIdHH")
+_SCORE_SCALE = 65535.0
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+_ENCODINGS = (None, "", "identity", "gzip", "deflate")
+
+
+def check_encoding(encoding):
+    if encoding not in _ENCODINGS:
+        raise WireFormatError(f"Unsupported content encoding: {encoding}")
+
+
+def compress(payload, encoding):
+    if encoding in (None, "", "identity"):
+        return payload
+    if encoding == "gzip":
+        return gzip.compress(payload)
+    if encoding == "deflate":
+        return zlib.compress(payload)
+    raise WireFormatError(f"Unsupported content encoding: {encoding}")
+
+
+def decompress(payload, encoding):
+    if encoding in (None, "", "identity"):
+        return payload
+    if encoding == "gzip":
+        return gzip.decompress(payload)
+    if encoding == "deflate":
+        return zlib.decompress(payload)
+    raise WireFormatError(f"Unsupported content encoding: {encoding}")
+
+
+class WireEncoder:
+    """
+    1 フレーム分の検出結果を列指向の固定長バイナリにエンコードする
+
+    各列はリトルエンディアンの numpy 配列として連続して格納する。
+    直前のフレームと検出数・クラス ID が一致する場合は、ボックスを差分で送る。
+    差分フレームは keyframe_interval ごと、または reset() 後に必ずキーフレームに戻る。
+    late=True の結果はフレームの順序が前後するため差分の対象にしない
+    """
+
+    def __init__(self, delta_boxes=True, keyframe_interval=30):
+        self.delta_boxes = delta_boxes
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self):
+        self._prev_frame_id = None
+        self._prev_class_ids = None
+        self._prev_boxes = None
+        self._frames_since_keyframe = 0
+
+    def encode(self, frame_id, ts, results, late=False):
+        num = len(results)
+        class_ids = np.fromiter((r["class_id"] for r in results), dtype="<u2", count=num)
+        scores = np.fromiter(
+            (round(min(max(r["score"], 0.0), 1.0) * _SCORE_SCALE) for r in results),
+            dtype="<u2",
+            count=num,
+        )
+        boxes = np.array(
+            [
+                (r["box"]["x1"], r["box"]["y1"], r["box"]["x2"], r["box"]["y2"])
+                for r in results
+            ],
+            dtype="<i2",
+        ).reshape(num, 4)
+        distances = np.fromiter(
+            (r["anomaly_distances"] for r in results), dtype="<f4", count=num
+        )
+        angle_diffs = np.fromiter((r["angle_diff"] for r in results), dtype="<f4", count=num)
+
+        labels = {}
+        for r in results:
+            labels.setdefault(int(r["class_id"]), r["class_label"])
+
+        flags = 0
+        base_frame_id = 0
+        box_column = boxes
+        if late:
+            flags |= _FLAG_LATE
+        elif self._can_delta(frame_id, class_ids):
+            flags |= _FLAG_DELTA_BOXES
+            base_frame_id = self._prev_frame_id
+            box_column = boxes - self._prev_boxes
+            self._frames_since_keyframe += 1
+        else:
+            self._frames_since_keyframe = 0
+
+        if not late:
+            self._prev_frame_id = frame_id
+            self._prev_class_ids = class_ids
+            self._prev_boxes = boxes
+
+        chunks = [
+            _HEADER.pack(
+                _MAGIC, _VERSION, flags, frame_id, base_frame_id, ts, num, len(labels)
+            )
+        ]
+        for class_id, label in labels.items():
+            encoded = label.encode("utf-8")
+            chunks.append(struct.pack("<HB", class_id, len(encoded)))
+            chunks.append(encoded)
+        for column in (class_ids, scores, box_column, distances, angle_diffs):
+            chunks.append(column.tobytes())
+        return b"".join(chunks)
+
+    def _can_delta(self, frame_id, class_ids):
+        return (
+            self.delta_boxes
+            and self._prev_frame_id is not None
+            and frame_id == self._prev_frame_id + 1
+            and self._frames_since_keyframe < self.keyframe_interval
+            and np.array_equal(class_ids, self._prev_class_ids)
+        )
+
+
+class WireDecoder:
+    """
+    WireEncoder の出力を検出結果の dict のリストに戻す。持ち越し分の結果には "late": True を付ける
+    """
+
+    def __init__(self):
+        self._prev_frame_id = None
+        self._prev_boxes = None
+
+    def decode(self, payload):
+        if len(payload) < _HEADER.size:
+            raise WireFormatError("Payload is shorter than the header")
+        (
+            magic,
+            version,
+            flags,
+            frame_id,
+            base_frame_id,
+            ts,
+            num,
+            num_labels,
+        ) = _HEADER.unpack_from(payload, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise WireFormatError(f"Unknown payload format {magic!r} v{version}")
+
+        offset = _HEADER.size
+        labels = {}
+        for _ in range(num_labels):
+            class_id, length = struct.unpack_from("<HB", payload, offset)
+            offset += 3
+            labels[class_id] = payload[offset : offset + length].decode("utf-8")
+            offset += length
+
+        def column(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        class_ids = column("<u2", num)
+        scores = column("<u2", num).astype(np.float32) / _SCORE_SCALE
+        boxes = column("<i2", num * 4).reshape(num, 4)
+        distances = column("<f4", num)
+        angle_diffs = column("<f4", num)
+
+        if flags & _FLAG_DELTA_BOXES:
+            if self._prev_frame_id != base_frame_id or self._prev_boxes is None:
+                raise WireFormatError(
+                    f"Delta frame {frame_id} references unknown base {base_frame_id}"
+                )
+            boxes = boxes + self._prev_boxes
+        late = bool(flags & _FLAG_LATE)
+        if not late:
+            self._prev_frame_id = frame_id
+            self._prev_boxes = boxes
+
+        results = []
+        for i in range(num):
+            x1, y1, x2, y2 = (int(v) for v in boxes[i])
+            result = {
+                "class_id": int(class_ids[i]),
+                "class_label": labels.get(int(class_ids[i]), ""),
+                "score": float(scores[i]),
+                "box": {"x1": x1, "y1": y1, "x2": x2, "y2": y2},
+                "anomaly_distances": float(distances[i]),
+                "angle_diff": float(angle_diffs[i]),
+            }
+            if late:
+                result["late"] = True
+            results.append(result)
+        return frame_id, ts, results
+
+
+def encode_json(frame_id, ts, results):
+    return json.dumps(
+        {"frame_id": frame_id, "ts": ts, "results": results},
+        separators=(",", ":"),
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+
+def decode_json(payload):
+    data = json.loads(payload)
+    return data["frame_id"], data["ts"], data["results"]
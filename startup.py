@@ -0,0 +1,120 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from calculator.scorer_router import build_metric
+from config_manager.config import SystemConfigs
+from detector.anomaly import Anomaly
+from detector.detector import Detector
+from logger.custom_logger import custom_logger
+from scheduling.affinity import SchedulingPolicy
+
+
+class StartupTimer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+        self.steps = {}
+
+    def measure(self, step_name, func, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                self.steps[step_name] = elapsed
+            custom_logger.debug(f"startup step {step_name} took {elapsed:.3f} seconds")
+
+    def total(self):
+        return time.perf_counter() - self._started_at
+
+    def report(self):
+        total = self.total()
+        lines = [f"startup finished in {total:.3f} seconds"]
+        for step_name, elapsed in sorted(self.steps.items(), key=lambda x: -x[1]):
+            lines.append(f"  {step_name:<24} {elapsed:8.3f} s")
+        custom_logger.info("\n".join(lines))
+        return {"total": total, "steps": dict(self.steps)}
+
+
+class StartupOrchestrator:
+    """
+    検出モデル・異常検知モデル・統計データの読み込みを並列に行い、
+    ライブフレームの前にウォームアップ推論を済ませる
+    """
+
+    def __init__(
+        self,
+        label_map,
+        mean_inv_cov_path,
+        system_config=None,
+        scheduling_policy=None,
+    ):
+        self.label_map = label_map
+        self.mean_inv_cov_path = mean_inv_cov_path
+        self.system_config = system_config or SystemConfigs()
+        self.scheduling_policy = scheduling_policy or SchedulingPolicy.from_config(
+            self.system_config
+        )
+        self.timer = StartupTimer()
+
+    def _build_detector(self):
+        # ウォームアップで生成される TFLite のワーカースレッドにもアフィニティを引き継がせる
+        with self.scheduling_policy.pinned("detector"):
+            detector = self.timer.measure("load_detector", Detector, self.label_map)
+            self.timer.measure(
+                "warm_up_detector",
+                detector.model.warm_up,
+                self.system_config.warmup_runs,
+            )
+        return detector
+
+    def _build_anomaly(self):
+        with self.scheduling_policy.pinned("anomaly"):
+            anomaly = self.timer.measure("load_anomaly", Anomaly)
+            self.timer.measure(
+                "warm_up_anomaly",
+                anomaly.model.warm_up,
+                self.system_config.warmup_runs,
+            )
+        return anomaly
+
+    def _build_metric(self):
+        # メモリ予算が設定されている場合は pinned クラスのみ先に読み込み、残りは初回参照時に読む
+        with self.scheduling_policy.pinned("io"):
+            return self.timer.measure(
+                "load_statistics",
+                build_metric,
+                self.system_config,
+                self.mean_inv_cov_path,
+            )
+
+    def build(self, components=("detector", "anomaly", "metric")):
+        """
+        指定した構成要素を並列に構築し、名前をキーとする dict で返す
+        """
+        builders = {
+            "detector": self._build_detector,
+            "anomaly": self._build_anomaly,
+            "metric": self._build_metric,
+        }
+        with ThreadPoolExecutor(
+            max_workers=self.system_config.startup_max_workers,
+            thread_name_prefix="startup",
+        ) as executor:
+            futures = {
+                component: executor.submit(builders[component])
+                for component in components
+            }
+            built = {component: future.result() for component, future in futures.items()}
+
+        self.timing_report = self.timer.report()
+        return built
+
+    def run(self):
+        """
+        戻り値は (detector, anomaly, metric)。いずれかの読み込みに失敗した場合は例外を送出する
+        """
+        built = self.build()
+        return built["detector"], built["anomaly"], built["metric"]
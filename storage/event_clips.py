@@ -0,0 +1,262 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+
+from logger.custom_logger import custom_logger
+from profiling.tracing import tracer
+
+_MAX_TRIGGERS_PER_CLIP = 100
+
+
+class FrameRingBuffer:
+    """
+    JPEG 圧縮した直近のフレームを、max_age_seconds とメモリ予算の範囲で保持する
+    """
+
+    def __init__(self, memory_budget_bytes, max_age_seconds):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_age_seconds = max_age_seconds
+        self.nbytes = 0
+        self._frames = deque()
+        self._budget_warned = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, frame_name, ts, data):
+        self._frames.append((frame_name, ts, data))
+        self.nbytes += len(data)
+        while self._frames and ts - self._frames[0][1] > self.max_age_seconds:
+            self._evict()
+        while len(self._frames) > 1 and self.nbytes > self.memory_budget_bytes:
+            if not self._budget_warned:
+                custom_logger.warning(
+                    f"frame ring buffer budget {self.memory_budget_bytes} bytes "
+                    f"holds only {ts - self._frames[0][1]:.1f} s of pre-roll"
+                )
+                self._budget_warned = True
+            self._evict()
+
+    def _evict(self):
+        _, _, data = self._frames.popleft()
+        self.nbytes -= len(data)
+
+    def drain(self):
+        frames = list(self._frames)
+        self._frames.clear()
+        self.nbytes = 0
+        return frames
+
+
+class EventThresholds:
+    """
+    クラスごとの距離・角度差の閾値。classes に無いクラスや項目は default を使い、None は判定しない
+    """
+
+    def __init__(self, default=None, classes=None):
+        self.default = default or {}
+        self.classes = classes or {}
+
+    def _get(self, class_label, key):
+        return self.classes.get(class_label, {}).get(key, self.default.get(key))
+
+    def exceeded(self, result):
+        distance_threshold = self._get(result["class_label"], "distance")
+        angle_threshold = self._get(result["class_label"], "angle")
+        if distance_threshold is not None and result["anomaly_distances"] > distance_threshold:
+            return True
+        return angle_threshold is not None and result["angle_diff"] > angle_threshold
+
+
+class _Clip:
+    def __init__(self, directory, frame_id, ts):
+        self.directory = directory
+        self.trigger_frame_id = frame_id
+        self.trigger_ts = ts
+        self.last_trigger_ts = ts
+        self.first_ts = ts
+        self.last_ts = ts
+        self.num_frames = 0
+        self.num_triggers = 0
+        self.triggers = []
+
+
+class EventClipRecorder:
+    """
+    フレームをリングバッファに保持し、異常イベントが起きたときだけ前後のフレームをクリップとして保存する
+
+    閾値を超える結果が min_trigger_frames フレーム続くとクリップを開始し、
+    pre_roll_seconds 分のバッファを書き出す。以降は閾値超えが post_roll_seconds 途切れるまで
+    同じクリップに追記し、終了後 cooldown_seconds は新しいクリップを開始しない
+    """
+
+    def __init__(
+        self,
+        directory,
+        thresholds,
+        pre_roll_seconds=3.0,
+        post_roll_seconds=3.0,
+        min_trigger_frames=1,
+        cooldown_seconds=0.0,
+        memory_budget_bytes=32 * 1024 * 1024,
+        jpeg_quality=80,
+        scheduling_policy=None,
+    ):
+        self.directory = directory
+        self.thresholds = thresholds
+        self.post_roll_seconds = post_roll_seconds
+        self.min_trigger_frames = min_trigger_frames
+        self.cooldown_seconds = cooldown_seconds
+        self.jpeg_quality = jpeg_quality
+        self.ring = FrameRingBuffer(memory_budget_bytes, pre_roll_seconds)
+        os.makedirs(directory, exist_ok=True)
+
+        # 書き込みスレッドには生成元 (キャプチャ) のアフィニティと nice 値ではなく io を適用する
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            initializer=scheduling_policy.apply if scheduling_policy else None,
+            initargs=("io",),
+        )
+        self._clip = None
+        self._consecutive = 0
+        # min_trigger_frames に達する前の閾値超えも、クリップ開始時にまとめて記録する
+        self._pending_triggers = []
+        self._cooldown_until = float("-inf")
+        self.num_frames = 0
+        self.num_saved_frames = 0
+        self.num_clips = 0
+
+    @classmethod
+    def from_config(cls, system_config, directory, scheduling_policy=None):
+        return cls(
+            directory=directory,
+            thresholds=EventThresholds(
+                system_config.event_clip_default_thresholds,
+                system_config.event_clip_class_thresholds,
+            ),
+            pre_roll_seconds=system_config.event_clip_pre_roll_seconds,
+            post_roll_seconds=system_config.event_clip_post_roll_seconds,
+            min_trigger_frames=system_config.event_clip_min_trigger_frames,
+            cooldown_seconds=system_config.event_clip_cooldown_seconds,
+            memory_budget_bytes=system_config.event_clip_memory_budget_bytes,
+            jpeg_quality=system_config.event_clip_jpeg_quality,
+            scheduling_policy=scheduling_policy,
+        )
+
+    def add(self, frame, frame_id, ts, frame_name, results, late=None):
+        """
+        1 フレーム分の画像と結果を渡す。保存が必要かどうかはここで判定する
+
+        late には以前のフレームから持ち越して処理した結果 (frame_id と index を含む) を渡す。
+        閾値を超えていればこのフレームのトリガーとして扱い、元のフレーム ID のまま記録する
+        """
+        self.num_frames += 1
+        ok, buffer = cv2.imencode(
+            ".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        )
+        if not ok:
+            custom_logger.warning(f"failed to encode frame {frame_name}")
+            return
+        data = buffer.tobytes()
+
+        triggers = [
+            dict(result, frame_id=frame_id, index=index)
+            for index, result in enumerate(results)
+            if self.thresholds.exceeded(result)
+        ]
+        triggers.extend(
+            result for result in late or () if self.thresholds.exceeded(result)
+        )
+        self._consecutive = self._consecutive + 1 if triggers else 0
+
+        if self._clip is None:
+            self.ring.push(frame_name, ts, data)
+            self._pending_triggers = self._pending_triggers + triggers if triggers else []
+            if self._consecutive >= self.min_trigger_frames and ts >= self._cooldown_until:
+                self._open_clip(frame_id, ts)
+                self._add_triggers(self._pending_triggers, ts)
+                self._pending_triggers = []
+            return
+
+        self._write_frame(frame_name, ts, data)
+        if triggers:
+            self._add_triggers(triggers, ts)
+        elif ts - self._clip.last_trigger_ts >= self.post_roll_seconds:
+            self._close_clip()
+            self._cooldown_until = ts + self.cooldown_seconds
+
+    def _open_clip(self, frame_id, ts):
+        directory = os.path.join(
+            self.directory,
+            f"{datetime.fromtimestamp(ts).strftime('%Y%m%d_%H%M%S')}_{frame_id:012d}",
+        )
+        os.makedirs(directory, exist_ok=True)
+        self._clip = _Clip(directory, frame_id, ts)
+        # トリガーとなったフレームを含むリングバッファの内容をプリロールとして書き出す
+        pre_roll = self.ring.drain()
+        self._clip.first_ts = pre_roll[0][1]
+        for buffered_name, buffered_ts, data in pre_roll:
+            self._write_frame(buffered_name, buffered_ts, data)
+        self.num_clips += 1
+        custom_logger.info(
+            f"anomaly event at frame {frame_id}, saving clip to {directory} "
+            f"with {len(pre_roll)} pre-roll frames"
+        )
+
+    def _add_triggers(self, triggers, ts):
+        self._clip.last_trigger_ts = ts
+        self._clip.num_triggers += len(triggers)
+        room = _MAX_TRIGGERS_PER_CLIP - len(self._clip.triggers)
+        self._clip.triggers.extend(triggers[:room])
+
+    def _write_frame(self, frame_name, ts, data):
+        self._clip.num_frames += 1
+        self._clip.last_ts = ts
+        self.num_saved_frames += 1
+        file_path = os.path.join(self._clip.directory, f"frame_{frame_name}.jpg")
+        self._executor.submit(
+            tracer.wrap("clip.write", self._write_file), file_path, data
+        )
+
+    @staticmethod
+    def _write_file(file_path, data):
+        try:
+            with open(file_path, "wb") as f:
+                f.write(data)
+        except Exception:
+            custom_logger.exception(f"failed to write {file_path}")
+
+    def _close_clip(self):
+        clip = self._clip
+        self._clip = None
+        summary = {
+            "trigger_frame_id": clip.trigger_frame_id,
+            "trigger_ts": clip.trigger_ts,
+            "start_ts": clip.first_ts,
+            "end_ts": clip.last_ts,
+            "num_frames": clip.num_frames,
+            "num_triggers": clip.num_triggers,
+            "triggers": clip.triggers,
+        }
+        self._executor.submit(
+            self._write_file,
+            os.path.join(clip.directory, "event.json"),
+            json.dumps(summary, ensure_ascii=False, indent=2).encode("utf-8"),
+        )
+        custom_logger.info(
+            f"event clip closed: {clip.directory} / {clip.num_frames} frames / "
+            f"{clip.last_ts - clip.first_ts:.1f} s"
+        )
+
+    def close(self):
+        if self._clip is not None:
+            self._close_clip()
+        self._executor.shutdown(wait=True)
+        custom_logger.info(
+            f"event clips: {self.num_clips} clips / saved {self.num_saved_frames} of "
+            f"{self.num_frames} frames"
+        )
@@ -0,0 +1,218 @@
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from logger.custom_logger import custom_logger
+from profiling.tracing import tracer
+
+
+class FeatureChunk:
+    """
+    アーカイブの 1 チャンク。records[i] のレイヤー出力は layers[layer_index][i]
+    """
+
+    def __init__(self, path, records, layer_indices, layers, crops=None):
+        self.path = path
+        self.records = records
+        self.layer_indices = layer_indices
+        self.layers = layers
+        self.crops = crops
+
+    def __len__(self):
+        return len(self.records)
+
+    def layer_batches(self, rows=None):
+        return [
+            self.layers[layer_index] if rows is None else self.layers[layer_index][rows]
+            for layer_index in self.layer_indices
+        ]
+
+    def decode_crop(self, row):
+        if self.crops is None:
+            return None
+        data, offsets = self.crops
+        return cv2.imdecode(data[offsets[row] : offsets[row + 1]], cv2.IMREAD_COLOR)
+
+
+def _next_chunk_index(directory):
+    indexes = [-1]
+    for path in glob.glob(os.path.join(directory, "chunk_*.npz")):
+        number = os.path.basename(path)[len("chunk_") : -len(".npz")]
+        if number.isdigit():
+            indexes.append(int(number))
+    return max(indexes) + 1
+
+
+class FeatureRecorder:
+    """
+    異常検知に使った切り出し領域のレイヤー出力 (と任意で切り出し画像) をチャンク単位の npz に記録する
+
+    chunk_records 件たまるごとに別スレッドで圧縮・書き込みを行い、フレーム処理を止めない
+    """
+
+    def __init__(
+        self,
+        directory,
+        chunk_records=256,
+        feature_dtype="float16",
+        store_crops=False,
+        crop_jpeg_quality=90,
+        scheduling_policy=None,
+    ):
+        self.directory = directory
+        self.chunk_records = chunk_records
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.store_crops = store_crops
+        self.crop_jpeg_quality = crop_jpeg_quality
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            initializer=scheduling_policy.apply if scheduling_policy else None,
+            initargs=("io",),
+        )
+        self._pending = []
+        self._layer_indices = None
+        # 既存のチャンクを上書きしないよう、最大の番号の続きから書き込む (途中のチャンクが
+        # 削除されていると件数と番号が一致しない)
+        self._chunk_index = _next_chunk_index(directory)
+        self.num_records = 0
+        custom_logger.info(
+            f"feature recording to {directory} / {chunk_records} records per chunk / "
+            f"dtype {self.feature_dtype} / crops {store_crops}"
+        )
+
+    @classmethod
+    def from_config(cls, system_config, subdirectory=None, scheduling_policy=None):
+        directory = system_config.recording_directory
+        if subdirectory:
+            directory = os.path.join(directory, subdirectory)
+        return cls(
+            directory=directory,
+            chunk_records=system_config.recording_chunk_records,
+            feature_dtype=system_config.recording_feature_dtype,
+            store_crops=system_config.recording_store_crops,
+            crop_jpeg_quality=system_config.recording_crop_jpeg_quality,
+            scheduling_policy=scheduling_policy,
+        )
+
+    def add(self, record, sample_feats, crop=None):
+        """
+        record は frame_id / index / class_label などのメタデータ、sample_feats は Anomaly.detect の戻り値
+        """
+        if sample_feats is None:
+            return
+        layer_indices = [int(index) for index in sample_feats["layer_indices"]]
+        features = [
+            np.asarray(layer_output[0], dtype=self.feature_dtype).ravel()
+            for layer_output in sample_feats["layer_outputs"]
+        ]
+        encoded = None
+        if self.store_crops and crop is not None:
+            ok, buffer = cv2.imencode(
+                ".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, self.crop_jpeg_quality]
+            )
+            encoded = buffer.ravel() if ok else np.empty(0, dtype=np.uint8)
+
+        with self._lock:
+            # チャンク内では同じレイヤー構成を前提とするため、構成が変わったら先に書き出す
+            if self._layer_indices is not None and layer_indices != self._layer_indices:
+                self._submit_chunk()
+            self._layer_indices = layer_indices
+            self._pending.append((record, features, encoded))
+            self.num_records += 1
+            if len(self._pending) >= self.chunk_records:
+                self._submit_chunk()
+
+    def _submit_chunk(self):
+        if not self._pending:
+            return
+        path = os.path.join(self.directory, f"chunk_{self._chunk_index:06d}.npz")
+        self._chunk_index += 1
+        self._executor.submit(
+            tracer.wrap("record.write_chunk", self._write_chunk),
+            path,
+            self._pending,
+            self._layer_indices,
+        )
+        self._pending = []
+
+    def _write_chunk(self, path, pending, layer_indices):
+        start_time = time.perf_counter()
+        try:
+            arrays = {
+                "meta": np.frombuffer(
+                    json.dumps([record for record, _, _ in pending]).encode("utf-8"),
+                    dtype=np.uint8,
+                ),
+                "layer_indices": np.asarray(layer_indices, dtype=np.int64),
+            }
+            for position, layer_index in enumerate(layer_indices):
+                arrays[f"layer_{layer_index}"] = np.stack(
+                    [features[position] for _, features, _ in pending]
+                )
+            if self.store_crops:
+                crops = [
+                    encoded if encoded is not None else np.empty(0, dtype=np.uint8)
+                    for _, _, encoded in pending
+                ]
+                arrays["crops"] = np.concatenate(crops)
+                arrays["crop_offsets"] = np.concatenate(
+                    [[0], np.cumsum([len(crop) for crop in crops])]
+                ).astype(np.int64)
+
+            # 書き込み途中のファイルを読まないよう一時ファイルから置き換える
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(temp_path, path)
+            custom_logger.debug(
+                f"feature chunk saved: {path} / {len(pending)} records / "
+                f"{(time.perf_counter() - start_time) * 1000.0:.1f} ms"
+            )
+        except Exception:
+            custom_logger.exception(f"failed to write feature chunk {path}")
+
+    def close(self):
+        with self._lock:
+            self._submit_chunk()
+        self._executor.shutdown(wait=True)
+        custom_logger.info(
+            f"feature recording closed / {self.num_records} records / "
+            f"next chunk {self._chunk_index:06d}"
+        )
+
+
+class FeatureArchiveReader:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def chunk_paths(self):
+        # マルチプロセス構成ではワーカーごとのサブディレクトリに記録される
+        return sorted(
+            glob.glob(os.path.join(self.directory, "**", "chunk_*.npz"), recursive=True)
+        )
+
+    def load_chunk(self, path):
+        with np.load(path) as data:
+            records = json.loads(data["meta"].tobytes().decode("utf-8"))
+            layer_indices = [int(index) for index in data["layer_indices"]]
+            layers = {
+                layer_index: data[f"layer_{layer_index}"].astype(np.float32)
+                for layer_index in layer_indices
+            }
+            crops = None
+            if "crops" in data.files:
+                crops = (data["crops"], data["crop_offsets"])
+        return FeatureChunk(path, records, layer_indices, layers, crops)
+
+    def __iter__(self):
+        for path in self.chunk_paths():
+            yield self.load_chunk(path)
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+
+from logger.custom_logger import custom_logger
+
+
+class SegmentInfo:
+    def __init__(self, file_name, first_frame_id, first_ts):
+        self.file_name = file_name
+        self.first_frame_id = first_frame_id
+        self.last_frame_id = first_frame_id
+        self.first_ts = first_ts
+        self.last_ts = first_ts
+        self.size = 0
+
+    def update(self, frame_id, ts, num_bytes):
+        self.last_frame_id = frame_id
+        self.last_ts = ts
+        self.size += num_bytes
+
+    def overlaps(self, start_ts, end_ts):
+        return self.last_ts >= start_ts and self.first_ts <= end_ts
+
+    def to_dict(self):
+        return {
+            "file_name": self.file_name,
+            "first_frame_id": self.first_frame_id,
+            "last_frame_id": self.last_frame_id,
+            "first_ts": self.first_ts,
+            "last_ts": self.last_ts,
+            "size": self.size,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        info = cls(data["file_name"], data["first_frame_id"], data["first_ts"])
+        info.last_frame_id = data["last_frame_id"]
+        info.last_ts = data["last_ts"]
+        info.size = data["size"]
+        return info
+
+
+class ResultStore:
+    """
+    検出結果を JSONL 形式でセグメントファイルへ追記する
+
+    セグメントはサイズで切り替え、フレーム ID とタイムスタンプの範囲を index.json に保持する。
+    全セグメントの合計サイズが total_budget_bytes を超えた場合は古いセグメントから削除する
+    """
+
+    _index_file_name = "index.json"
+    _segment_prefix = "segment_"
+    _segment_suffix = ".jsonl"
+
+    def __init__(
+        self,
+        directory,
+        segment_max_bytes=4 * 1024 * 1024,
+        total_budget_bytes=256 * 1024 * 1024,
+        fsync=False,
+    ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.total_budget_bytes = total_budget_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._segments = []
+        self._active_file = None
+        self._next_frame_id = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        custom_logger.info(
+            f"result store opened / directory {self.directory} / "
+            f"segments {len(self._segments)} / next frame id {self._next_frame_id}"
+        )
+
+    def _segment_path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def _recover(self):
+        index_path = self._segment_path(self._index_file_name)
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                self._segments = [SegmentInfo.from_dict(d) for d in json.load(f)]
+        self._segments = [
+            s for s in self._segments if os.path.exists(self._segment_path(s.file_name))
+        ]
+
+        # index.json はローテーション時にのみ書かれるため、索引外のセグメントは走査して復元する
+        indexed = {s.file_name for s in self._segments}
+        for file_name in sorted(os.listdir(self.directory)):
+            if (
+                file_name.startswith(self._segment_prefix)
+                and file_name.endswith(self._segment_suffix)
+                and file_name not in indexed
+            ):
+                segment = self._scan_segment(file_name)
+                if segment is not None:
+                    self._segments.append(segment)
+        self._segments.sort(key=lambda s: s.first_frame_id)
+
+        # 最後のセグメントは索引の作成後にも追記されているため必ず走査し直す
+        if self._segments:
+            last = self._segments[-1]
+            rescanned = self._scan_segment(last.file_name)
+            if rescanned is None:
+                self._segments.pop()
+                os.remove(self._segment_path(last.file_name))
+                self._next_frame_id = last.first_frame_id
+            else:
+                self._segments[-1] = rescanned
+
+        if self._segments:
+            self._next_frame_id = self._segments[-1].last_frame_id + 1
+
+    def _scan_segment(self, file_name):
+        segment = None
+        with open(self._segment_path(file_name), "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で停止した末尾行は読み飛ばす
+                    custom_logger.warning(f"skipping truncated record in {file_name}")
+                    continue
+                if segment is None:
+                    segment = SegmentInfo(file_name, record["frame_id"], record["ts"])
+                segment.update(record["frame_id"], record["ts"], len(line))
+        return segment
+
+    def _write_index(self):
+        index_path = self._segment_path(self._index_file_name)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([s.to_dict() for s in self._segments], f, separators=(",", ":"))
+        os.replace(tmp_path, index_path)
+
+    def _rotate(self, frame_id, ts):
+        if self._active_file is not None:
+            self._active_file.close()
+            self._active_file = None
+
+        file_name = f"{self._segment_prefix}{frame_id:012d}{self._segment_suffix}"
+        self._segments.append(SegmentInfo(file_name, frame_id, ts))
+        self._active_file = open(self._segment_path(file_name), "ab")
+        self._enforce_budget()
+        self._write_index()
+
+    def _enforce_budget(self):
+        total = sum(s.size for s in self._segments)
+        while total > self.total_budget_bytes and len(self._segments) > 1:
+            oldest = self._segments.pop(0)
+            os.remove(self._segment_path(oldest.file_name))
+            total -= oldest.size
+            custom_logger.warning(
+                f"result store budget exceeded, dropped frames "
+                f"{oldest.first_frame_id}-{oldest.last_frame_id} ({oldest.file_name})"
+            )
+
+    def _needs_rotation(self):
+        if self._active_file is None or not self._segments:
+            return True
+        return self._segments[-1].size >= self.segment_max_bytes
+
+    def append(self, results, ts=None, late=None, frame_id=None):
+        """
+        1 フレーム分の結果を追記して割り当てたフレーム ID を返す
+
+        late には以前のフレームから持ち越して処理した結果を渡す。
+        frame_id を渡すとその ID で記録する (マルチプロセス構成でキャプチャ側が採番する場合)
+        """
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            if frame_id is None:
+                frame_id = self._next_frame_id
+            record = {"frame_id": frame_id, "ts": ts, "results": results}
+            if late:
+                record["late"] = late
+            line = json.dumps(
+                record,
+                separators=(",", ":"),
+                ensure_ascii=False,
+            ).encode("utf-8") + b"\n"
+
+            if self._needs_rotation():
+                self._rotate(frame_id, ts)
+
+            self._active_file.write(line)
+            self._active_file.flush()
+            if self.fsync:
+                os.fsync(self._active_file.fileno())
+
+            self._segments[-1].update(frame_id, ts, len(line))
+            self._next_frame_id = max(self._next_frame_id, frame_id + 1)
+            return frame_id
+
+    def peek_next_frame_id(self):
+        with self._lock:
+            return self._next_frame_id
+
+    def query(self, start_ts, end_ts):
+        """
+        start_ts 以上 end_ts 以下のレコードを古い順に返す
+        """
+        with self._lock:
+            if self._active_file is not None:
+                self._active_file.flush()
+            segments = [s for s in self._segments if s.overlaps(start_ts, end_ts)]
+
+        for segment in segments:
+            path = self._segment_path(segment.file_name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if start_ts <= record["ts"] <= end_ts:
+                        yield record
+
+    def close(self):
+        with self._lock:
+            if self._active_file is not None:
+                self._active_file.close()
+                self._active_file = None
+            self._write_index()
@@ -0,0 +1,22 @@
+import pytest
+
+from config_manager.config import SystemConfigs
+from profiling.allocation import AllocationBudget, AllocationBudgetExceeded
+from profiling.allocation_check import profile_hot_loop
+
+_FRAMES = 200
+
+
+@pytest.fixture(scope="module")
+def report():
+    return profile_hot_loop(_FRAMES, SystemConfigs().allocation_warmup_frames)
+
+
+def test_hot_loop_stays_within_allocation_budget(report):
+    AllocationBudget(SystemConfigs().allocation_budget).check(report)
+
+
+def test_exceeded_budget_is_reported(report):
+    # 予算を超えた場合に check() が失敗することを確かめる
+    with pytest.raises(AllocationBudgetExceeded):
+        AllocationBudget({"total": -1}).check(report)
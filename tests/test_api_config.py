@@ -0,0 +1,12 @@
+from config_manager.config import RESULT_API_SECTION, ApiConfigs
+from sender.wire_format import check_encoding
+
+
+def test_result_api_section_configures_wire_format():
+    api_config = ApiConfigs(section_name=RESULT_API_SECTION)
+    # 読まれるセクションが存在しないと、既定値 (非圧縮 JSON) で送信されてしまう
+    assert RESULT_API_SECTION in api_config.config
+    assert api_config.wire_format == "binary"
+    assert api_config.compression == "gzip"
+    assert api_config.delta_boxes is True
+    check_encoding(api_config.compression)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from detector.admission import DEFERRED, SKIPPED, CropAdmission
+
+
+def _record(frame_id, index):
+    return {"frame_id": frame_id, "index": index}
+
+
+def test_restore_undoes_counts_and_deferred_queue():
+    admission = CropAdmission(max_deferred=2)
+    crop = np.zeros((4, 4, 3), dtype=np.uint8)
+    admission.defer(_record(0, 0), crop)
+    before = admission.stats()
+
+    # 処理し直すフレームで行った持ち越しの取り出しと追加を取り消す
+    checkpoint = admission.checkpoint()
+    assert admission.pop_deferred(1).frame_id == 0
+    admission.defer(_record(1, 0), crop)
+    admission.defer(_record(1, 1), crop)
+    admission.restore(checkpoint)
+
+    assert admission.stats() == before
+    assert admission.stats()[DEFERRED] == 1
+    assert SKIPPED not in admission.stats()
+    entry = admission.pop_deferred(1)
+    assert (entry.frame_id, entry.index) == (0, 0)
+    assert admission.pop_deferred(1) is None
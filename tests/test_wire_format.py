@@ -0,0 +1,106 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from sender.receiver_server import ResultReceiver
+from sender.wire_format import BINARY_CONTENT_TYPE, WireEncoder, compress
+
+
+def _results(shift):
+    return [
+        {
+            "class_id": 1,
+            "class_label": "person",
+            "score": 0.9,
+            "box": {"x1": 10 + shift, "y1": 20, "x2": 110 + shift, "y2": 220},
+            "anomaly_distances": 12.5,
+            "angle_diff": 3.25,
+        },
+        {
+            "class_id": 2,
+            "class_label": "head",
+            "score": 0.5,
+            "box": {"x1": 30, "y1": 40 + shift, "x2": 60, "y2": 80 + shift},
+            "anomaly_distances": 0.0,
+            "angle_diff": 0.0,
+        },
+    ]
+
+
+def _post(url, payload):
+    request = urllib.request.Request(
+        url,
+        data=compress(payload, "gzip"),
+        headers={"Content-Type": BINARY_CONTENT_TYPE, "Content-Encoding": "gzip"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.fixture
+def receiver():
+    receiver = ResultReceiver(port=0).start()
+    yield receiver
+    receiver.stop()
+
+
+def test_keyframe_and_delta_round_trip(receiver):
+    encoder = WireEncoder(delta_boxes=True)
+
+    assert _post(receiver.url, encoder.encode(1, 100.0, _results(0))) == 200
+    assert _post(receiver.url, encoder.encode(2, 100.1, _results(5))) == 200
+
+    (key_id, key_ts, key_results), (delta_id, _, delta_results) = receiver.received
+    assert (key_id, key_ts) == (1, 100.0)
+    assert delta_id == 2
+    for sent, got in ((_results(0), key_results), (_results(5), delta_results)):
+        for expected, actual in zip(sent, got):
+            assert actual["box"] == expected["box"]
+            assert actual["class_label"] == expected["class_label"]
+            assert actual["score"] == pytest.approx(expected["score"], abs=1e-4)
+            assert actual["anomaly_distances"] == pytest.approx(
+                expected["anomaly_distances"]
+            )
+
+
+def test_delta_without_base_is_rejected(receiver):
+    encoder = WireEncoder(delta_boxes=True)
+    assert _post(receiver.url, encoder.encode(1, 100.0, _results(0))) == 200
+    # フレーム 2 を送らずに、フレーム 2 を基準とする差分フレーム 3 を送る
+    encoder.encode(2, 100.1, _results(5))
+    assert _post(receiver.url, encoder.encode(3, 100.2, _results(10))) == 409
+    assert [frame_id for frame_id, _, _ in receiver.received] == [1]
+
+
+def test_late_results_do_not_break_deltas(receiver):
+    encoder = WireEncoder(delta_boxes=True)
+    assert _post(receiver.url, encoder.encode(1, 100.0, _results(0))) == 200
+    # 持ち越し分のフレーム 0 を挟んでも、フレーム 2 はフレーム 1 との差分で届く
+    assert _post(receiver.url, encoder.encode(0, 99.9, _results(3), late=True)) == 200
+    assert _post(receiver.url, encoder.encode(2, 100.1, _results(5))) == 200
+
+    (_, _, key_results), (late_id, _, late_results), (_, _, delta_results) = (
+        receiver.received
+    )
+    assert late_id == 0
+    assert all(result["late"] for result in late_results)
+    assert not any("late" in result for result in key_results + delta_results)
+    assert [r["box"] for r in delta_results] == [r["box"] for r in _results(5)]
+
+
+def test_sender_delivers_queued_results(receiver):
+    pytest.importorskip("requests")
+    from sender.result_sender import Sender
+
+    sender = Sender(
+        receiver.url, wire_format="binary", compression="gzip", queue_size=8
+    )
+    for frame_id in range(3):
+        sender.enqueue(frame_id, 100.0 + frame_id, _results(frame_id))
+    sender.close(timeout=5)
+    assert [frame_id for frame_id, _, _ in receiver.received] == [0, 1, 2]